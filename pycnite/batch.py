@@ -0,0 +1,131 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Process many pyc files in parallel."""
+
+from concurrent import futures
+import dataclasses
+import itertools
+import os
+import time
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+
+@dataclasses.dataclass
+class BatchStats:
+    """Throughput summary for a batch run, updated as results come in."""
+
+    files: int = 0
+    errors: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / 1e6 / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.files} files ({self.errors} errors), "
+            f"{self.bytes / 1e6:.1f} MB in {self.elapsed:.2f}s: "
+            f"{self.files_per_second:.0f} files/s, "
+            f"{self.mb_per_second:.1f} MB/s"
+        )
+
+
+def _run_chunk(
+    fn: Callable[[str], Any], paths: List[str]
+) -> List[Tuple[str, Any, int]]:
+    """Run fn over a chunk of paths, capturing errors and file sizes."""
+    ret = []
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+            ret.append((path, fn(path), size))
+        except Exception as e:  # pylint: disable=broad-except
+            ret.append((path, e, 0))
+    return ret
+
+
+def _chunks(paths: Iterable[str], chunksize: int) -> Iterator[List[str]]:
+    it = iter(paths)
+    while True:
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run(
+    fn: Callable[[str], Any],
+    paths: Iterable[str],
+    jobs: Optional[int] = None,
+    chunksize: int = 64,
+    stats: Optional[BatchStats] = None,
+) -> Iterator[Tuple[str, Any]]:
+    """Run fn over paths in a process pool.
+
+    Paths are sent to the workers in chunks, and results are yielded as each
+    chunk finishes, so they are not in input order. Only a bounded number of
+    chunks is in flight at once, so results are not buffered in memory if the
+    caller consumes them slowly.
+
+    Args:
+      fn: A picklable (i.e. module-level) function taking a file path.
+      paths: The file paths to process.
+      jobs: The number of worker processes; defaults to the number of CPUs. If
+        jobs is 1, everything runs in the current process.
+      chunksize: The number of paths sent to a worker at once.
+      stats: If given, updated with throughput information as results are
+        yielded.
+
+    Yields:
+      (path, result) tuples. If fn raised an exception, the exception is
+      yielded in place of the result.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+
+    def process(results):
+        for path, result, size in results:
+            if stats is not None:
+                stats.files += 1
+                stats.bytes += size
+                if isinstance(result, Exception):
+                    stats.errors += 1
+                stats.elapsed = time.perf_counter() - start
+            yield path, result
+
+    chunks = _chunks(paths, chunksize)
+    if jobs == 1:
+        for chunk in chunks:
+            yield from process(_run_chunk(fn, chunk))
+        return
+    with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        for chunk in itertools.islice(chunks, jobs * 2):
+            pending.add(executor.submit(_run_chunk, fn, chunk))
+        while pending:
+            done, pending = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED
+            )
+            for chunk in itertools.islice(chunks, len(done)):
+                pending.add(executor.submit(_run_chunk, fn, chunk))
+            for f in done:
+                yield from process(f.result())
@@ -14,12 +14,27 @@
 
 """Bytecode reader."""
 
-from dataclasses import dataclass
+import array
+import collections
+import dataclasses
+import json
 
-from typing import cast, Iterable, List, Optional
+from typing import (
+    Any,
+    Callable,
+    cast,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
+from . import batch
 from . import linetable
 from . import mapping
+from . import pyc
 from . import types
 
 
@@ -28,7 +43,7 @@ HAVE_ARGUMENT = 90
 EXTENDED_ARG = 144
 
 
-@dataclass
+@dataclasses.dataclass
 class RawOpcode:
     """Opcode parsed from code.co_code."""
 
@@ -67,13 +82,99 @@ class _Unknown:
     def __repr__(self):
         return "<unknown>"
 
+    def __reduce__(self):
+        # Unpickle as the module-level singleton, so that `is UNKNOWN` checks
+        # keep working on pickled results, e.g. from cache.DiskCache.
+        return "UNKNOWN"
+
 
 # Sentinel to represent values that cannot be calculated
 UNKNOWN = _Unknown()
 
 
-def _is_backward_jump(name):
-    return "JUMP_BACKWARD" in name
+class _LazyState:
+    """State shared by the LazyOpcodes from one disassembly."""
+
+    def __init__(self, disassembler: "Disassembler"):
+        self.disassembler = disassembler
+        self.offsets = array.array("i")
+        self.ends = array.array("i")
+        self.reader = linetable.linetable_reader(disassembler.code)
+        self.positions: List[linetable.Entry] = []
+
+    def position(self, index: int) -> linetable.Entry:
+        # The line table reader only goes forwards, so we decode the positions
+        # of all opcodes up to the one requested.
+        while len(self.positions) <= index:
+            offset = self.offsets[len(self.positions)]
+            self.positions.append(self.reader.get(offset))
+        return self.positions[index]
+
+    def argval(self, index: int, op: int, arg: Optional[int]) -> Any:
+        return self.disassembler.resolve_argval(op, arg, self.ends[index])
+
+
+def _lazy_field(name: str, compute):
+    """A property that fills in the Opcode slot `name` on first access."""
+    slot = getattr(types.Opcode, name)
+
+    def get(self):
+        # Read the slot through super(), since our property shadows it.
+        try:
+            return getattr(super(LazyOpcode, self), name)
+        except AttributeError:
+            compute(self)
+            return getattr(super(LazyOpcode, self), name)
+
+    # The slot's setter writes the Opcode slot rather than our property.
+    return property(get, getattr(slot, "__set__"))
+
+
+class LazyOpcode(types.Opcode):
+    """An Opcode whose argval and position are computed on first access."""
+
+    __slots__ = ("_state", "_index")
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self,
+        state: _LazyState,
+        index: int,
+        *,
+        offset: int,
+        op: int,
+        name: str,
+        arg: Optional[int],
+    ):
+        self._state = state
+        self._index = index
+        self.offset = offset
+        self.op = op
+        self.name = name
+        self.arg = arg
+
+    def _set_position(self):
+        pos = self._state.position(self._index)
+        self.line = pos.line
+        self.endline = pos.endline
+        self.col = pos.startcol
+        self.endcol = pos.endcol
+
+    def _set_argval(self):
+        self.argval = self._state.argval(self._index, self.op, self.arg)
+
+    line = _lazy_field("line", _set_position)
+    endline = _lazy_field("endline", _set_position)
+    col = _lazy_field("col", _set_position)
+    endcol = _lazy_field("endcol", _set_position)
+    argval = _lazy_field("argval", _set_argval)
+
+    def _fields(self):
+        return tuple(getattr(self, f.name) for f in dataclasses.fields(self))
+
+    def __eq__(self, other):
+        if isinstance(other, types.Opcode):
+            return self._fields() == LazyOpcode._fields(other)
+        return NotImplemented
 
 
 class Disassembler:
@@ -82,90 +183,282 @@ class Disassembler:
     def __init__(self, code):
         self.code = code
         self.python_version = code.python_version[:2]
-        self.opmap = mapping.get_mapping(self.python_version)
-        if self.python_version < (3, 11):
+        self.op_table = mapping.get_op_table(self.python_version)
+        if self.python_version >= (3, 11):
+            code = cast(types.CodeType311, code)
+            local_names = free_names = code.co_localsplusnames
+        else:
             code = cast(types.CodeType38, code)
-            self.cell_names = code.co_cellvars + code.co_freevars
+            local_names = code.co_varnames
+            free_names = code.co_cellvars + code.co_freevars
+        # The tables that opargs index into, by mapping arg type.
+        self.arg_values = {
+            mapping.CONST: code.co_consts,
+            mapping.NAME: code.co_names,
+            mapping.LOCAL: local_names,
+            mapping.FREE: free_names,
+        }
+
+    def _get_opinfo(self, op: int) -> mapping.OpInfo:
+        info = self.op_table[op]
+        if info is None:
+            raise KeyError(op)
+        return info
 
-    def _lookup(self, vals: Optional[tuple], arg: int):
+    def _get_argval(self, info: mapping.OpInfo, arg: int, end_pos: int):
+        if info.decode_arg is not None:
+            arg = info.decode_arg(arg, end_pos)
+        if info.arg_type not in self.arg_values:
+            return arg
+        vals = self.arg_values[info.arg_type]
         if vals is None or arg >= len(vals):
             return UNKNOWN
         return vals[arg]
 
-    def _decode_arg(self, name: str, arg_type: int, arg: int, end_pos: int):
-        if self.python_version >= (3, 12):
-            if name == "COMPARE_OP":
-                return arg >> 4
-            if name == "LOAD_ATTR":
-                return arg >> 1
-        if self.python_version >= (3, 11):
-            if name == "LOAD_GLOBAL":
-                return arg // 2
-        if self.python_version >= (3, 10):
-            if arg_type == mapping.JREL:
-                signed_arg = -arg if _is_backward_jump(name) else arg
-                return signed_arg * 2 + end_pos
-            elif arg_type == mapping.JABS:
-                return arg * 2
-        if arg_type == mapping.JREL:
-            return arg + end_pos
-        return arg
-
-    def _get_argval(self, name: str, arg: int, end_pos: int):
-        arg_type = mapping.arg_type(name, self.python_version)
-        arg = self._decode_arg(name, arg_type, arg, end_pos)
-        if arg_type == mapping.CONST:
-            return self._lookup(self.code.co_consts, arg)
-        elif arg_type == mapping.NAME:
-            return self._lookup(self.code.co_names, arg)
-        elif arg_type == mapping.LOCAL:
-            if self.python_version >= (3, 11):
-                return self._lookup(self.code.co_localsplusnames, arg)
-            else:
-                return self._lookup(self.code.co_varnames, arg)
-        elif arg_type == mapping.FREE:
-            if self.python_version >= (3, 11):
-                return self._lookup(self.code.co_localsplusnames, arg)
-            else:
-                return self._lookup(self.cell_names, arg)
-        else:
-            return arg
+    def _get_display_argval(self, info: mapping.OpInfo, arg: int, end_pos: int):
+        argval = self._get_argval(info, arg, end_pos)
+        if isinstance(argval, types.CodeTypeBase):
+            argval = f"<code:{argval.co_name}>"
+        return argval
 
-    def dis(self) -> List[types.Opcode]:
-        """Disassemble code."""
+    def resolve_argval(self, op: int, arg: Optional[int], end_pos: int):
+        """Get the argval for an instruction, as computed by dis().
+
+        Args:
+          op: The opcode.
+          arg: The oparg, including any EXTENDED_ARG prefixes.
+          end_pos: The offset of the next instruction.
+
+        Returns:
+          The argval.
+        """
+        return self._get_display_argval(self._get_opinfo(op), arg, end_pos)
+
+    def _dis(self) -> Iterator[Tuple]:
+        """Disassemble code, yielding fields in types.Opcode order."""
         lt = linetable.linetable_reader(self.code)
-        ret = []
         for o in wordcode_reader(self.code.co_code):
             if o.op == 0:  # CACHE
                 continue
-            name = self.opmap[o.op]
+            info = self._get_opinfo(o.op)
             pos = lt.get(o.start)
-            argval = self._get_argval(name, o.arg, o.end)
-            if isinstance(argval, types.CodeTypeBase):
-                argval = f"<code:{argval.co_name}>"
-            op = types.Opcode(
-                offset=o.start,
-                name=name,
-                line=pos.line,
-                endline=pos.endline,
-                col=pos.startcol,
-                endcol=pos.endcol,
-                op=o.op,
-                arg=o.arg,
+            argval = self._get_display_argval(info, o.arg, o.end)
+            yield (
+                o.start,
+                pos.line,
+                pos.endline,
+                pos.startcol,
+                pos.endcol,
+                o.op,
+                info.name,
+                o.arg,
+                argval,
+            )
+
+    def _iter_lazy(self) -> Iterator[LazyOpcode]:
+        state = _LazyState(self)
+        for o in wordcode_reader(self.code.co_code):
+            if o.op == 0:  # CACHE
+                continue
+            name = self._get_opinfo(o.op).name
+            index = len(state.offsets)
+            state.offsets.append(o.start)
+            state.ends.append(o.end)
+            yield LazyOpcode(
+                state, index, offset=o.start, op=o.op, name=name, arg=o.arg
+            )
+
+    def iter_dis(self, lazy: bool = False) -> Iterator[types.Opcode]:
+        """Disassemble code, yielding opcodes as they are decoded.
+
+        Args:
+          lazy: Yield LazyOpcodes, whose argval and position fields are only
+            computed when first accessed.
+
+        Returns:
+          An iterator over opcodes.
+        """
+        if lazy:
+            return self._iter_lazy()
+        return (types.Opcode(*fields) for fields in self._dis())
+
+    def dis(self, lazy: bool = False) -> List[types.Opcode]:
+        """Disassemble code."""
+        return list(self.iter_dis(lazy))
+
+    def dis_table(self) -> types.OpcodeTable:
+        """Disassemble code into columnar storage."""
+        ret = types.OpcodeTable()
+        for fields in self._dis():
+            offset, line, endline, col, endcol, op, name, arg, argval = fields
+            ret.add(
+                offset,
+                line,
+                op,
+                name,
+                endline=endline,
+                col=col,
+                endcol=endcol,
+                arg=arg,
                 argval=argval,
             )
-            ret.append(op)
         return ret
 
 
-def dis(code: types.CodeTypeBase) -> List[types.Opcode]:
+def dis(code: types.CodeTypeBase, lazy: bool = False) -> List[types.Opcode]:
     """Disassemble a single piece of top-level code."""
-    return Disassembler(code).dis()
+    return Disassembler(code).dis(lazy)
+
+
+def iter_dis(
+    code: types.CodeTypeBase, lazy: bool = False
+) -> Iterator[types.Opcode]:
+    """Disassemble a single piece of top-level code, yielding opcodes."""
+    return Disassembler(code).iter_dis(lazy)
+
+
+def dis_table(code: types.CodeTypeBase) -> types.OpcodeTable:
+    """Disassemble a single piece of top-level code into an OpcodeTable."""
+    return Disassembler(code).dis_table()
+
+
+def _with_positions(
+    code: types.CodeTypeBase, opcodes: List[types.Opcode]
+) -> List[types.Opcode]:
+    """Copy opcodes, replacing their positions with those from code."""
+    lt = linetable.linetable_reader(code)
+    ret = []
+    for op in opcodes:
+        pos = lt.get(op.offset)
+        ret.append(
+            types.Opcode(
+                op.offset,
+                pos.line,
+                pos.endline,
+                pos.startcol,
+                pos.endcol,
+                op.op,
+                op.name,
+                op.arg,
+                op.argval,
+            )
+        )
+    return ret
+
+
+def _shift_lines(opcodes: List[types.Opcode], delta: int) -> List[types.Opcode]:
+    """Copy opcodes, moving them down by delta lines."""
+    ret = []
+    for op in opcodes:
+        endline = op.endline
+        if endline is not None and endline != -1:
+            endline += delta
+        ret.append(
+            types.Opcode(
+                op.offset,
+                op.line + delta,
+                endline,
+                op.col,
+                op.endcol,
+                op.op,
+                op.name,
+                op.arg,
+                op.argval,
+            )
+        )
+    return ret
 
 
-def dis_all(code: types.CodeTypeBase) -> types.DisassembledCode:
-    """Recursively disassemble code and contained code blocks."""
-    opcodes = dis(code)
+def _line_table(code: types.CodeTypeBase) -> bytes:
+    if code.python_version >= (3, 11):
+        return cast(types.CodeType311, code).co_linetable
+    return cast(types.CodeType38, code).co_lnotab
+
+
+@dataclasses.dataclass
+class _DisCacheEntry:
+    __slots__ = ("fingerprint", "firstlineno", "line_table", "opcodes")
+
+    fingerprint: bytes
+    firstlineno: int
+    line_table: bytes
+    opcodes: List[types.Opcode]
+
+
+class DisCache:
+    """LRU cache of disassembled code, keyed by code fingerprint.
+
+    Pass one to dis_all() to reuse the opcodes of code objects that have not
+    changed since an earlier call, e.g. when analysing a rebuilt module.
+    Entries are keyed by the fingerprint without line information, so code
+    that has only moved within its file gets its new positions filled in
+    rather than being disassembled again.
+
+    Cached opcode lists are shared between results, so they must not be
+    modified.
+    """
+
+    def __init__(self, maxsize: int = 16384):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Keyed by fingerprint(lines=False)
+        self._entries: Dict[bytes, _DisCacheEntry] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def dis(self, code: types.CodeTypeBase) -> List[types.Opcode]:
+        """Disassemble code, or get its opcodes from the cache."""
+        key = code.fingerprint(lines=False)
+        fingerprint = code.fingerprint()
+        line_table = _line_table(code)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            opcodes = dis(code)
+        else:
+            self.hits += 1
+            opcodes = entry.opcodes
+            if entry.fingerprint == fingerprint:
+                pass
+            elif entry.line_table == line_table:
+                # Line tables are relative to the first line, so the code has
+                # just been moved.
+                delta = code.co_firstlineno - entry.firstlineno
+                opcodes = _shift_lines(opcodes, delta)
+            else:
+                opcodes = _with_positions(code, opcodes)
+        # (Re)insert the entry as the most recently used one.
+        self._entries[key] = _DisCacheEntry(
+            fingerprint, code.co_firstlineno, line_table, opcodes
+        )
+        if len(self._entries) > self.maxsize:
+            del self._entries[next(iter(self._entries))]
+        return opcodes
+
+
+def _check_dis_options(table: bool, lazy: bool, cache: Optional[DisCache]):
+    if table + lazy + (cache is not None) > 1:
+        raise ValueError("table, lazy and cache are mutually exclusive")
+
+
+def _dis_one(
+    code: types.CodeTypeBase,
+    table: bool,
+    lazy: bool,
+    cache: Optional[DisCache],
+) -> types.DisassembledCode:
+    """Disassemble code, without its children."""
+    if cache is not None:
+        opcodes = cache.dis(code)
+    elif table:
+        opcodes = dis_table(code)
+    else:
+        opcodes = dis(code, lazy)
     if code.python_version >= (3, 11):
         code = cast(types.CodeType311, code)
         et = linetable.ExceptionTableReader(code)
@@ -176,10 +469,177 @@ def dis_all(code: types.CodeTypeBase) -> types.DisassembledCode:
         # before accessing the exception table, rather than doing type or
         # presence checks on the attribute.
         exc_table = types.ExceptionTable([])
-    ret = types.DisassembledCode(
+    return types.DisassembledCode(
         code=code, opcodes=opcodes, exception_table=exc_table, children=[]
     )
+
+
+def dis_all(
+    code: types.CodeTypeBase,
+    table: bool = False,
+    lazy: bool = False,
+    cache: Optional[DisCache] = None,
+) -> types.DisassembledCode:
+    """Recursively disassemble code and contained code blocks.
+
+    Args:
+      code: The code to disassemble.
+      table: Store opcodes in a types.OpcodeTable rather than a list.
+      lazy: Use LazyOpcodes, which compute their argval and position fields
+        on first access. Cannot be combined with table.
+      cache: Reuse opcode lists from this cache for code objects that have
+        been disassembled before. Cannot be combined with table or lazy.
+
+    Returns:
+      A types.DisassembledCode tree.
+
+    Raises:
+      ValueError: If more than one of table, lazy and cache are set.
+    """
+    _check_dis_options(table, lazy, cache)
+    ret = _dis_one(code, table, lazy, cache)
     for child in code.co_consts:
         if hasattr(child, "co_code"):
-            ret.children.append(dis_all(child))
+            ret.children.append(dis_all(child, table, lazy, cache))
     return ret
+
+
+def dis_walk(
+    code: types.CodeTypeBase,
+    visitor: Callable[[Tuple[str, ...], types.DisassembledCode], None],
+    table: bool = False,
+    lazy: bool = False,
+    cache: Optional[DisCache] = None,
+):
+    """Disassemble code and contained code blocks one at a time.
+
+    Code blocks are visited in the same (depth first) order as dis_all, but
+    each one is only referenced until the visitor returns, so unlike with
+    dis_all, memory use does not grow with the size of the module.
+
+    Args:
+      code: The code to disassemble.
+      visitor: Called with (path, disassembled code) for each code block, where
+        path is as in iter_dis_all() and the types.DisassembledCode has the
+        opcodes and exception table of that block, and no children.
+      table: See dis_all().
+      lazy: See dis_all().
+      cache: See dis_all().
+
+    Raises:
+      ValueError: If more than one of table, lazy and cache are set.
+    """
+    _check_dis_options(table, lazy, cache)
+    for path, c in _walk(code):
+        visitor(path, _dis_one(c, table, lazy, cache))
+
+
+def _walk(
+    code: types.CodeTypeBase,
+) -> Iterator[Tuple[Tuple[str, ...], types.CodeTypeBase]]:
+    """Yield (path, code) for code and nested code blocks, depth first."""
+    stack = [((), code)]
+    while stack:
+        path, code = stack.pop()
+        yield path, code
+        children = [c for c in code.co_consts if hasattr(c, "co_code")]
+        for child in reversed(children):
+            stack.append((path + (child.co_name,), child))
+
+
+def iter_dis_all(
+    code: types.CodeTypeBase, lazy: bool = False
+) -> Iterator[Tuple[Tuple[str, ...], types.Opcode]]:
+    """Recursively disassemble code and contained code blocks, streaming.
+
+    Code blocks are visited in the same (depth first) order as dis_all, but
+    nothing is kept in memory once it has been yielded, so the caller can stop
+    early or pass opcodes on to a sink.
+
+    Args:
+      code: The code to disassemble.
+      lazy: Yield LazyOpcodes, see iter_dis().
+
+    Returns:
+      An iterator over (path, opcode) tuples, where path is the tuple of
+      co_name values of the code blocks enclosing the opcode, starting below
+      the top-level code (so opcodes of the top-level code have path ()).
+    """
+    for path, c in _walk(code):
+        for opcode in iter_dis(c, lazy):
+            yield path, opcode
+
+
+# (path, offset), where path is as in iter_dis_all()
+InstructionRef = Tuple[Tuple[str, ...], int]
+
+
+@dataclasses.dataclass
+class LineIndex:
+    """Map from source lines to the instructions on them, for a whole file.
+
+    Build it with LineIndex.build(code) on the top-level code of a file.
+    """
+
+    lines: Dict[int, List[InstructionRef]]
+
+    @classmethod
+    def build(cls, code: types.CodeTypeBase) -> "LineIndex":
+        """Index code and all nested code blocks, in one pass."""
+        lines: Dict[int, List[InstructionRef]] = {}
+        for path, c in _walk(code):
+            lt = linetable.linetable_reader(c)
+            for o in wordcode_reader(c.co_code):
+                if o.op == 0:  # CACHE
+                    continue
+                line = lt.get(o.start).line
+                lines.setdefault(line, []).append((path, o.start))
+        return cls(lines)
+
+    def get(self, line: int) -> List[InstructionRef]:
+        """Get (path, offset) for every instruction on a line."""
+        return self.lines.get(line, [])
+
+    def to_json(self) -> str:
+        return json.dumps(
+            [
+                [line, [[list(path), offset] for path, offset in refs]]
+                for line, refs in sorted(self.lines.items())
+            ]
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "LineIndex":
+        lines = {}
+        for line, refs in json.loads(data):
+            lines[line] = [(tuple(path), offset) for path, offset in refs]
+        return cls(lines)
+
+
+def dis_file(path: str) -> types.DisassembledCode:
+    """Disassemble all the code in a pyc file."""
+    return dis_all(pyc.load_file(path))
+
+
+def dis_tree(
+    root: str,
+    jobs: Optional[int] = None,
+    chunksize: int = 64,
+    stats: Optional[batch.BatchStats] = None,
+):
+    """Disassemble all *.cpython-3XY.pyc files under a directory in parallel.
+
+    Args:
+      root: The directory to search.
+      jobs: The number of worker processes; defaults to the number of CPUs.
+      chunksize: The number of files sent to a worker at once.
+      stats: If given, updated with throughput information as files are
+        disassembled.
+
+    Returns:
+      An iterator over (path, types.DisassembledCode) tuples in completion
+      order, where the exception raised while processing a file takes the
+      place of its result.
+    """
+    paths = pyc.find_pyc_files(root, cpython_only=True)
+    return batch.run(dis_file, paths, jobs, chunksize, stats)
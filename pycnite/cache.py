@@ -0,0 +1,187 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent on-disk cache of loaded and disassembled pyc files."""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+import zlib
+
+from typing import Any, Callable, Optional
+
+from . import __version__
+from . import bytecode
+from . import pyc
+from . import types
+
+# Written at the start of every cache entry.
+_MAGIC = b"pycnite-cache\x01"
+
+# Cache hits only update the access time of an entry if it is older than this
+# (in seconds), so that warm runs mostly just read from the cache.
+_TOUCH_INTERVAL = 60
+
+# Fraction of max_bytes to evict down to when the cache is full, so that we
+# do not scan the cache directory on every write.
+_EVICT_TO = 0.8
+
+
+class DiskCache:
+    """Cache of pyc.load_file() and bytecode.dis_all() results on disk.
+
+    Entries are keyed by a hash of the pyc file contents and the pycnite
+    version, and stored as compressed pickles. The content hash of each pyc is
+    remembered along with its size and mtime, so a warm lookup only has to
+    stat the pyc and read two small files from the cache; the pyc itself is
+    only read if it has changed.
+
+    Writes are atomic, so several processes can share a cache directory. When
+    the cache grows beyond max_bytes, the least recently used files are
+    removed.
+
+    The cache directory must only be writable by trusted users, since entries
+    are unpickled when read.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Approximate size of the cache directory, computed on first write.
+        self._size: Optional[int] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except OSError:
+            return None
+        if time.time() - mtime > _TOUCH_INTERVAL:
+            try:
+                os.utime(self._path(name))
+            except OSError:
+                pass
+        return data
+
+    def _write(self, name: str, data: bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(name))
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += len(data)
+        if self._size > self.max_bytes:
+            self.evict(int(self.max_bytes * _EVICT_TO))
+
+    def _content_key(self, path: str) -> str:
+        """Get the content key of a pyc file, hashing it only if it changed."""
+        st = os.stat(path)
+        stamp = f"{st.st_mtime_ns} {st.st_size} "
+        abspath = os.path.abspath(path).encode("utf-8", "surrogateescape")
+        name = "path-" + hashlib.sha256(abspath).hexdigest()[:32]
+        pointer = self._read(name)
+        if pointer is not None:
+            pointer_str = pointer.decode("ascii", "replace")
+            if pointer_str.startswith(stamp):
+                return pointer_str[len(stamp) :]
+        with open(path, "rb") as f:
+            data = f.read()
+        h = hashlib.sha256(__version__.__version__.encode("ascii") + b"\0")
+        h.update(data)
+        key = h.hexdigest()[:40]
+        self._write(name, (stamp + key).encode("ascii"))
+        return key
+
+    def _get(self, kind: str, path: str, compute: Callable[[str], Any]):
+        name = f"{kind}-{self._content_key(path)}"
+        data = self._read(name)
+        if data is not None and data.startswith(_MAGIC):
+            try:
+                value = pickle.loads(zlib.decompress(data[len(_MAGIC) :]))
+            except (zlib.error, pickle.UnpicklingError, EOFError, ValueError):
+                # A corrupt entry is treated like a missing one.
+                pass
+            else:
+                self.hits += 1
+                return value
+        self.misses += 1
+        value = compute(path)
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._write(name, _MAGIC + zlib.compress(payload, 1))
+        return value
+
+    def load_file(self, path: str) -> types.CodeTypeBase:
+        """Cached version of pyc.load_file()."""
+        return self._get("code", path, pyc.load_file)
+
+    def dis_all(self, path: str) -> types.DisassembledCode:
+        """Cached version of bytecode.dis_all(pyc.load_file(path))."""
+        return self._get("dis", path, bytecode.dis_file)
+
+    def size(self) -> int:
+        """The total size in bytes of the files in the cache."""
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                total += entry.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def evict(self, max_bytes: int):
+        """Remove least recently used files until the cache fits in max_bytes.
+
+        Args:
+          max_bytes: The size to shrink the cache to.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """Remove all cached files."""
+        self.evict(0)
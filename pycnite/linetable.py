@@ -15,24 +15,54 @@
 """Line table reader."""
 
 import abc
+import array
+import bisect
 import dataclasses
+import re
 
-from typing import List, Optional
+from typing import FrozenSet, Iterator, List, Optional, Set, Tuple
 
 from . import types
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(init=False)
 class Entry:
     """Position information for an opcode."""
 
+    __slots__ = (
+        "offset",
+        "end_offset",
+        "line",
+        "endline",
+        "startcol",
+        "endcol",
+    )
+
     offset: int
     end_offset: int
     line: int
     # The following are new in 3.11
-    endline: Optional[int] = None
-    startcol: Optional[int] = None
-    endcol: Optional[int] = None
+    endline: Optional[int]
+    startcol: Optional[int]
+    endcol: Optional[int]
+
+    # Written out by hand because dataclass defaults don't work with __slots__.
+    def __init__(
+        self,
+        offset: int,
+        end_offset: int,
+        line: int,
+        *,
+        endline: Optional[int] = None,
+        startcol: Optional[int] = None,
+        endcol: Optional[int] = None,
+    ):
+        self.offset = offset
+        self.end_offset = end_offset
+        self.line = line
+        self.endline = endline
+        self.startcol = startcol
+        self.endcol = endcol
 
 
 class LineTableReader(abc.ABC):
@@ -240,6 +270,120 @@ class LineTableReader311(LineTableReader):
             i = self.end
         return ret
 
+    def read_lines(self) -> array.array:
+        """Decode only the line numbers of the remaining entries.
+
+        This is much faster than read() or get(), since column information is
+        skipped over rather than decoded, and no Entry objects are created.
+
+        Returns:
+          An array of alternating end offset and line values, with one pair
+          for each run of code on the same line. The line is -1 for code
+          without location information.
+        """
+        # Hand-inlined version of read(), using locals for speed.
+        info_none = PyCodeLocation.INFO_NONE
+        info_one_line0 = PyCodeLocation.INFO_ONE_LINE0
+        info_no_columns = PyCodeLocation.INFO_NO_COLUMNS
+        info_long = PyCodeLocation.INFO_LONG
+        table = self.table
+        pos = self.pos
+        end_pos = self.end_pos
+        line = self.line
+        end = self.end
+        start = self.start
+        ret = array.array("i")
+        prev_line = None
+        while pos < end_pos:
+            b = table[pos]
+            pos += 1
+            code = (b >> 3) & 15
+            start = end
+            end += ((b & 7) + 1) * 2
+            if code < info_one_line0:
+                # INFO_SHORT*: one byte of column info.
+                pos += 1
+                entry_line = line
+            elif code < info_no_columns:
+                # INFO_ONE_LINE*: two bytes of column info.
+                line += code - info_one_line0
+                pos += 2
+                entry_line = line
+            elif code == info_none:
+                entry_line = -1
+            else:
+                # INFO_NO_COLUMNS or INFO_LONG; starts with a line delta.
+                read = table[pos]
+                pos += 1
+                val = read & 63
+                shift = 0
+                while read & 64:
+                    read = table[pos]
+                    pos += 1
+                    shift += 6
+                    val |= (read & 63) << shift
+                line += -(val >> 1) if val & 1 else val >> 1
+                entry_line = line
+                if code == info_long:
+                    # Skip the end line, start and end column varints.
+                    for _ in range(3):
+                        while table[pos] & 64:
+                            pos += 1
+                        pos += 1
+            if entry_line == prev_line:
+                ret[-2] = end
+            else:
+                ret.append(end)
+                ret.append(entry_line)
+                prev_line = entry_line
+        self.pos = pos
+        self.line = line
+        self.start = start
+        self.end = end
+        return ret
+
+
+def _write_varint(out: bytearray, val: int):
+    while val >= 64:
+        out.append(64 | (val & 63))
+        val >>= 6
+    out.append(val)
+
+
+def strip_columns(code: types.CodeType311) -> bytes:
+    """Re-encode a 3.11+ line table without column information.
+
+    This is the table python writes with -X no_debug_ranges. Line numbers are
+    unchanged, but runs of code on the same line are merged into as few
+    entries as possible, which typically makes the table several times
+    smaller.
+
+    Args:
+      code: The code object whose co_linetable to re-encode.
+
+    Returns:
+      The new line table.
+    """
+    out = bytearray()
+    runs = LineTableReader311(code).read_lines()
+    start = 0
+    prev_line = code.co_firstlineno
+    for i in range(0, len(runs), 2):
+        end, line = runs[i], runs[i + 1]
+        units = (end - start) // 2
+        start = end
+        while units > 0:
+            n = min(units, 8)
+            units -= n
+            if line == -1:
+                out.append(0x80 | (PyCodeLocation.INFO_NONE << 3) | (n - 1))
+                continue
+            out.append(0x80 | (PyCodeLocation.INFO_NO_COLUMNS << 3) | (n - 1))
+            delta = line - prev_line
+            prev_line = line
+            _write_varint(out, (-delta << 1) | 1 if delta < 0 else delta << 1)
+    return bytes(out)
+
 
 class ExceptionTableReader:
     """Read the exception table in 3.11+."""
@@ -282,6 +426,95 @@ class ExceptionTableReader:
         return ret
 
 
+class LineTableIndex:
+    """Random access position lookup for a code object.
+
+    The table is decoded once into runs of offsets that share the same
+    position, stored as sorted start offsets plus packed line and column
+    arrays, so that get() is a binary search. Unlike LineTableReader.get(),
+    every lookup in 3.11+ returns the columns of the entry containing the
+    offset.
+    """
+
+    def __init__(self, code: types.CodeTypeBase):
+        self.end = len(code.co_code)
+        self.starts = array.array("i")
+        self.lines = array.array("i")
+        self.has_columns = code.python_version >= (3, 11)
+        self.endlines = array.array("i")
+        self.startcols = array.array("i")
+        self.endcols = array.array("i")
+        reader = linetable_reader(code)
+        if isinstance(reader, LineTableReader311):
+            self._add(0, reader.line, -1, -1, -1)
+            while reader.pos < reader.end_pos:
+                endline, startcol, endcol = reader.read()
+                self._add(reader.start, reader.line, endline, startcol, endcol)
+            if reader.end < self.end:
+                # Offsets past the end of the table have no position.
+                self._add(reader.end, reader.line, -1, -1, -1)
+        else:
+            for i in range(0, self.end, 2):
+                self._add(i, reader.get(i).line)
+        if not self.starts:
+            self._add(0, code.co_firstlineno)
+
+    def _columns(self):
+        if self.has_columns:
+            return (self.endlines, self.startcols, self.endcols)
+        return ()
+
+    def _add(self, start, line, endline=-1, startcol=-1, endcol=-1):
+        if self.starts and self.starts[-1] == start:
+            # The previous run is empty, replace it.
+            for a in (self.starts, self.lines) + self._columns():
+                a.pop()
+        pos = (line, endline, startcol, endcol)[: 1 + len(self._columns())]
+        if self.starts:
+            prev = tuple(a[-1] for a in (self.lines,) + self._columns())
+            if prev == pos:
+                # Same position as the previous run, extend it.
+                return
+        self.starts.append(start)
+        for a, x in zip((self.lines,) + self._columns(), pos):
+            a.append(x)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def get(self, i: int) -> Entry:
+        """Get position information for the instruction at byte position i.
+
+        Args:
+          i: The byte position in the bytecode, in any order.
+
+        Returns:
+          The position of the instruction at i. end_offset is the end of the
+          run of instructions sharing the position.
+        """
+        k = max(bisect.bisect_right(self.starts, i) - 1, 0)
+        end = self.starts[k + 1] if k + 1 < len(self.starts) else self.end
+        if not self.has_columns:
+            return Entry(offset=i, end_offset=end, line=self.lines[k])
+        return Entry(
+            offset=i,
+            end_offset=end,
+            line=self.lines[k],
+            endline=self.endlines[k],
+            startcol=self.startcols[k],
+            endcol=self.endcols[k],
+        )
+
+
+def line_index(code: types.CodeTypeBase) -> LineTableIndex:
+    """Get the LineTableIndex for code, building and caching it on first use."""
+    index = getattr(code, "_line_index", None)
+    if index is None:
+        index = LineTableIndex(code)
+        code._line_index = index  # pylint: disable=protected-access
+    return index
+
+
 def linetable_reader(code: types.CodeTypeBase) -> LineTableReader:
     if code.python_version < (3, 10):
         assert isinstance(code, types.CodeType38)
@@ -292,3 +525,114 @@ def linetable_reader(code: types.CodeTypeBase) -> LineTableReader:
     else:
         assert isinstance(code, types.CodeType311)
         return LineTableReader311(code)
+
+
+def _lnotab_lines(code: types.CodeType38) -> Iterator[Tuple[int, int]]:
+    """Yield (start offset, line) for each change of line in a lnotab."""
+    table = code.co_lnotab
+    line = code.co_firstlineno
+    addr = 0
+    if code.python_version < (3, 10):
+        # Pairs of (address increment, line increment), applied in turn.
+        yield 0, line
+        for i in range(0, len(table), 2):
+            addr += table[i]
+            delta = table[i + 1]
+            line += delta - 0x100 if delta >= 0x80 else delta
+            yield addr, line
+    else:
+        # Pairs of (address increment, line increment), where each line applies
+        # to the addresses *before* its address increment, and a line
+        # increment of -128 means no line.
+        for i in range(0, len(table), 2):
+            delta = table[i + 1]
+            if delta == 128:
+                yield addr, -1
+            else:
+                line += delta - 0x100 if delta > 128 else delta
+                yield addr, line
+            addr += table[i]
+
+
+# In 3.11+ line tables the first byte of each entry has the high bit set, and
+# no other byte does. Entries that change the line (INFO_ONE_LINE1,
+# INFO_ONE_LINE2, INFO_NO_COLUMNS and INFO_LONG) start with a byte in
+# [0xd8, 0xf7], and entries that keep it (INFO_SHORT*, INFO_ONE_LINE0) with one
+# in [0x80, 0xd7], so we can find them without decoding the whole table.
+_LINE_CHANGE_ENTRY = re.compile(rb"[\xd8-\xf7]")
+_SAME_LINE_ENTRY = re.compile(rb"[\x80-\xd7]")
+
+
+def _add_linetable_lines(code: types.CodeType311, lines: Set[int]):
+    table = code.co_linetable
+    line = code.co_firstlineno
+    first_change = _LINE_CHANGE_ENTRY.search(table)
+    first_same = _SAME_LINE_ENTRY.search(table)
+    if first_same and (
+        not first_change or first_same.start() < first_change.start()
+    ):
+        # Code before the first change of line is on the first line.
+        lines.add(line)
+    no_columns = PyCodeLocation.INFO_NO_COLUMNS
+    one_line0 = PyCodeLocation.INFO_ONE_LINE0
+    for m in _LINE_CHANGE_ENTRY.finditer(table):
+        pos = m.start()
+        kind = (table[pos] >> 3) & 15
+        if kind < no_columns:
+            line += kind - one_line0
+        else:
+            pos += 1
+            read = table[pos]
+            val = read & 63
+            shift = 0
+            while read & 64:
+                pos += 1
+                read = table[pos]
+                shift += 6
+                val |= (read & 63) << shift
+            line += -(val >> 1) if val & 1 else val >> 1
+        lines.add(line)
+
+
+def _add_lines(code: types.CodeTypeBase, lines: Set[int]):
+    if code.python_version >= (3, 11):
+        assert isinstance(code, types.CodeType311)
+        _add_linetable_lines(code, lines)
+        return
+    assert isinstance(code, types.CodeType38)
+    end = len(code.co_code)
+    prev_start, prev_line = 0, -1
+    for start, line in _lnotab_lines(code):
+        if start > prev_start:
+            lines.add(prev_line)
+        if start >= end:
+            return
+        prev_start, prev_line = start, line
+    if end > prev_start:
+        lines.add(prev_line)
+
+
+def executable_lines(
+    code: types.CodeTypeBase, recursive: bool = True
+) -> FrozenSet[int]:
+    """Get the lines that have bytecode.
+
+    Only the line tables are decoded, which is much faster than getting the
+    lines of all opcodes via bytecode.dis_all().
+
+    Args:
+      code: The code object.
+      recursive: Include the lines of nested code objects in co_consts.
+
+    Returns:
+      The set of line numbers that at least one instruction maps to.
+    """
+    lines: Set[int] = set()
+    stack = [code]
+    while stack:
+        c = stack.pop()
+        _add_lines(c, lines)
+        if recursive:
+            stack.extend(x for x in c.co_consts if hasattr(x, "co_code"))
+    lines.discard(-1)
+    return frozenset(lines)
@@ -14,7 +14,7 @@
 
 """Mapping of opcode codes to names."""
 
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
 
 OpMap = Dict[int, str]
 Overlay = Dict[int, Optional[str]]
@@ -421,3 +421,95 @@ def arg_type(name: str, version: Tuple[int, int]) -> Optional[int]:
     else:
         argmap = PYTHON_3_8_ARG_TYPES
     return argmap.get(name)
+
+
+# ----------------------------------------------------------
+# Per-version opcode tables
+
+# Converts (oparg, end offset of the instruction) to the value used to look up
+# the argval, e.g. a jump target or an index into co_names.
+ArgDecoder = Callable[[int, int], int]
+
+
+def _jrel(arg: int, end_pos: int) -> int:
+    return arg + end_pos
+
+
+def _jrel_forward(arg: int, end_pos: int) -> int:
+    return end_pos + arg * 2
+
+
+def _jrel_backward(arg: int, end_pos: int) -> int:
+    return end_pos - arg * 2
+
+
+def _jabs(arg: int, unused_end_pos: int) -> int:
+    return arg * 2
+
+
+def _shift1(arg: int, unused_end_pos: int) -> int:
+    return arg >> 1
+
+
+def _shift4(arg: int, unused_end_pos: int) -> int:
+    return arg >> 4
+
+
+class OpInfo(NamedTuple):
+    """Precomputed information about an opcode in a given python version."""
+
+    name: str
+    arg_type: Optional[int]
+    # None if the oparg is used as is.
+    decode_arg: Optional[ArgDecoder]
+
+
+OpTable = Tuple[Optional[OpInfo], ...]
+
+_OP_TABLES: Dict[Tuple[int, int], OpTable] = {}
+
+
+def _arg_decoder(
+    name: str, argtype: Optional[int], version: Tuple[int, int]
+) -> Optional[ArgDecoder]:
+    if version >= (3, 12):
+        if name == "COMPARE_OP":
+            return _shift4
+        if name == "LOAD_ATTR":
+            return _shift1
+    if version >= (3, 11):
+        if name == "LOAD_GLOBAL":
+            return _shift1
+    if version >= (3, 10):
+        if argtype == JREL:
+            if "JUMP_BACKWARD" in name:
+                return _jrel_backward
+            return _jrel_forward
+        elif argtype == JABS:
+            return _jabs
+    if argtype == JREL:
+        return _jrel
+    return None
+
+
+def get_op_table(version: Tuple[int, int]) -> OpTable:
+    """Get a table indexed by opcode, with None for unused opcodes.
+
+    Tables are built on first use and shared between callers.
+
+    Args:
+      version: The python version.
+
+    Returns:
+      A 256-entry tuple of OpInfo or None.
+    """
+    table = _OP_TABLES.get(version)
+    if table is None:
+        opmap = get_mapping(version)
+        entries = [None] * 256
+        for op, name in opmap.items():
+            argtype = arg_type(name, version)
+            decoder = _arg_decoder(name, argtype, version)
+            entries[op] = OpInfo(name, argtype, decoder)
+        table = _OP_TABLES[version] = tuple(entries)
+    return table
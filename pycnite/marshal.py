@@ -12,12 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A pure python version of marshal.loads."""
+"""A pure python version of marshal.loads and marshal.dumps."""
 
+import dataclasses
 import struct
 import sys
-from typing import Tuple
+from typing import AbstractSet, Dict, List, Optional, Tuple, Union
 
+from . import native
 from . import types
 
 
@@ -105,16 +107,214 @@ class Flags:
 
 NULL = object()  # sentinel marker
 
+_SHORT = struct.Struct("<h")
+_LONG = struct.Struct("<i")
+_LONG64 = struct.Struct("<q")
+_BINARY_FLOAT = struct.Struct("<d")
+_BINARY_COMPLEX = struct.Struct("<dd")
+# The fixed-size fields at the start of a code object: argcount,
+# posonlyargcount, kwonlyargcount, [nlocals,] stacksize, flags
+_CODE_HEADER_3_8 = struct.Struct("<6i")
+_CODE_HEADER_3_11 = struct.Struct("<5i")
+
+# The fields of code objects that are stored after the fixed-size header, in
+# order. co_firstlineno, which is always loaded, comes before the last one
+# (3.8 - 3.10) or two (3.11+) of them.
+_OBJECT_FIELDS_3_8 = (
+    "co_code",
+    "co_consts",
+    "co_names",
+    "co_varnames",
+    "co_freevars",
+    "co_cellvars",
+    "co_filename",
+    "co_name",
+    "co_lnotab",
+)
+_OBJECT_FIELDS_3_11 = (
+    "co_code",
+    "co_consts",
+    "co_names",
+    "co_localsplusnames",
+    "co_localspluskinds",
+    "co_filename",
+    "co_name",
+    "co_qualname",
+    "co_linetable",
+    "co_exceptiontable",
+)
+
+# The values of the fields above when they are skipped, see loads(fields=...).
+_SKIPPED_FIELD_VALUES = {
+    "co_code": b"",
+    "co_consts": (),
+    "co_names": (),
+    "co_varnames": (),
+    "co_freevars": (),
+    "co_cellvars": (),
+    "co_localsplusnames": (),
+    "co_localspluskinds": b"",
+    "co_filename": "",
+    "co_name": "",
+    "co_qualname": "",
+    "co_lnotab": b"",
+    "co_linetable": b"",
+    "co_exceptiontable": b"",
+}
+
+# The fields that are returned as views into the data in zero_copy mode.
+_BUFFER_FIELDS = frozenset(
+    ("co_code", "co_lnotab", "co_linetable", "co_exceptiontable")
+)
+
+# The attributes of code objects, which can be passed as loads(fields=...).
+_CODE_FIELDS = frozenset(
+    f.name
+    for cls in (types.CodeType38, types.CodeType311)
+    for f in dataclasses.fields(cls)
+)
+
+
+class _LazyObject:
+    """Placeholder for an object that has been skipped over but not decoded.
+
+    Used in lazy mode, both for nested code objects in co_consts and for
+    entries in the reference table that were defined inside a skipped object.
+    """
+
+    __slots__ = ("reader", "start", "ref_start", "value")
+
+    def __init__(self, reader: "MarshalReader", start: int, ref_start: int):
+        self.reader = reader
+        # Position of the encoded object
+        self.start = start
+        # Index of the first reference table slot reserved inside the object
+        self.ref_start = ref_start
+        self.value = None
+
+    def resolve(self):
+        if self.reader is not None:
+            self.value = self.reader.load_at(self.start, self.ref_start)
+            self.reader = None
+        return self.value
+
+    def __repr__(self):
+        if self.reader is None:
+            return repr(self.value)
+        return f"<lazy object at {self.start}>"
+
+
+def _resolve(obj):
+    return obj.resolve() if isinstance(obj, _LazyObject) else obj
+
+
+class LazyConsts(tuple):
+    """A co_consts tuple whose nested code objects are decoded on access."""
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(_resolve(x) for x in super().__getitem__(i))
+        return _resolve(super().__getitem__(i))
+
+    def __iter__(self):
+        for x in super().__iter__():
+            yield _resolve(x)
+
+    def __contains__(self, value):
+        return value in tuple(self)
+
+    def index(self, value, start=0, stop=sys.maxsize):
+        return tuple(self).index(value, start, stop)
+
+    def count(self, value):
+        return tuple(self).count(value)
+
+    def __add__(self, other):
+        return tuple(self) + other
+
+    def __radd__(self, other):
+        return other + tuple(self)
+
+    def __mul__(self, n):
+        return tuple(self) * n
+
+    __rmul__ = __mul__
+
+    def __reduce__(self):
+        # Pickle as a plain tuple, rather than pickling the reader through the
+        # placeholders.
+        return (tuple, (tuple(self),))
+
+    def __eq__(self, other):
+        return tuple(self) == other
+
+    def __ne__(self, other):
+        return tuple(self) != other
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+
+class Trace:
+    """The encoding of marshalled data, recorded while loading it.
+
+    Marshalled data cannot in general be reproduced from the loaded objects:
+    which objects were added to the reference table depends on reference
+    counts in the process that wrote the data, and the order of set elements
+    on its string hashes. Passing the trace of some data to MarshalWriter
+    reproduces it byte for byte, as long as the loaded objects are unchanged.
+    """
+
+    __slots__ = ("codes", "refs", "sets", "raw_strings")
+
+    def __init__(self):
+        # The type code, including Flags.REF, of every object in the data.
+        self.codes = bytearray()
+        # The arguments of Type.REF and Type.STRINGREF objects.
+        self.refs: List[int] = []
+        # The elements of sets and frozensets, in the order they were stored.
+        self.sets: List[list] = []
+        # The encoded form of strings that are not valid utf8 (which are
+        # loaded with escapes), by their index in codes.
+        self.raw_strings: Dict[int, bytes] = {}
+
 
 class MarshalReader:
     """Stateful loader for marshalled files."""
 
-    def __init__(self, data: bytes, python_version: Tuple[int, int]):
+    def __init__(
+        self,
+        data: Union[bytes, memoryview],
+        python_version: Tuple[int, int],
+        *,
+        zero_copy: bool = False,
+        lazy: bool = False,
+        fingerprints: bool = False,
+        fields: Optional[AbstractSet[str]] = None,
+    ):
         self.bufstr = data
         self.bufpos = 0
         self.python_version = python_version
+        # If zero_copy is set and data is a memoryview, the bytes fields of
+        # code objects (co_code, line and exception tables) are returned as
+        # views into data rather than being copied.
+        self.zero_copy = zero_copy
+        # If lazy is set, code objects in co_consts are skipped over and only
+        # decoded when they are first accessed.
+        self.lazy = lazy
+        # If fingerprints is set, code objects are fingerprinted as they are
+        # loaded (see types.CodeTypeBase.fingerprint). Ignored in lazy mode.
+        self.fingerprints = fingerprints
+        # If fields is set, the fields of code objects that are not in it
+        # are skipped over and set to an empty value. Objects inside them that
+        # are in the reference table are only decoded if they are referred to.
+        self.fields = fields
         self.refs = []
         self._stringtable = []
+        self._buffer_field = False
+        # When decoding a previously skipped object, the reference table slots
+        # it uses have already been reserved; this is the next one to fill.
+        self._next_ref = None
 
     def eof(self):
         """Return True if we reached the end of the stream."""
@@ -131,16 +331,225 @@ class MarshalReader:
                 # determine the index position *before* reading the contents of
                 # this element.
                 idx = self._reserve_ref()
-                result = MarshalReader._DISPATCH[c & ~Flags.REF](self)
-                self.refs[idx] = result
+                result = self._DISPATCH[c & ~Flags.REF](self)
+                result = self._set_ref(idx, result)
             else:
-                result = MarshalReader._DISPATCH[c](self)
+                result = self._DISPATCH[c](self)
             return result
         except KeyError as e:
             raise ValueError(f"bad marshal code: {chr(c)!r} ({c:02x})") from e
         except IndexError as e:
             raise EOFError() from e
 
+    def load_at(self, pos: int, ref_start: int):
+        """Load a previously skipped object.
+
+        Args:
+          pos: The position of the object in the buffer.
+          ref_start: The first reference table slot reserved by the object.
+
+        Returns:
+          The decoded object.
+        """
+        saved = self.bufpos, self._next_ref, self._buffer_field
+        self.bufpos, self._next_ref, self._buffer_field = pos, ref_start, False
+        try:
+            return self.load()
+        finally:
+            self.bufpos, self._next_ref, self._buffer_field = saved
+
+    def load_iterative(self):
+        """Load an encoded Python data structure without recursion.
+
+        This gives the same result as load(), but keeps its own stack of
+        partially decoded containers and code objects rather than recursing,
+        so deeply nested data cannot hit the recursion limit, and each element
+        costs fewer python calls. It ignores lazy mode, and cannot be used to
+        decode skipped objects (see load_at).
+
+        Returns:
+          The decoded object.
+        """
+        leaves = MarshalReader._DISPATCH
+        bufstr = self.bufstr
+        refs = self.refs
+        zero_copy = self.zero_copy
+        if self.python_version < (3, 11):
+            code_header = _CODE_HEADER_3_8
+            object_fields = _OBJECT_FIELDS_3_8
+        else:
+            code_header = _CODE_HEADER_3_11
+            object_fields = _OBJECT_FIELDS_3_11
+        # The number of code object fields, including firstlineno.
+        n_code_fields = len(object_fields) + 1
+        # The values of the runs of consecutive code object fields to skip,
+        # see self.fields, by the index of their first field in the fields
+        # passed to _make_code. Runs end at firstlineno.
+        skipped = {}
+        if self.fields is not None:
+            run = None
+            for i, name in enumerate(object_fields):
+                if name in self.fields or i == 8:
+                    run = None
+                if name not in self.fields:
+                    if run is None:
+                        run = skipped[i if i < 8 else i + 1] = []
+                    run.append(_SKIPPED_FIELD_VALUES[name])
+        # The innermost partially decoded object: its type, reference table
+        # index, number of elements and elements so far; for code objects,
+        # elements are fields, header is the fixed-size header and
+        # cur_skipped is skipped.
+        cur_type = cur_idx = cur_n = cur_items = header = None
+        cur_skipped = {}
+        # The enclosing partially decoded objects.
+        stack = []
+        c = ord("?")  # make pylint happy
+        try:
+            while True:
+                if zero_copy:
+                    # co_code and the fields after firstlineno are buffers.
+                    self._buffer_field = (
+                        cur_type == Type.CODE and len(cur_items) in (0, 9, 10)
+                    )
+                pos = self.bufpos
+                c = bufstr[pos]
+                self.bufpos = pos + 1
+                t = c & ~Flags.REF
+                if c & Flags.REF:
+                    # Inlined _reserve_ref(), see load()
+                    idx = len(refs)
+                    refs.append(None)
+                else:
+                    idx = None
+                if cur_skipped and len(cur_items) in cur_skipped:
+                    values = cur_skipped[len(cur_items)]
+                    if idx is not None:
+                        # _skip_fields() fills in the slots of the fields.
+                        refs.pop()
+                        idx = None
+                    self.bufpos = pos
+                    self._skip_fields(len(values))
+                    cur_items.extend(values[:-1])
+                    value = values[-1]
+                # The most common leaves are decoded inline.
+                elif t in (Type.SHORT_ASCII_INTERNED, Type.SHORT_ASCII):
+                    end = pos + 2 + bufstr[pos + 1]
+                    if end > len(bufstr):
+                        raise EOFError()
+                    value = str(bufstr[pos + 2 : end], "ascii")
+                    self.bufpos = end
+                elif t == Type.REF and not zero_copy:
+                    value = refs[self._read_long()]
+                    if skipped and isinstance(value, _LazyObject):
+                        value = value.resolve()
+                elif t == Type.STRING and not zero_copy:
+                    value = bytes(self._read_sized())
+                elif t in _CONTAINER_TYPES:
+                    if t == Type.SMALL_TUPLE:
+                        n = self._read_byte()
+                    elif t == Type.DICT:
+                        n = -1
+                    elif t == Type.CODE:
+                        n = 8
+                    else:
+                        n = self._read_long()
+                    if n:
+                        stack.append(
+                            (
+                                cur_type,
+                                cur_idx,
+                                cur_n,
+                                cur_items,
+                                header,
+                                cur_skipped,
+                            )
+                        )
+                        cur_type, cur_idx, cur_n, cur_items = t, idx, n, []
+                        if t == Type.CODE:
+                            header = self._unpack(code_header)
+                            cur_skipped = skipped
+                        else:
+                            cur_skipped = None
+                        continue
+                    value = _CONTAINERS[t]()
+                else:
+                    value = leaves[t](self)
+                if idx is not None:
+                    refs[idx] = value
+                # Add the value to the innermost object, and finish any
+                # objects that are now complete.
+                while True:
+                    if cur_items is None:
+                        return value
+                    if cur_type == Type.DICT:
+                        if value is not NULL or len(cur_items) % 2:
+                            cur_items.append(value)
+                            break
+                        value = dict(zip(cur_items[::2], cur_items[1::2]))
+                    else:
+                        cur_items.append(value)
+                        if len(cur_items) < cur_n:
+                            break
+                        if cur_type == Type.CODE:
+                            if cur_n == 8:
+                                cur_items.append(self._read_long())
+                                cur_n = n_code_fields
+                                break
+                            value = self._make_code(header, cur_items)
+                        elif cur_type == Type.LIST:
+                            value = cur_items
+                        else:
+                            value = _CONTAINERS[cur_type](cur_items)
+                    if cur_idx is not None:
+                        refs[cur_idx] = value
+                    (
+                        cur_type,
+                        cur_idx,
+                        cur_n,
+                        cur_items,
+                        header,
+                        cur_skipped,
+                    ) = stack.pop()
+        except KeyError as e:
+            raise ValueError(f"bad marshal code: {chr(c)!r} ({c:02x})") from e
+        except IndexError as e:
+            raise EOFError() from e
+        finally:
+            self._buffer_field = False
+
+    def skip(self, n: int = 1):
+        """Skip over encoded Python data structures without decoding them.
+
+        Reference table slots defined inside the skipped data are filled with
+        placeholders that decode the referenced object on demand.
+
+        Args:
+          n: The number of consecutive objects to skip.
+        """
+        if self._next_ref is None:
+            ref_start = len(self.refs)
+        else:
+            ref_start = self._next_ref
+        self.bufpos, _, _, positions = _walk(
+            self.bufstr,
+            self.bufpos,
+            self.python_version,
+            n_refs=ref_start,
+            n_strings=len(self._stringtable),
+            count=n,
+        )
+        if self._next_ref is None:
+            self.refs.extend(
+                [
+                    _LazyObject(self, pos, idx)
+                    for idx, pos in enumerate(positions, ref_start)
+                ]
+            )
+        else:
+            # The slots already hold placeholders from when the enclosing
+            # object was skipped.
+            self._next_ref += len(positions)
+
     def _read(self, n):
         """Read n bytes as a string."""
         pos = self.bufpos
@@ -155,50 +564,125 @@ class MarshalReader:
         self.bufpos += 1
         return self.bufstr[pos]
 
+    def _unpack(self, fmt: struct.Struct):
+        """Read a fixed size record."""
+        pos = self.bufpos
+        self.bufpos += fmt.size
+        try:
+            return fmt.unpack_from(self.bufstr, pos)
+        except struct.error as e:
+            raise EOFError() from e
+
     def _read_short(self):
         """Read a signed 16 bit word."""
-        lo = self._read_byte()
-        hi = self._read_byte()
-        x = lo | (hi << 8)
-        if x & 0x8000:
-            # sign extension
-            x -= 0x10000
-        return x
+        return self._unpack(_SHORT)[0]
 
     def _read_long(self):
         """Read a signed 32 bit word."""
-        b = self._read(4)
-        x = b[0] | b[1] << 8 | b[2] << 16 | b[3] << 24
-        if b[3] & 0x80 and x > 0:
-            # sign extension
-            x = -((1 << 32) - x)
-            return int(x)
-        else:
-            return x
+        # Inlined version of self._unpack(_LONG)[0], since this is very hot.
+        pos = self.bufpos
+        self.bufpos = pos + 4
+        try:
+            return _LONG.unpack_from(self.bufstr, pos)[0]
+        except struct.error as e:
+            raise EOFError() from e
 
     def _read_long64(self):
         """Read a signed 64 bit integer."""
-        b = self._read(8)
-        x = (
-            b[0]
-            | b[1] << 8
-            | b[2] << 16
-            | b[3] << 24
-            | b[4] << 32
-            | b[5] << 40
-            | b[6] << 48
-            | b[7] << 56
-        )
-        if b[7] & 0x80 and x > 0:
-            # sign extension
-            x = -((1 << 64) - x)
-        return x
+        return self._unpack(_LONG64)[0]
 
     def _read_sized(self):
         """Read a size and a variable number of bytes."""
         n = self._read_long()
         return self._read(n)
 
+    def _load_field(self, name: str):
+        """Load a field of a code object that is stored as an object.
+
+        Args:
+          name: The name of the field, e.g. "co_code".
+
+        Returns:
+          The loaded field.
+        """
+        if self.fields is not None and name not in self.fields:
+            self._skip_fields(1)
+            return _SKIPPED_FIELD_VALUES[name]
+        elif name == "co_consts":
+            return self._load_consts()
+        elif name not in _BUFFER_FIELDS:
+            return self.load()
+        # In zero_copy mode the field is returned as a view into the
+        # underlying buffer; callers that need a real bytes object can call
+        # bytes() on it.
+        self._buffer_field = self.zero_copy
+        try:
+            return self.load()
+        finally:
+            self._buffer_field = False
+
+    def _skip_fields(self, n: int):
+        """Skip over consecutive fields of a code object not in self.fields.
+
+        The fields are set to an empty value even if they are references to
+        objects that have been loaded, so that the result does not depend on
+        which objects the writer shared. Strings, references and small tuples
+        of them, which make up most fields, are skipped inline as in _walk(),
+        and anything else with skip().
+
+        Args:
+          n: The number of fields.
+        """
+        if self._next_ref is not None:
+            # The reference table slots already hold placeholders.
+            self.skip(n)
+            return
+        bufstr = self.bufstr
+        refs = self.refs
+        kinds = _SCAN_KINDS
+        pos = self.bufpos
+        for _ in range(n):
+            start = pos
+            n_refs = len(refs)
+            c = bufstr[pos]
+            if kinds[c] == _SCAN_SMALL_TUPLE:
+                if c & Flags.REF:
+                    refs.append(_LazyObject(self, pos, n_refs))
+                n_items = bufstr[pos + 1]
+                pos += 2
+            else:
+                n_items = 1
+            while n_items:
+                c = bufstr[pos]
+                kind = kinds[c]
+                if kind == _SCAN_SHORT_SIZED:
+                    end = pos + 2 + bufstr[pos + 1]
+                    if c & Flags.REF:
+                        # Cheaper than a placeholder.
+                        refs.append(str(bufstr[pos + 2 : end], "ascii"))
+                elif kind == _SCAN_REF:
+                    end = pos + 5
+                elif kind == _SCAN_SIZED:
+                    self.bufpos = pos + 1
+                    size = self._read_long()
+                    if size < 0:
+                        raise ValueError(f"bad marshal data (size {size})")
+                    end = pos + 5 + size
+                    if c & Flags.REF:
+                        refs.append(_LazyObject(self, pos, len(refs)))
+                else:
+                    break
+                pos = end
+                n_items -= 1
+            if n_items:
+                del refs[n_refs:]
+                self.bufpos = start
+                self.skip()
+                pos = self.bufpos
+        if pos > len(bufstr):
+            raise EOFError()
+        self.bufpos = pos
+
     def _reserve_ref(self):
         """Reserve one entry in the reference table.
 
@@ -209,10 +693,66 @@ class MarshalReader:
           Reserved index position in the reference table.
         """
         # See r_ref_reserve in Python-3.4/Python/marshal.c
+        if self._next_ref is not None:
+            idx = self._next_ref
+            self._next_ref += 1
+            return idx
         idx = len(self.refs)
         self.refs.append(None)
         return idx
 
+    def _set_ref(self, idx, value):
+        """Fill in a reserved reference table slot."""
+        if self._next_ref is not None:
+            # We are decoding a skipped object; if this slot has already been
+            # decoded, keep the existing object so identities are preserved.
+            existing = self.refs[idx]
+            if not isinstance(existing, _LazyObject):
+                return existing
+            existing.value = value
+            existing.reader = None
+        self.refs[idx] = value
+        return value
+
+    def _peek_type(self):
+        """Return the type code of the next object, without the ref flag."""
+        return self.bufstr[self.bufpos] & ~Flags.REF
+
+    def _load_consts(self):
+        """Load co_consts, skipping over code objects in lazy mode."""
+        if not self.lazy or self._peek_type() not in (
+            Type.TUPLE,
+            Type.SMALL_TUPLE,
+        ):
+            return self.load()
+        c = self._read_byte()
+        idx = self._reserve_ref() if c & Flags.REF else None
+        if c & ~Flags.REF == Type.TUPLE:
+            n = self._read_long()
+        else:
+            n = self._read_byte()
+        consts = LazyConsts(self._load_const() for _ in range(n))
+        if idx is not None:
+            consts = self._set_ref(idx, consts)
+        return consts
+
+    def _load_const(self):
+        """Load a constant, deferring the decoding of code objects."""
+        if self._peek_type() != Type.CODE:
+            return self.load()
+        start = self.bufpos
+        flagged = self.bufstr[start] & Flags.REF
+        if self._next_ref is None:
+            ref_start = len(self.refs)
+        else:
+            ref_start = self._next_ref
+        self.skip()
+        if flagged:
+            # The code object's own reference table slot holds either a
+            # placeholder or, if it was already referenced, the decoded object.
+            return self.refs[ref_start]
+        return _LazyObject(self, start, ref_start)
+
     # pylint: disable=missing-docstring
     # This is a bunch of small methods with self-explanatory names.
 
@@ -243,20 +783,21 @@ class MarshalReader:
     def load_long(self):
         """Load a variable length integer."""
         size = self._read_long()
+        n = abs(size)
+        digits = self._read(2 * n)
         x = 0
-        for i in range(abs(size)):
-            d = self._read_short()
+        # Digits are 15 bits each, least significant first.
+        for i, d in enumerate(struct.unpack(f"<{n}h", digits)):
             x |= d << (i * 15)
         return x if size >= 0 else -x
 
     def load_float(self):
         n = self._read_byte()
         s = self._read(n)
-        return float(s)
+        return float(bytes(s))
 
     def load_binary_float(self):
-        binary = self._read(8)
-        return struct.unpack("<d", binary)[0]
+        return self._unpack(_BINARY_FLOAT)[0]
 
     def load_complex(self):
         real = self.load_float()
@@ -264,16 +805,19 @@ class MarshalReader:
         return complex(real, imag)
 
     def load_binary_complex(self):
-        binary = self._read(16)
-        return complex(*struct.unpack("dd", binary))
+        return complex(*self._unpack(_BINARY_COMPLEX))
 
     def load_string(self):
         s = self._read_sized()
+        if self._buffer_field and s:
+            # Only hand out views for non-empty fields, since the empty bytes
+            # object is frequently shared with constants via the ref table.
+            return s
         return bytes(s)
 
     def load_interned(self):
         s = self._read_sized()
-        ret = sys.intern(s.decode("utf-8", "strict"))
+        ret = sys.intern(str(s, "utf-8", "strict"))
         self._stringtable.append(ret)
         return ret
 
@@ -286,16 +830,16 @@ class MarshalReader:
         # We use the 'backslashreplace' error mode in order to handle non-utf8
         # backslash-escaped string literals correctly.
         s = self._read_sized()
-        return s.decode("utf8", "backslashreplace")
+        return str(s, "utf8", "backslashreplace")
 
     def load_ascii(self):
         s = self._read_sized()
-        return s.decode("ascii")
+        return str(s, "ascii")
 
     def load_short_ascii(self):
         n = self._read_byte()
         s = self._read(n)
-        return s.decode("ascii")
+        return str(s, "ascii")
 
     def load_list(self):
         n = self._read_long()
@@ -327,7 +871,16 @@ class MarshalReader:
 
     def load_ref(self):
         n = self._read_long()
-        return self.refs[n]
+        ret = self.refs[n]
+        if (self.lazy or self.fields is not None) and isinstance(
+            ret, _LazyObject
+        ):
+            ret = ret.resolve()
+        if self.zero_copy and not self._buffer_field:
+            if isinstance(ret, memoryview):
+                # Don't leak a view of a code field into e.g. co_consts.
+                return bytes(ret)
+        return ret
 
     def load_code(self):
         if self.python_version < (3, 11):
@@ -337,25 +890,66 @@ class MarshalReader:
 
     def load_code_3_8(self):
         """Load a Python code object."""
-        argcount = self._read_long()
-        posonlyargcount = self._read_long()
-        kwonlyargcount = self._read_long()
-        nlocals = self._read_long()
-        stacksize = self._read_long()
-        flags = self._read_long()
-        code = self.load()
-        consts = self.load()
-        names = self.load()
-        varnames = self.load()
-        freevars = self.load()
-        cellvars = self.load()
-        filename = self.load()
-        name = self.load()
-        firstlineno = self._read_long()
+        header = self._unpack(_CODE_HEADER_3_8)
+        fields = [self._load_field(name) for name in _OBJECT_FIELDS_3_8[:8]]
+        fields.append(self._read_long())  # firstlineno
+        fields.append(self._load_field("co_lnotab"))
+        return self._make_code(header, fields)
+
+    def load_code_3_11(self):
+        """Load a Python code object."""
+        header = self._unpack(_CODE_HEADER_3_11)
+        fields = [self._load_field(name) for name in _OBJECT_FIELDS_3_11[:8]]
+        fields.append(self._read_long())  # firstlineno
+        fields.append(self._load_field("co_linetable"))
+        fields.append(self._load_field("co_exceptiontable"))
+        return self._make_code(header, fields)
+
+    def _make_code(self, header: Tuple[int, ...], fields: List):
+        """Create a code object.
+
+        Args:
+          header: The fixed-size fields at the start of the code object.
+          fields: The remaining fields, in the order they are stored.
+
+        Returns:
+          The code object.
+        """
+        if self.python_version < (3, 11):
+            code = self._make_code_3_8(header, fields)
+        else:
+            code = self._make_code_3_11(header, fields)
+        if self.fingerprints and not self.lazy:
+            # Nested code objects have already been fingerprinted, so this
+            # only hashes the fields of this code object.
+            code.fingerprint()
+        return code
+
+    def _make_code_3_8(self, header, fields):
+        """Create a python 3.8 - 3.10 code object."""
+        (
+            argcount,
+            posonlyargcount,
+            kwonlyargcount,
+            nlocals,
+            stacksize,
+            flags,
+        ) = header
         # lnotab, from
         # https://github.com/python/cpython/blob/master/Objects/lnotab_notes.txt:
         # 'an array of unsigned bytes disguised as a Python bytes object'.
-        lnotab = self.load()
+        (
+            code,
+            consts,
+            names,
+            varnames,
+            freevars,
+            cellvars,
+            filename,
+            name,
+            firstlineno,
+            lnotab,
+        ) = fields
         return types.CodeType38(
             co_argcount=argcount,
             co_posonlyargcount=posonlyargcount,
@@ -376,25 +970,28 @@ class MarshalReader:
             python_version=self.python_version,
         )
 
-    def load_code_3_11(self):
-        """Load a Python code object."""
-        argcount = self._read_long()
-        posonlyargcount = self._read_long()
-        kwonlyargcount = self._read_long()
-        stacksize = self._read_long()
-        flags = self._read_long()
-        code = self.load()
-        consts = self.load()
-        names = self.load()
-        localsplusnames = self.load()
-        localspluskinds = self.load()
-        filename = self.load()
-        name = self.load()
-        qualname = self.load()
-        firstlineno = self._read_long()
-        linetable = self.load()
-        exceptiontable = self.load()
-
+    def _make_code_3_11(self, header, fields):
+        """Create a python 3.11+ code object."""
+        (
+            argcount,
+            posonlyargcount,
+            kwonlyargcount,
+            stacksize,
+            flags,
+        ) = header
+        (
+            code,
+            consts,
+            names,
+            localsplusnames,
+            localspluskinds,
+            filename,
+            name,
+            qualname,
+            firstlineno,
+            linetable,
+            exceptiontable,
+        ) = fields
         return types.CodeType311(
             co_argcount=argcount,
             co_posonlyargcount=posonlyargcount,
@@ -450,11 +1047,658 @@ class MarshalReader:
     }
 
 
-def loads(data: bytes, python_version: Tuple[int, int]):
-    um = MarshalReader(data, python_version)
-    result = um.load()
+class _TracingReader(MarshalReader):
+    """A MarshalReader that records the encoding of the data in a Trace."""
+
+    def __init__(self, data, python_version, trace: Trace, **kwargs):
+        super().__init__(data, python_version, **kwargs)
+        self.trace = trace
+
+    def load(self):
+        pos = self.bufpos
+        if pos < len(self.bufstr):
+            c = self.bufstr[pos]
+            self.trace.codes.append(c)
+            if c & ~Flags.REF in (Type.REF, Type.STRINGREF):
+                if pos + 5 <= len(self.bufstr):
+                    n = _LONG.unpack_from(self.bufstr, pos + 1)[0]
+                    self.trace.refs.append(n)
+        return super().load()
+
+    def _load_elements(self):
+        # Reserve the slot first, so that sets are recorded in the order they
+        # start in the data even if they are nested.
+        idx = len(self.trace.sets)
+        self.trace.sets.append([])
+        elts = self.load_list()
+        self.trace.sets[idx] = elts
+        return elts
+
+    def _load_set(self):
+        return set(self._load_elements())
+
+    def _load_frozenset(self):
+        return frozenset(self._load_elements())
+
+    def _load_unicode(self):
+        idx = len(self.trace.codes) - 1
+        start = self.bufpos + 4
+        ret = self.load_unicode()
+        raw = bytes(self.bufstr[start : self.bufpos])
+        try:
+            raw.decode("utf8")
+        except UnicodeDecodeError:
+            self.trace.raw_strings[idx] = raw
+        return ret
+
+    _DISPATCH = {
+        **MarshalReader._DISPATCH,
+        Type.SET: _load_set,
+        Type.FROZENSET: _load_frozenset,
+        Type.UNICODE: _load_unicode,
+    }
+
+
+class _IndexingReader(MarshalReader):
+    """A MarshalReader that records where objects and code objects are."""
+
+    def __init__(self, data, python_version):
+        super().__init__(data, python_version)
+        # (position, end slot, external slots) of the object in each reference
+        # table slot. The end slot is one past the last slot reserved inside
+        # the object, and the external slots are the ones it refers to that
+        # were filled before it started.
+        self.slots: Dict[int, Tuple[int, int, frozenset]] = {}
+        # (start, end, first slot, external slots) of each code object, by id.
+        self.code_objects: Dict[int, Tuple[int, int, int, frozenset]] = {}
+        # The slots referred to inside each object being loaded.
+        self._deps = [set()]
+
+    def load(self):
+        pos = self.bufpos
+        if pos >= len(self.bufstr):
+            return super().load()
+        c = self.bufstr[pos]
+        if c & ~Flags.REF == Type.REF:
+            ret = super().load()
+            self._deps[-1].add(_LONG.unpack_from(self.bufstr, pos + 1)[0])
+            return ret
+        if not c & Flags.REF and c != Type.CODE:
+            return super().load()
+        slot = len(self.refs)
+        self._deps.append(set())
+        try:
+            ret = super().load()
+        finally:
+            deps = self._deps.pop()
+        external = frozenset(d for d in deps if d < slot)
+        self._deps[-1].update(external)
+        if c & Flags.REF:
+            self.slots[slot] = (pos, len(self.refs), external)
+        if c & ~Flags.REF == Type.CODE:
+            self.code_objects[id(ret)] = (pos, self.bufpos, slot, external)
+        return ret
+
+    def needed_refs(self, slots) -> Dict[int, int]:
+        """Positions of the objects needed to decode references to slots.
+
+        Args:
+          slots: Reference table slots.
+
+        Returns:
+          A dict of slot: position, for the slots and, recursively, the slots
+          defined or referred to inside their objects.
+        """
+        ret = {}
+        stack = list(slots)
+        while stack:
+            slot = stack.pop()
+            if slot in ret:
+                continue
+            pos, end, external = self.slots[slot]
+            ret[slot] = pos
+            stack.extend(range(slot + 1, end))
+            stack.extend(external)
+        return ret
+
+
+class MarshalWriter:
+    """Marshals objects in the format read by a given python version.
+
+    Without a trace, the encoding follows cpython's marshal module: strings in
+    the name fields of code objects are interned, and objects
+    that occur more than once are stored once and referenced after that.
+    Unlike cpython, equal strings, bytes and tuples of strings are shared even
+    if they are different objects. The result loads to an equal object, but is
+    not necessarily identical to what cpython would write for it (see Trace).
+    """
+
+    def __init__(
+        self, python_version: Tuple[int, int], trace: Optional[Trace] = None
+    ):
+        self.python_version = python_version
+        # If set, type codes and references are taken from the trace rather
+        # than chosen by the writer.
+        self.trace = trace
+        self._out = bytearray()
+        self._code_pos = 0
+        self._ref_pos = 0
+        self._set_pos = 0
+        # Reference table, keyed by _ref_key().
+        self._refs = {}
+        # Keys of objects that occur more than once in the object being written.
+        self._shared = set()
+
+    def getvalue(self) -> bytes:
+        """The data written so far.
+
+        Raises:
+          ValueError: If part of the trace has not been used, i.e. the objects
+            written do not match it.
+        """
+        if self.trace is not None and self._code_pos != len(self.trace.codes):
+            raise ValueError("object does not match trace: too short")
+        return bytes(self._out)
+
+    def dump(self, obj):
+        """Write an object.
+
+        Args:
+          obj: The object to marshal.
+
+        Raises:
+          ValueError: If the object cannot be marshalled, or does not match
+            the trace.
+        """
+        if self.trace is None:
+            self._shared = _shared_keys(obj)
+        self._write(obj)
+
+    def _check(self, cond: bool):
+        if not cond:
+            raise ValueError(
+                f"object does not match trace at code {self._code_pos - 1}"
+            )
+
+    def _next_code(self) -> int:
+        try:
+            c = self.trace.codes[self._code_pos]
+        except IndexError as e:
+            raise ValueError("object does not match trace: too long") from e
+        self._code_pos += 1
+        return c
+
+    def _next_ref(self) -> int:
+        ret = self.trace.refs[self._ref_pos]
+        self._ref_pos += 1
+        return ret
+
+    def _type_code(self, obj, intern: bool) -> int:
+        """Choose the type code for obj, as cpython's marshal does."""
+        t = type(obj)
+        if obj is None:
+            return Type.NONE
+        elif obj is StopIteration:
+            return Type.STOPITER
+        elif obj is Ellipsis:
+            return Type.ELLIPSIS
+        elif t is bool:
+            return Type.TRUE if obj else Type.FALSE
+        elif isinstance(obj, int):
+            return Type.INT if -(2**31) <= obj < 2**31 else Type.LONG
+        elif isinstance(obj, float):
+            return Type.BINARY_FLOAT
+        elif isinstance(obj, complex):
+            return Type.BINARY_COMPLEX
+        elif isinstance(obj, str):
+            if not obj.isascii():
+                return Type.INTERNED if intern else Type.UNICODE
+            elif len(obj) < 256:
+                return Type.SHORT_ASCII_INTERNED if intern else Type.SHORT_ASCII
+            return Type.ASCII_INTERNED if intern else Type.ASCII
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            return Type.STRING
+        elif isinstance(obj, tuple):
+            return Type.SMALL_TUPLE if len(obj) < 256 else Type.TUPLE
+        elif isinstance(obj, list):
+            return Type.LIST
+        elif isinstance(obj, dict):
+            return Type.DICT
+        elif isinstance(obj, set):
+            return Type.SET
+        elif isinstance(obj, frozenset):
+            return Type.FROZENSET
+        elif isinstance(obj, types.CodeTypeBase):
+            return Type.CODE
+        raise ValueError(f"unmarshallable object: {t.__name__}")
+
+    def _write(self, obj, intern: bool = False):
+        """Write an object.
+
+        Args:
+          obj: The object to write.
+          intern: Whether to intern strings in obj. Ignored with a trace.
+        """
+        if self.trace is not None:
+            c = self._next_code()
+            if c & ~Flags.REF == Type.REF:
+                self._out.append(c)
+                self._out += _LONG.pack(self._next_ref())
+                return
+        else:
+            c = self._type_code(obj, intern)
+            if c in _SINGLETON_TYPES:
+                self._out.append(c)
+                return
+            key = _ref_key(obj)
+            if c in _INTERNED_TYPES or key in self._shared:
+                idx = self._refs.get(key)
+                if idx is not None:
+                    self._out.append(Type.REF)
+                    self._out += _LONG.pack(idx)
+                    return
+                self._refs[key] = len(self._refs)
+                c |= Flags.REF
+        self._out.append(c)
+        try:
+            write = MarshalWriter._WRITE[c & ~Flags.REF]
+        except KeyError as e:
+            raise ValueError(f"bad marshal code: {chr(c)!r} ({c:02x})") from e
+        write(self, obj, c & ~Flags.REF, intern)
+
+    def _write_long(self, n: int):
+        self._out += _LONG.pack(n)
+
+    def _write_sized(self, b: bytes):
+        self._write_long(len(b))
+        self._out += b
+
+    def _write_elements(self, elts, intern):
+        for x in elts:
+            self._write(x, intern)
+
+    # pylint: disable=missing-docstring
+    # The write methods below are called with the object, its type code
+    # (without Flags.REF) and the intern argument of _write(), and ignore the
+    # trailing arguments they do not need.
+
+    def write_singleton(self, obj, c, *_):
+        self._check(obj is _SINGLETONS[c])
+
+    def write_int(self, obj, c, *_):
+        self._check(isinstance(obj, int) and not isinstance(obj, bool))
+        try:
+            if c == Type.INT64:
+                self._out += _LONG64.pack(obj)
+            else:
+                self._write_long(obj)
+        except struct.error as e:
+            raise ValueError(f"int out of range: {obj}") from e
+
+    def write_long(self, obj, *_):
+        self._check(isinstance(obj, int) and not isinstance(obj, bool))
+        n = abs(obj)
+        digits = []
+        while n:
+            digits.append(n & 0x7FFF)
+            n >>= 15
+        self._write_long(-len(digits) if obj < 0 else len(digits))
+        self._out += struct.pack(f"<{len(digits)}h", *digits)
+
+    def _write_float_str(self, x: float):
+        s = repr(x).encode("ascii")
+        self._out.append(len(s))
+        self._out += s
+
+    def write_float(self, obj, c, *_):
+        self._check(isinstance(obj, float))
+        if c == Type.BINARY_FLOAT:
+            self._out += _BINARY_FLOAT.pack(obj)
+        else:
+            self._write_float_str(obj)
+
+    def write_complex(self, obj, c, *_):
+        self._check(isinstance(obj, complex))
+        if c == Type.BINARY_COMPLEX:
+            self._out += _BINARY_COMPLEX.pack(obj.real, obj.imag)
+        else:
+            self._write_float_str(obj.real)
+            self._write_float_str(obj.imag)
+
+    def write_string(self, obj, *_):
+        self._check(isinstance(obj, (bytes, bytearray, memoryview)))
+        self._write_sized(bytes(obj))
+
+    def write_unicode(self, obj, c, *_):
+        self._check(isinstance(obj, str))
+        if self.trace is not None and c == Type.UNICODE:
+            raw = self.trace.raw_strings.get(self._code_pos - 1)
+            if raw is not None:
+                self._check(obj == str(raw, "utf8", "backslashreplace"))
+                self._write_sized(raw)
+                return
+        self._write_sized(obj.encode("utf8", "surrogatepass"))
+
+    def write_ascii(self, obj, *_):
+        self._check(isinstance(obj, str) and obj.isascii())
+        self._write_sized(obj.encode("ascii"))
+
+    def write_short_ascii(self, obj, *_):
+        self._check(isinstance(obj, str) and obj.isascii() and len(obj) < 256)
+        self._out.append(len(obj))
+        self._out += obj.encode("ascii")
+
+    def write_stringref(self, obj, *_):
+        self._check(isinstance(obj, str))
+        self._write_long(self._next_ref())
+
+    def write_tuple(self, obj, c, intern):
+        self._check(isinstance(obj, tuple))
+        if c == Type.SMALL_TUPLE:
+            self._check(len(obj) < 256)
+            self._out.append(len(obj))
+        else:
+            self._write_long(len(obj))
+        self._write_elements(obj, intern)
+
+    def write_list(self, obj, *_):
+        self._check(isinstance(obj, list))
+        self._write_long(len(obj))
+        self._write_elements(obj, False)
+
+    def write_set(self, obj, c, intern):
+        cls = set if c == Type.SET else frozenset
+        self._check(isinstance(obj, cls))
+        if self.trace is not None:
+            elts = self.trace.sets[self._set_pos]
+            self._set_pos += 1
+            self._check(cls(elts) == obj)
+        else:
+            elts = obj
+        self._write_long(len(elts))
+        self._write_elements(elts, intern)
+
+    def write_dict(self, obj, *_):
+        self._check(isinstance(obj, dict))
+        for k, v in obj.items():
+            self._write(k)
+            self._write(v)
+        if self.trace is not None:
+            self._check(self._next_code() == Type.NULL)
+        self._out.append(Type.NULL)
+
+    def write_code(self, obj, *_):
+        if self.python_version < (3, 11):
+            self._check(isinstance(obj, types.CodeType38))
+            self._out += _CODE_HEADER_3_8.pack(
+                obj.co_argcount,
+                obj.co_posonlyargcount,
+                obj.co_kwonlyargcount,
+                obj.co_nlocals,
+                obj.co_stacksize,
+                obj.co_flags,
+            )
+            self._write(obj.co_code)
+            self._write(obj.co_consts)
+            self._write(obj.co_names, True)
+            self._write(obj.co_varnames, True)
+            self._write(obj.co_freevars, True)
+            self._write(obj.co_cellvars, True)
+            self._write(obj.co_filename)
+            self._write(obj.co_name, True)
+            self._write_long(obj.co_firstlineno)
+            self._write(obj.co_lnotab)
+        else:
+            self._check(isinstance(obj, types.CodeType311))
+            self._out += _CODE_HEADER_3_11.pack(
+                obj.co_argcount,
+                obj.co_posonlyargcount,
+                obj.co_kwonlyargcount,
+                obj.co_stacksize,
+                obj.co_flags,
+            )
+            self._write(obj.co_code)
+            self._write(obj.co_consts)
+            self._write(obj.co_names, True)
+            self._write(obj.co_localsplusnames, True)
+            self._write(obj.co_localspluskinds)
+            self._write(obj.co_filename)
+            self._write(obj.co_name, True)
+            self._write(obj.co_qualname, True)
+            self._write_long(obj.co_firstlineno)
+            self._write(obj.co_linetable)
+            self._write(obj.co_exceptiontable)
+
+    # pylint: enable=missing-docstring
+
+    _WRITE = {
+        Type.ASCII: write_ascii,
+        Type.ASCII_INTERNED: write_ascii,
+        Type.BINARY_COMPLEX: write_complex,
+        Type.BINARY_FLOAT: write_float,
+        Type.CODE: write_code,
+        Type.COMPLEX: write_complex,
+        Type.DICT: write_dict,
+        Type.ELLIPSIS: write_singleton,
+        Type.FALSE: write_singleton,
+        Type.FLOAT: write_float,
+        Type.FROZENSET: write_set,
+        Type.INT64: write_int,
+        Type.INT: write_int,
+        Type.INTERNED: write_unicode,
+        Type.LIST: write_list,
+        Type.LONG: write_long,
+        Type.NONE: write_singleton,
+        Type.SET: write_set,
+        Type.SHORT_ASCII: write_short_ascii,
+        Type.SHORT_ASCII_INTERNED: write_short_ascii,
+        Type.SMALL_TUPLE: write_tuple,
+        Type.STOPITER: write_singleton,
+        Type.STRING: write_string,
+        Type.STRINGREF: write_stringref,
+        Type.TRUE: write_singleton,
+        Type.TUPLE: write_tuple,
+        Type.UNICODE: write_unicode,
+    }
+
+
+_SINGLETONS = {
+    Type.NONE: None,
+    Type.TRUE: True,
+    Type.FALSE: False,
+    Type.STOPITER: StopIteration,
+    Type.ELLIPSIS: Ellipsis,
+}
+
+_SINGLETON_TYPES = frozenset(_SINGLETONS)
+
+_INTERNED_TYPES = frozenset(
+    (Type.INTERNED, Type.ASCII_INTERNED, Type.SHORT_ASCII_INTERNED)
+)
+
+
+def _children(obj) -> List:
+    """The objects that MarshalWriter writes as part of obj."""
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        return list(obj)
+    elif isinstance(obj, dict):
+        return [x for kv in obj.items() for x in kv]
+    elif isinstance(obj, types.CodeType38):
+        return [
+            obj.co_code,
+            obj.co_consts,
+            obj.co_names,
+            obj.co_varnames,
+            obj.co_freevars,
+            obj.co_cellvars,
+            obj.co_filename,
+            obj.co_name,
+            obj.co_lnotab,
+        ]
+    elif isinstance(obj, types.CodeType311):
+        return [
+            obj.co_code,
+            obj.co_consts,
+            obj.co_names,
+            obj.co_localsplusnames,
+            obj.co_localspluskinds,
+            obj.co_filename,
+            obj.co_name,
+            obj.co_qualname,
+            obj.co_linetable,
+            obj.co_exceptiontable,
+        ]
+    return []
+
+
+# Types that MarshalReader.load_iterative() decodes using its stack, and their
+# constructors (code objects are created by MarshalReader._make_code).
+_CONTAINERS = {
+    Type.TUPLE: tuple,
+    Type.SMALL_TUPLE: tuple,
+    Type.LIST: list,
+    Type.SET: set,
+    Type.FROZENSET: frozenset,
+    Type.DICT: dict,
+    Type.CODE: None,
+}
+
+_CONTAINER_TYPES = frozenset(_CONTAINERS)
+
+
+def _ref_key(obj):
+    """The key of obj in MarshalWriter's reference table."""
+    if isinstance(obj, str):
+        return (str, obj)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        return (bytes, bytes(obj))
+    elif isinstance(obj, tuple) and all(isinstance(x, str) for x in obj):
+        # Tuples of names, which are often repeated in code objects.
+        return (tuple, obj)
+    return id(obj)
+
+
+def _shared_keys(obj) -> set:
+    """The _ref_key() of the objects that occur more than once in obj."""
+    seen = set()
+    shared = set()
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        if (
+            x is None
+            or isinstance(x, bool)
+            or x is Ellipsis
+            or x is StopIteration
+        ):
+            continue
+        key = _ref_key(x)
+        if key in seen:
+            shared.add(key)
+            continue
+        seen.add(key)
+        stack.extend(_children(x))
+    return shared
+
+
+def loads(
+    data: Union[bytes, memoryview],
+    python_version: Tuple[int, int],
+    *,
+    zero_copy: bool = False,
+    lazy: bool = False,
+    native_fast_path: bool = False,
+    fingerprints: bool = False,
+    trace: Optional[Trace] = None,
+    fields: Optional[AbstractSet[str]] = None,
+):
+    """Load marshalled data.
+
+    With native_fast_path=True, data marshalled by the running python version
+    is loaded with the host's C marshal module and converted to pycnite
+    types, which is about twice as fast as the pure python reader. This is
+    opt-in: the host module is not hardened against malformed input, accepts
+    some data that the pure python reader rejects, and normalises co_code when
+    it builds code objects, so it only gives the same result for well-formed
+    data. If it fails, the data is loaded with the pure python reader.
+
+    Args:
+      data: The marshalled data.
+      python_version: The python version the data was marshalled with.
+      zero_copy: If True and data is a memoryview, return the bytes fields of
+        code objects as views into data instead of copying them.
+      lazy: If True, code objects nested in co_consts are only decoded when
+        first accessed. The returned tree keeps a reference to data until
+        then.
+      native_fast_path: Whether to use the host marshal module if possible.
+        It is not used in zero_copy or lazy mode.
+      fingerprints: If True, compute the fingerprints of all code objects
+        while loading. Ignored in lazy mode.
+      trace: If given, record the encoding of the data in it, so that
+        dumps() can reproduce the data exactly. Not supported in lazy mode.
+      fields: If given, the code object attributes that will be used, e.g.
+        {"co_names", "co_consts"}. Attributes that are not listed are skipped
+        over rather than decoded, and set to b"", () or "" depending on their
+        type; without co_consts, nested code objects are not loaded at all.
+        The integer attributes, such as co_flags and co_firstlineno, are
+        always loaded. Cannot be used with fingerprints or trace.
+
+    Returns:
+      The unmarshalled object.
+
+    Raises:
+      ValueError: If both trace and lazy are set, fields is used with
+        fingerprints or trace, or fields has unknown names.
+    """
+    if trace is not None and lazy:
+        raise ValueError("trace cannot be used in lazy mode")
+    if fields is not None:
+        if fingerprints or trace is not None:
+            raise ValueError("fields cannot be used with fingerprints or trace")
+        unknown = set(fields) - _CODE_FIELDS
+        if unknown:
+            raise ValueError(f"unknown code fields: {sorted(unknown)}")
+    if (
+        native_fast_path
+        and trace is None
+        and not zero_copy
+        and not lazy
+        and native.can_load(python_version)
+    ):
+        try:
+            result = native.loads(data, python_version, fields)
+        except Exception:  # pylint: disable=broad-except
+            # The host marshal module can fail in many ways on malformed
+            # data, e.g. with a SystemError; report the error, if any, from
+            # the pure python reader.
+            pass
+        else:
+            if fingerprints and isinstance(result, types.CodeTypeBase):
+                result.fingerprint()
+            return result
+    if trace is not None:
+        um = _TracingReader(
+            data,
+            python_version,
+            trace,
+            zero_copy=zero_copy,
+            fingerprints=fingerprints,
+        )
+    else:
+        um = MarshalReader(
+            data,
+            python_version,
+            zero_copy=zero_copy,
+            lazy=lazy,
+            fingerprints=fingerprints,
+            fields=fields,
+        )
+    if lazy or trace is not None:
+        result = um.load()
+    else:
+        result = um.load_iterative()
     if not um.eof():
-        leftover = um.bufstr[um.bufpos :]
+        leftover = bytes(um.bufstr[um.bufpos :])
         if len(leftover) > 80:
             raise BufferError(
                 f"trailing bytes in marshal data ({um.bufpos}...)"
@@ -464,3 +1708,457 @@ def loads(data: bytes, python_version: Tuple[int, int]):
                 f"trailing bytes in marshal data ({um.bufpos}...): {leftover}"
             )
     return result
+
+
+def dumps(
+    obj, python_version: Tuple[int, int], trace: Optional[Trace] = None
+) -> bytes:
+    """Marshal an object in the format read by python_version.
+
+    Args:
+      obj: The object to marshal, e.g. a types.CodeTypeBase tree.
+      python_version: The python version to marshal for.
+      trace: The Trace recorded while loading obj, to reproduce the original
+        data exactly.
+
+    Returns:
+      The marshalled data.
+
+    Raises:
+      ValueError: If the object cannot be marshalled, or does not match the
+        trace.
+    """
+    writer = MarshalWriter(python_version, trace)
+    writer.dump(obj)
+    return writer.getvalue()
+
+
+@dataclasses.dataclass
+class ScanResult:
+    """Summary of marshalled data, returned by scan()."""
+
+    # The number of encoded objects in the data, including references and
+    # the NULLs that end dicts.
+    n_objects: int
+    # The (start, end) byte offsets of each code object, in the order they
+    # start in the data.
+    code_extents: List[Tuple[int, int]]
+
+    @property
+    def n_code_objects(self) -> int:
+        return len(self.code_extents)
+
+
+def _scan_table(kinds) -> bytes:
+    """A table of scan() kinds indexed by type code, with or without REF."""
+    table = bytearray([_SCAN_BAD] * 256)
+    for kind, codes in kinds.items():
+        for c in codes:
+            table[c] = table[c | Flags.REF] = kind
+    return bytes(table)
+
+
+# How scan() reads each type of object.
+(
+    _SCAN_BAD,
+    _SCAN_EMPTY,
+    _SCAN_FIXED,
+    _SCAN_SIZED,
+    _SCAN_SHORT_SIZED,
+    _SCAN_INTERNED,
+    _SCAN_REF,
+    _SCAN_STRINGREF,
+    _SCAN_LONG,
+    _SCAN_COMPLEX,
+    _SCAN_NULL,
+    # Containers, which must come last.
+    _SCAN_SEQUENCE,
+    _SCAN_SMALL_TUPLE,
+    _SCAN_DICT,
+    _SCAN_CODE,
+) = range(15)
+
+_SCAN_KINDS = _scan_table(
+    {
+        _SCAN_EMPTY: (
+            Type.NONE,
+            Type.FALSE,
+            Type.TRUE,
+            Type.STOPITER,
+            Type.ELLIPSIS,
+        ),
+        _SCAN_FIXED: (
+            Type.INT,
+            Type.INT64,
+            Type.BINARY_FLOAT,
+            Type.BINARY_COMPLEX,
+        ),
+        _SCAN_SIZED: (
+            Type.STRING,
+            Type.UNICODE,
+            Type.ASCII,
+            Type.ASCII_INTERNED,
+        ),
+        _SCAN_SHORT_SIZED: (
+            Type.SHORT_ASCII,
+            Type.SHORT_ASCII_INTERNED,
+            Type.FLOAT,
+        ),
+        _SCAN_INTERNED: (Type.INTERNED,),
+        _SCAN_REF: (Type.REF,),
+        _SCAN_STRINGREF: (Type.STRINGREF,),
+        _SCAN_LONG: (Type.LONG,),
+        _SCAN_COMPLEX: (Type.COMPLEX,),
+        _SCAN_SEQUENCE: (Type.TUPLE, Type.LIST, Type.SET, Type.FROZENSET),
+        _SCAN_SMALL_TUPLE: (Type.SMALL_TUPLE,),
+        _SCAN_DICT: (Type.DICT,),
+        _SCAN_CODE: (Type.CODE,),
+        _SCAN_NULL: (Type.NULL,),
+    }
+)
+
+# The sizes of the _SCAN_FIXED types, not counting the type code.
+_SCAN_SIZES = {
+    Type.INT: 4,
+    Type.INT64: 8,
+    Type.BINARY_FLOAT: 8,
+    Type.BINARY_COMPLEX: 16,
+}
+_SCAN_SIZES.update({c | Flags.REF: size for c, size in _SCAN_SIZES.items()})
+
+
+def scan(
+    data: Union[bytes, memoryview], python_version: Tuple[int, int]
+) -> ScanResult:
+    """Check that marshalled data is well-formed, without loading it.
+
+    This walks the data like MarshalReader, checking sizes, reference indices
+    and that there are no trailing bytes, but does not create any objects, so
+    it is faster than loads(). The contents of strings and numbers are not
+    checked.
+
+    Args:
+      data: The marshalled data.
+      python_version: The python version the data was marshalled with.
+
+    Returns:
+      A ScanResult.
+
+    Raises:
+      EOFError: If the data is truncated.
+      ValueError: If the data contains a bad type code or reference.
+      BufferError: If there is data after the marshalled object.
+    """
+    end, n_objects, code_extents, _ = _walk(data, 0, python_version)
+    if end < len(data):
+        raise BufferError(f"trailing bytes in marshal data ({end}...)")
+    return ScanResult(n_objects, code_extents)
+
+
+def _walk(
+    data: Union[bytes, memoryview],
+    pos: int,
+    python_version: Tuple[int, int],
+    *,
+    n_refs: int = 0,
+    n_strings: int = 0,
+    count: int = 1,
+) -> Tuple[int, int, List[Tuple[int, int]], List[int]]:
+    """Walk over marshalled objects without creating any objects.
+
+    This is the loop behind scan() and MarshalReader.skip().
+
+    Args:
+      data: The marshalled data.
+      pos: The position of the first object in data.
+      python_version: The python version the data was marshalled with.
+      n_refs: The number of reference table slots in use before pos, which
+        the objects may refer to.
+      n_strings: The number of interned strings before pos, which the objects
+        may refer to.
+      count: The number of consecutive objects to walk over.
+
+    Returns:
+      The position after the objects, the number of encoded objects in them,
+      the extents of their code objects (see ScanResult) and the positions of
+      the objects they add to the reference table, in slot order.
+
+    Raises:
+      EOFError: If the data is truncated.
+      ValueError: If the data contains a bad type code or reference.
+    """
+    if python_version < (3, 11):
+        code_header_size = _CODE_HEADER_3_8.size
+        # lnotab
+        n_fields_after_lineno = 1
+    else:
+        code_header_size = _CODE_HEADER_3_11.size
+        # linetable, exceptiontable
+        n_fields_after_lineno = 2
+    kinds = _SCAN_KINDS
+    unpack_long = _LONG.unpack_from
+    size = len(data)
+    n_objects = 0
+    code_extents = []
+    # The positions of the objects in the reference table slots from n_refs
+    # on. The slots of incomplete containers hold -1 - position, since
+    # references to them are invalid, as in cpython.
+    refs = []
+    # The innermost incomplete container, and the remaining number of
+    # elements in it. Dicts count down from -1, and code objects count their
+    # fields up to firstlineno, and then the fields after it. The data as a
+    # whole is treated as a container with count elements.
+    cur_kind = None
+    cur_n = count
+    # The containers' reference table slots and, for code objects, indices
+    # in code_extents.
+    cur_idx = cur_code = None
+    # The enclosing incomplete containers.
+    stack = []
+    c = ord("?")  # make pylint happy
+    try:
+        while True:
+            start = pos
+            c = data[pos]
+            pos += 1
+            n_objects += 1
+            kind = kinds[c]
+            # Positions are only checked against the size of the data at the
+            # end, or implicitly when reading beyond it.
+            if kind == _SCAN_REF:
+                n = unpack_long(data, pos)[0]
+                pos += 4
+                if not 0 <= n - n_refs < len(refs):
+                    if not 0 <= n < n_refs:
+                        raise ValueError(f"bad marshal data (invalid ref {n})")
+                elif refs[n - n_refs] < 0:
+                    raise ValueError(f"bad marshal data (invalid ref {n})")
+            elif kind == _SCAN_SHORT_SIZED:
+                pos += 1 + data[pos]
+            elif kind in (_SCAN_SIZED, _SCAN_INTERNED):
+                n = unpack_long(data, pos)[0]
+                if n < 0:
+                    raise ValueError(f"bad marshal data (size {n})")
+                pos += 4 + n
+                if kind == _SCAN_INTERNED:
+                    n_strings += 1
+            elif kind in (_SCAN_EMPTY, _SCAN_NULL):
+                pass
+            elif kind == _SCAN_FIXED:
+                pos += _SCAN_SIZES[c]
+            elif kind >= _SCAN_SEQUENCE:
+                # The reference table slot is reserved before the elements
+                # are read.
+                if c & Flags.REF:
+                    idx = len(refs)
+                    refs.append(-1 - start)
+                else:
+                    idx = None
+                if kind == _SCAN_SMALL_TUPLE:
+                    n = data[pos]
+                    pos += 1
+                elif kind == _SCAN_SEQUENCE:
+                    n = unpack_long(data, pos)[0]
+                    pos += 4
+                    if n < 0:
+                        raise ValueError(f"bad marshal data (size {n})")
+                elif kind == _SCAN_DICT:
+                    n = -1
+                else:
+                    code_extents.append((start, -1))
+                    pos += code_header_size
+                    # Fields up to firstlineno.
+                    n = 8
+                if kind != _SCAN_CODE:
+                    # Skip over leading strings and references, which make up
+                    # most of the elements of name and constant tuples,
+                    # without the bookkeeping below.
+                    while n > 0:
+                        c = data[pos]
+                        element = kinds[c]
+                        if element == _SCAN_SHORT_SIZED:
+                            end = pos + 2 + data[pos + 1]
+                        elif element == _SCAN_REF:
+                            ref = unpack_long(data, pos + 1)[0]
+                            if not 0 <= ref - n_refs < len(refs):
+                                valid = 0 <= ref < n_refs
+                            else:
+                                valid = refs[ref - n_refs] >= 0
+                            if not valid:
+                                raise ValueError(
+                                    f"bad marshal data (invalid ref {ref})"
+                                )
+                            end = pos + 5
+                        else:
+                            break
+                        if c & Flags.REF:
+                            refs.append(pos)
+                        pos = end
+                        n -= 1
+                        n_objects += 1
+                if n:
+                    stack.append((cur_kind, cur_n, cur_idx, cur_code))
+                    cur_kind, cur_n, cur_idx = kind, n, idx
+                    if kind == _SCAN_CODE:
+                        cur_code = len(code_extents) - 1
+                    continue
+            elif kind == _SCAN_STRINGREF:
+                n = unpack_long(data, pos)[0]
+                pos += 4
+                if not 0 <= n < n_strings:
+                    raise ValueError(f"bad marshal data (invalid ref {n})")
+            elif kind == _SCAN_LONG:
+                n = unpack_long(data, pos)[0]
+                pos += 4 + 2 * abs(n)
+            elif kind == _SCAN_COMPLEX:
+                pos += 1 + data[pos]
+                pos += 1 + data[pos]
+            else:
+                raise ValueError(f"bad marshal code: {chr(c)!r} ({c:02x})")
+            if kind < _SCAN_SEQUENCE:
+                if c & Flags.REF:
+                    refs.append(start)
+            elif idx is not None:
+                refs[idx] = start
+            # Count the object towards its container, and finish any
+            # containers that are now complete.
+            cur_n -= 1
+            if cur_n > 0:
+                continue
+            while True:
+                if cur_n < 0:
+                    # A dict; they end with a NULL in place of a key, and
+                    # cur_n is even after a key.
+                    if kind != _SCAN_NULL or cur_n % 2:
+                        break
+                elif cur_kind == _SCAN_CODE:
+                    code_start, code_end = code_extents[cur_code]
+                    if code_end == -1:
+                        # Skip firstlineno; -2 marks the fields after it.
+                        code_extents[cur_code] = (code_start, -2)
+                        pos += 4
+                        cur_n = n_fields_after_lineno
+                        break
+                    code_extents[cur_code] = (code_start, pos)
+                elif cur_kind is None:
+                    if pos > size:
+                        raise EOFError()
+                    return pos, n_objects, code_extents, refs
+                if cur_idx is not None:
+                    refs[cur_idx] = -1 - refs[cur_idx]
+                kind = cur_kind
+                cur_kind, cur_n, cur_idx, cur_code = stack.pop()
+                cur_n -= 1
+                if cur_n > 0:
+                    break
+    except (IndexError, struct.error) as e:
+        raise EOFError() from e
+
+
+@dataclasses.dataclass
+class CodeIndexEntry:
+    """The location of a code object in marshalled data.
+
+    Together with the data, an entry has everything needed to decode its code
+    object with load_code_at(), without decoding the rest of the data.
+    """
+
+    # The co_name values of the enclosing code objects and this one, starting
+    # below the top-level code object (which has path ()).
+    path: Tuple[str, ...]
+    firstlineno: int
+    # The byte extent of the code object.
+    start: int
+    end: int
+    # The first reference table slot reserved inside the code object.
+    ref_start: int
+    # The positions of the objects in the slots that the code object refers
+    # to, directly or through other referenced objects, by slot.
+    refs: Dict[int, int]
+
+    @property
+    def qualname(self) -> str:
+        """The dotted path, e.g. "C.method"."""
+        return ".".join(self.path)
+
+
+def code_index(
+    data: Union[bytes, memoryview], python_version: Tuple[int, int]
+) -> List[CodeIndexEntry]:
+    """Find all code objects in marshalled data.
+
+    This loads the data with the pure python reader, so it is slower than
+    loads(); the index is meant to be built once and saved.
+
+    Args:
+      data: The marshalled data.
+      python_version: The python version the data was marshalled with.
+
+    Returns:
+      A CodeIndexEntry for each code object, depth first in the order used by
+      bytecode.dis_all().
+    """
+    reader = _IndexingReader(data, python_version)
+    root = reader.load()
+    if not isinstance(root, types.CodeTypeBase):
+        return []
+    if not reader.eof():
+        raise BufferError(
+            f"trailing bytes in marshal data ({reader.bufpos}...)"
+        )
+    ret = []
+    stack = [((), root)]
+    while stack:
+        path, code = stack.pop()
+        start, end, ref_start, external = reader.code_objects[id(code)]
+        ret.append(
+            CodeIndexEntry(
+                path=path,
+                firstlineno=code.co_firstlineno,
+                start=start,
+                end=end,
+                ref_start=ref_start,
+                refs=reader.needed_refs(external),
+            )
+        )
+        children = [
+            c for c in code.co_consts if isinstance(c, types.CodeTypeBase)
+        ]
+        for child in reversed(children):
+            stack.append((path + (child.co_name,), child))
+    return ret
+
+
+def load_code_at(
+    data: Union[bytes, memoryview],
+    python_version: Tuple[int, int],
+    entry: CodeIndexEntry,
+) -> types.CodeTypeBase:
+    """Load one code object, given its entry in code_index(data).
+
+    Code objects nested in the returned one are decoded when first accessed,
+    as with loads(lazy=True).
+
+    Args:
+      data: The marshalled data.
+      python_version: The python version the data was marshalled with.
+      entry: The index entry of the code object.
+
+    Returns:
+      The code object.
+
+    Raises:
+      ValueError: If the entry does not match the data.
+    """
+    reader = MarshalReader(data, python_version, lazy=True)
+    reader.refs = [None] * entry.ref_start
+    for slot, pos in entry.refs.items():
+        reader.refs[slot] = _LazyObject(reader, pos, slot)
+    reader.bufpos = entry.start
+    try:
+        code = reader.load()
+    except (IndexError, EOFError) as e:
+        raise ValueError("code index entry does not match the data") from e
+    if reader.bufpos != entry.end or not isinstance(code, types.CodeTypeBase):
+        raise ValueError("code index entry does not match the data")
+    return code
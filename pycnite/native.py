@@ -0,0 +1,236 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fast path for loading data marshalled by the host python version."""
+
+import dataclasses
+import marshal
+import sys
+from types import CodeType as HostCodeType
+
+from typing import AbstractSet, Any, Dict, FrozenSet, List, Optional, Tuple
+
+from . import types
+
+# Target versions whose code objects we can convert exactly when they match
+# the host version. Python 3.12 marks the locals of inlined comprehensions
+# with a CO_FAST_HIDDEN kind that is not exposed on code objects, so we cannot
+# recover co_localspluskinds from a 3.12 code object.
+SUPPORTED_VERSIONS = ((3, 8), (3, 9), (3, 10), (3, 11))
+
+# Types of constants that never need converting.
+_PLAIN_TYPES = frozenset(
+    {type(None), bool, int, float, complex, bytes, type(Ellipsis)}
+)
+
+# The values that code fields not in loads(fields=...) are set to, by code
+# type and fields; see _project().
+_EMPTY_VALUES: Dict[Tuple[type, FrozenSet[str]], List[Tuple[str, Any]]] = {}
+
+# Cell kinds, see marshal.Flags
+_CO_FAST_LOCAL = 0x20
+_CO_FAST_CELL = 0x40
+_CO_FAST_FREE = 0x80
+
+
+def can_load(python_version: Tuple[int, int]) -> bool:
+    """Whether data for python_version can be loaded via the host marshal."""
+    host_version = sys.version_info[:2]
+    return python_version == host_version and host_version in SUPPORTED_VERSIONS
+
+
+def _convert_str(s: str) -> str:
+    # The pure python loader decodes string constants with backslashreplace,
+    # whereas the host keeps lone surrogates.
+    if s.isascii():
+        return s
+    try:
+        s.encode("utf-8")
+    except UnicodeEncodeError:
+        s = s.encode("utf-8", "surrogatepass")
+        return s.decode("utf-8", "backslashreplace")
+    return s
+
+
+def _convert(
+    obj,
+    python_version: Tuple[int, int],
+    fields: Optional[AbstractSet[str]] = None,
+):
+    """Convert host code objects contained in obj."""
+    t = type(obj)
+    if t is HostCodeType:
+        return from_code(obj, python_version, fields)
+    elif t is str:
+        return _convert_str(obj)
+    elif t is tuple or t is frozenset:
+        # Most tuples, e.g. co_consts and co_names, only contain values that
+        # are returned unchanged, so check for that first.
+        for x in obj:
+            tx = type(x)
+            if tx not in _PLAIN_TYPES and not (tx is str and x.isascii()):
+                break
+        else:
+            return obj
+        elts = [_convert(x, python_version, fields) for x in obj]
+        if all(x is y for x, y in zip(elts, obj)):
+            return obj
+        return t(elts)
+    return obj
+
+
+def _localsplus(code: HostCodeType):
+    """Reconstruct co_localsplusnames and co_localspluskinds."""
+    if not code.co_cellvars and not code.co_freevars:
+        return code.co_varnames, bytes([_CO_FAST_LOCAL]) * code.co_nlocals
+    names = list(code.co_varnames)
+    kinds = [_CO_FAST_LOCAL] * len(names)
+    for name in code.co_cellvars:
+        # Cell variables that are also arguments share the argument's slot.
+        if name in code.co_varnames:
+            kinds[code.co_varnames.index(name)] |= _CO_FAST_CELL
+        else:
+            names.append(name)
+            kinds.append(_CO_FAST_CELL)
+    names.extend(code.co_freevars)
+    kinds.extend([_CO_FAST_FREE] * len(code.co_freevars))
+    return tuple(names), bytes(kinds)
+
+
+def _project(code: types.CodeTypeBase, fields: FrozenSet[str]):
+    """Empty the fields of code that are not in fields (see marshal.loads)."""
+    key = (type(code), fields)
+    if key not in _EMPTY_VALUES:
+        # Integer fields are always loaded.
+        _EMPTY_VALUES[key] = [
+            (f.name, type(getattr(code, f.name))())
+            for f in dataclasses.fields(code)
+            if f.name.startswith("co_")
+            and f.name not in fields
+            and f.type is not int
+        ]
+    for name, value in _EMPTY_VALUES[key]:
+        setattr(code, name, value)
+
+
+def from_code(
+    code: HostCodeType,
+    python_version: Optional[Tuple[int, int]] = None,
+    fields: Optional[AbstractSet[str]] = None,
+) -> types.CodeTypeBase:
+    """Convert a host code object to a pycnite code object.
+
+    Args:
+      code: A code object created by the running interpreter.
+      python_version: The version to record in the result; defaults to the
+        host version.
+      fields: If given, fields that are not in it are set to an empty value
+        (see marshal.loads).
+
+    Returns:
+      An instance of types.CodeTypeBase, equal to the one the pure python
+      loader would produce from the marshalled code.
+    """
+    python_version = python_version or sys.version_info[:2]
+    if fields is not None and "co_consts" not in fields:
+        # Don't convert nested code objects that will be thrown away.
+        consts = ()
+    else:
+        consts = _convert(code.co_consts, python_version, fields)
+    if python_version >= (3, 11):
+        localsplusnames, localspluskinds = _localsplus(code)
+        ret = types.CodeType311(
+            co_argcount=code.co_argcount,
+            co_posonlyargcount=code.co_posonlyargcount,
+            co_kwonlyargcount=code.co_kwonlyargcount,
+            co_stacksize=code.co_stacksize,
+            co_flags=code.co_flags,
+            co_code=code.co_code,
+            co_consts=consts,
+            co_names=code.co_names,
+            co_localsplusnames=localsplusnames,
+            co_localspluskinds=localspluskinds,
+            co_filename=_convert_str(code.co_filename),
+            co_name=code.co_name,
+            co_qualname=code.co_qualname,
+            co_firstlineno=code.co_firstlineno,
+            co_linetable=code.co_linetable,
+            co_exceptiontable=code.co_exceptiontable,
+            python_version=python_version,
+        )
+    else:
+        if python_version == (3, 10):
+            # The 3.10 line table is stored in the co_lnotab slot of the pyc.
+            lnotab = code.co_linetable
+        else:
+            lnotab = code.co_lnotab
+        ret = types.CodeType38(
+            co_argcount=code.co_argcount,
+            co_posonlyargcount=code.co_posonlyargcount,
+            co_kwonlyargcount=code.co_kwonlyargcount,
+            co_nlocals=code.co_nlocals,
+            co_stacksize=code.co_stacksize,
+            co_flags=code.co_flags,
+            co_code=code.co_code,
+            co_consts=consts,
+            co_names=code.co_names,
+            co_varnames=code.co_varnames,
+            co_filename=_convert_str(code.co_filename),
+            co_name=code.co_name,
+            co_firstlineno=code.co_firstlineno,
+            co_lnotab=lnotab,
+            co_freevars=code.co_freevars,
+            co_cellvars=code.co_cellvars,
+            python_version=python_version,
+        )
+    if fields is not None:
+        _project(ret, frozenset(fields))
+    return ret
+
+
+def loads(
+    data: bytes,
+    python_version: Tuple[int, int],
+    fields: Optional[AbstractSet[str]] = None,
+):
+    """Load marshalled data with the host marshal module.
+
+    Args:
+      data: The marshalled data.
+      python_version: The python version the data was marshalled with; must
+        satisfy can_load().
+      fields: See from_code().
+
+    Returns:
+      The unmarshalled object, with code objects converted to pycnite types.
+
+    Raises:
+      ValueError, EOFError, TypeError or BufferError: If the data is
+      malformed; callers should fall back to the pure python loader to get
+      pycnite's error reporting.
+    """
+    obj = marshal.loads(data)
+    # The host marshal ignores trailing bytes; detect them by checking whether
+    # the data minus its last byte still contains a complete object. This
+    # parses the data twice, but host parsing is a small part of the cost of
+    # the fast path, and marshal.load() on an io.BytesIO, which reports where
+    # the object ends, is much slower than marshal.loads() since it reads
+    # through python method calls.
+    try:
+        marshal.loads(memoryview(data)[:-1])
+    except (EOFError, ValueError, TypeError):
+        pass
+    else:
+        raise BufferError("trailing bytes in marshal data")
+    return _convert(obj, python_version, fields)
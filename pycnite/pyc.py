@@ -14,19 +14,165 @@
 
 """Load and parse .pyc files."""
 
+import dataclasses
 import io
+import json
+import mmap as _mmap
+import os
+import re
+import struct
 
-from typing import IO, Union
+from typing import (
+    IO,
+    AbstractSet,
+    Any,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
+from . import batch
+from . import linetable
 from . import magic
+from . import mapping
 from . import marshal
+from . import types
 
+_HEADER = struct.Struct("<H2sI8s")
+_MTIME_AND_SIZE = struct.Struct("<II")
 
-def load(fi: IO[bytes]):
+# Files written to __pycache__ by python 3.x
+_CPYTHON_PYC = re.compile(r"\.cpython-3\d+\.pyc$")
+
+# PEP 552 flags
+_FLAG_HASH_BASED = 0x1
+_FLAG_CHECK_SOURCE = 0x2
+
+# Code index files are stored next to the pyc, with this suffix added.
+_INDEX_SUFFIX = ".index"
+_INDEX_FORMAT = 2
+
+
+def _parse_header(data: Union[bytes, memoryview]) -> types.PycHeader:
+    """Parse the first 16 bytes of a pyc file."""
+    if len(data) < _HEADER.size:
+        raise OSError("Malformed pyc file")
+    magic_number, crlf, flags, rest = _HEADER.unpack_from(data)
+    python_version = magic.magic_number_to_version(magic_number)
+    if crlf != b"\r\n" or flags & ~(_FLAG_HASH_BASED | _FLAG_CHECK_SOURCE):
+        raise OSError("Malformed pyc file")
+    if flags & _FLAG_HASH_BASED:
+        mtime = source_size = None
+        source_hash = rest
+    else:
+        mtime, source_size = _MTIME_AND_SIZE.unpack(rest)
+        source_hash = None
+    return types.PycHeader(
+        python_version=python_version,
+        magic_number=magic_number,
+        flags=flags,
+        mtime=mtime,
+        source_size=source_size,
+        source_hash=source_hash,
+    )
+
+
+def _header_bytes(header: types.PycHeader) -> bytes:
+    """Encode a pyc header."""
+    if header.hash_based:
+        rest = header.source_hash
+    else:
+        rest = _MTIME_AND_SIZE.pack(header.mtime, header.source_size)
+    return _HEADER.pack(header.magic_number, b"\r\n", header.flags, rest)
+
+
+def read_header(
+    path_or_stream: Union[str, "os.PathLike[str]", IO[bytes]]
+) -> types.PycHeader:
+    """Read the header of a pyc file without unmarshalling the code.
+
+    Exactly 16 bytes are read; when passed a stream, it is left positioned at
+    the start of the marshalled code.
+
+    Args:
+      path_or_stream: A file path or a file-like object.
+
+    Returns:
+      A types.PycHeader.
+
+    Raises:
+      IOError: If we can't read the file or the header is malformed.
+    """
+    if isinstance(path_or_stream, (str, os.PathLike)):
+        with open(path_or_stream, "rb", buffering=0) as f:
+            return _parse_header(f.read(_HEADER.size))
+    return _parse_header(path_or_stream.read(_HEADER.size))
+
+
+def find_pyc_files(root: str, cpython_only: bool = False) -> Iterator[str]:
+    """Recursively find all .pyc files under a directory.
+
+    Args:
+      root: The directory to search.
+      cpython_only: Only find files named like *.cpython-3XY.pyc.
+
+    Yields:
+      File paths.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif cpython_only:
+                    if _CPYTHON_PYC.search(entry.name):
+                        yield entry.path
+                elif entry.name.endswith(".pyc"):
+                    yield entry.path
+
+
+def read_headers(
+    root: str,
+) -> Iterator[Tuple[str, Union[types.PycHeader, Exception]]]:
+    """Read the headers of all .pyc files under a directory.
+
+    Args:
+      root: The directory to search.
+
+    Yields:
+      (path, header) tuples. If a file could not be read or has a malformed
+      header, the exception is yielded in place of the header.
+    """
+    for path in find_pyc_files(root):
+        try:
+            yield path, read_header(path)
+        except (OSError, KeyError) as e:
+            yield path, e
+
+
+def load(
+    fi: IO[bytes],
+    *,
+    lazy: bool = False,
+    native_fast_path: bool = False,
+    fingerprints: bool = False,
+    fields: Optional[AbstractSet[str]] = None,
+):
     """Parse pyc data from a stream.
 
     Args:
       fi: A file-like object.
+      lazy: Only decode nested code objects when they are first accessed.
+      native_fast_path: Try the host marshal module first if the pyc was
+        compiled by the running python version (see marshal.loads).
+      fingerprints: Fingerprint code objects while loading them.
+      fields: The code object attributes to load; unlisted ones are skipped
+        and left empty (see marshal.loads).
 
     Returns:
       An instance of types.CodeTypeBase.
@@ -34,32 +180,79 @@ def load(fi: IO[bytes]):
     Raises:
       IOError: If we can't read the file or the file is malformed.
     """
-    magic_number = fi.read(2)
-    python_version = magic.magic_number_to_version(magic_number)
-    crlf = fi.read(2)  # cr, lf
-    if crlf != b"\r\n":
-        raise OSError("Malformed pyc file")
-    fi.read(12)  # skip rest of header
-    return marshal.loads(fi.read(), python_version)
+    header = read_header(fi)
+    return marshal.loads(
+        fi.read(),
+        header.python_version,
+        lazy=lazy,
+        native_fast_path=native_fast_path,
+        fingerprints=fingerprints,
+        fields=fields,
+    )
 
 
-def loads(data: Union[bytes, str]):
+def loads(
+    data: Union[bytes, str],
+    *,
+    lazy: bool = False,
+    native_fast_path: bool = False,
+    fingerprints: bool = False,
+    fields: Optional[AbstractSet[str]] = None,
+):
     """Parse pyc data from a string.
 
     Args:
       data: pyc data
+      lazy: Only decode nested code objects when they are first accessed.
+      native_fast_path: Try the host marshal module first if the pyc was
+        compiled by the running python version (see marshal.loads).
+      fingerprints: Fingerprint code objects while loading them.
+      fields: See load().
 
     Returns:
       An instance of types.CodeTypeBase.
     """
-    return load(io.BytesIO(data))
+    return load(
+        io.BytesIO(data),
+        lazy=lazy,
+        native_fast_path=native_fast_path,
+        fingerprints=fingerprints,
+        fields=fields,
+    )
 
 
-def load_file(path: str):
+def load_file(
+    path: str,
+    *,
+    mmap: bool = False,
+    lazy: bool = False,
+    native_fast_path: bool = False,
+    fingerprints: bool = False,
+    fields: Optional[AbstractSet[str]] = None,
+):
     """Parse pyc data from a file.
 
+    If `mmap` is set, the file is memory-mapped rather than read, and the
+    bytes fields of the returned code objects (co_code, co_lnotab or
+    co_linetable, and co_exceptiontable) are memoryviews into the mapping.
+    The mapping stays alive as long as any of these views do; call bytes() on
+    a field to get a standalone copy.
+
+    If `lazy` is set, code objects in co_consts are skipped over when loading
+    and decoded when first accessed, so the cost of loading grows with the
+    parts of the file that are actually used.
+
     Args:
       path: A file path.
+      mmap: Whether to memory-map the file and avoid copying bytes fields.
+      lazy: Only decode nested code objects when they are first accessed.
+      native_fast_path: Try the host marshal module first if the pyc was
+        compiled by the running python version (see marshal.loads). Not used
+        with mmap or lazy.
+      fingerprints: Fingerprint code objects while loading them, rather than
+        when types.CodeTypeBase.fingerprint() is first called. Ignored with
+        lazy.
+      fields: See load().
 
     Returns:
       An instance of types.CodeTypeBase.
@@ -68,4 +261,390 @@ def load_file(path: str):
       IOError: If we can't read the file or the file is malformed.
     """
     with open(path, "rb") as f:
-        return load(f)
+        if not mmap:
+            return load(
+                f,
+                lazy=lazy,
+                native_fast_path=native_fast_path,
+                fingerprints=fingerprints,
+                fields=fields,
+            )
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            # Also, empty files cannot be mapped.
+            raise OSError("Malformed pyc file")
+        data = memoryview(_mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ))
+    header = _parse_header(data[: _HEADER.size])
+    return marshal.loads(
+        data[_HEADER.size :],
+        header.python_version,
+        zero_copy=True,
+        lazy=lazy,
+        fingerprints=fingerprints,
+        fields=fields,
+    )
+
+
+def load_tree(
+    root: str,
+    jobs: Optional[int] = None,
+    chunksize: int = 64,
+    stats: Optional[batch.BatchStats] = None,
+):
+    """Parse all *.cpython-3XY.pyc files under a directory in parallel.
+
+    Args:
+      root: The directory to search.
+      jobs: The number of worker processes; defaults to the number of CPUs.
+      chunksize: The number of files sent to a worker at once.
+      stats: If given, updated with throughput information as files are
+        loaded.
+
+    Returns:
+      An iterator over (path, code) tuples in completion order, where code is
+      an instance of types.CodeTypeBase, or the exception raised while loading
+      the file.
+    """
+    paths = find_pyc_files(root, cpython_only=True)
+    return batch.run(load_file, paths, jobs, chunksize, stats)
+
+
+def _executable_lines_file(path: str) -> FrozenSet[int]:
+    return linetable.executable_lines(load_file(path))
+
+
+def executable_lines_tree(
+    root: str,
+    jobs: Optional[int] = None,
+    chunksize: int = 64,
+    stats: Optional[batch.BatchStats] = None,
+):
+    """Get the executable lines of all *.cpython-3XY.pyc files in parallel.
+
+    Args:
+      root: The directory to search.
+      jobs: The number of worker processes; defaults to the number of CPUs.
+      chunksize: The number of files sent to a worker at once.
+      stats: If given, updated with throughput information as files are
+        processed.
+
+    Returns:
+      An iterator over (path, frozenset of lines) tuples in completion order,
+      where the exception raised while processing a file takes the place of
+      its result.
+    """
+    paths = find_pyc_files(root, cpython_only=True)
+    return batch.run(_executable_lines_file, paths, jobs, chunksize, stats)
+
+
+def dumps(
+    code: types.CodeTypeBase,
+    header: types.PycHeader,
+    trace: Optional[marshal.Trace] = None,
+) -> bytes:
+    """Serialize code as pyc data.
+
+    Args:
+      code: The code to serialize.
+      header: The pyc header, which determines the marshal format.
+      trace: See marshal.dumps().
+
+    Returns:
+      The pyc data.
+    """
+    return _header_bytes(header) + marshal.dumps(
+        code, header.python_version, trace
+    )
+
+
+def _docstring_index(code: types.CodeTypeBase) -> Optional[int]:
+    """Find the docstring of code in co_consts, if it can be removed.
+
+    Functions keep their docstring in co_consts[0], whereas modules and class
+    bodies store it in __doc__ with LOAD_CONST and STORE_NAME. In either case,
+    the constant is only removed if no other instructions use it.
+
+    Args:
+      code: The code object.
+
+    Returns:
+      The index in co_consts of the docstring, or None.
+    """
+    opmap = mapping.get_mapping(code.python_version)
+    ops = {name: op for op, name in opmap.items()}
+    load_const = ops["LOAD_CONST"]
+    store_name = ops["STORE_NAME"]
+    extended_arg = ops["EXTENDED_ARG"]
+    consts = code.co_consts
+    uses = {}
+    doc_store = None
+    prev_const = None
+    ext = 0
+    co_code = code.co_code
+    for pos in range(0, len(co_code), 2):
+        op = co_code[pos]
+        arg = co_code[pos + 1] | ext
+        if op == extended_arg:
+            ext = arg << 8
+            continue
+        ext = 0
+        if op == 0:  # CACHE
+            continue
+        if op == load_const:
+            uses[arg] = uses.get(arg, 0) + 1
+            prev_const = arg
+            continue
+        if (
+            op == store_name
+            and prev_const is not None
+            and code.co_names[arg] == "__doc__"
+        ):
+            doc_store = prev_const
+        prev_const = None
+    if (
+        code.co_flags & marshal.Flags.CO_OPTIMIZED
+        and not code.co_name.startswith("<")
+    ):
+        # Functions always have their docstring or None as their first
+        # constant (lambdas and comprehensions, named <...>, do not).
+        index = 0
+    elif doc_store is not None and uses[doc_store] == 1:
+        index = doc_store
+    else:
+        return None
+    if index >= len(consts) or not isinstance(consts[index], str):
+        return None
+    if uses.get(index, 0) > (index == doc_store):
+        return None
+    return index
+
+
+def strip(
+    code: types.CodeTypeBase,
+    docstrings: bool = True,
+    line_tables: bool = False,
+) -> types.CodeTypeBase:
+    """Remove information that is not needed to run code.
+
+    Args:
+      code: The code to strip. It is not modified.
+      docstrings: Remove docstrings, as python -OO does. Module, class and
+        function docstrings become None.
+      line_tables: Remove column information from 3.11+ line tables, as
+        python -X no_debug_ranges does. Line numbers are kept. Line tables of
+        earlier versions do not have column information.
+
+    Returns:
+      A stripped copy of code.
+    """
+    consts = tuple(
+        strip(c, docstrings, line_tables)
+        if isinstance(c, types.CodeTypeBase)
+        else c
+        for c in code.co_consts
+    )
+    if docstrings:
+        index = _docstring_index(code)
+        if index is not None:
+            consts = consts[:index] + (None,) + consts[index + 1 :]
+    changes = {"co_consts": consts}
+    if line_tables and code.python_version >= (3, 11):
+        assert isinstance(code, types.CodeType311)
+        changes["co_linetable"] = linetable.strip_columns(code)
+    return dataclasses.replace(code, **changes)
+
+
+def strip_file(
+    path: str,
+    out_path: str,
+    docstrings: bool = True,
+    line_tables: bool = False,
+):
+    """Write a stripped copy of a pyc file.
+
+    The header is copied from the original file, so the stripped pyc is used
+    in place of the original for the same source file.
+
+    Args:
+      path: The pyc file to read.
+      out_path: The file to write to; may be the same as path.
+      docstrings: See strip().
+      line_tables: See strip().
+    """
+    with open(path, "rb") as f:
+        header = read_header(f)
+        code = marshal.loads(f.read(), header.python_version)
+    data = dumps(strip(code, docstrings, line_tables), header)
+    with open(out_path, "wb") as f:
+        f.write(data)
+
+
+def _read_pyc(path: str) -> Tuple[bytes, Dict[str, Any]]:
+    """Read a pyc file, and the key that its index file must have.
+
+    The key is the pyc header, which identifies the source, and the size and
+    modification time of the pyc file, which change when it is rewritten.
+    Unlike a hash of the contents, it is free to check.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+    key = {
+        "header": data[: _HEADER.size].hex(),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+    return data, key
+
+
+def _build_index(data: bytes) -> List[marshal.CodeIndexEntry]:
+    header = _parse_header(data)
+    return marshal.code_index(
+        memoryview(data)[_HEADER.size :], header.python_version
+    )
+
+
+def _index_entry(row: list) -> marshal.CodeIndexEntry:
+    path, firstlineno, start, end, ref_start, refs = row
+    return marshal.CodeIndexEntry(
+        path=tuple(path),
+        firstlineno=firstlineno,
+        start=start,
+        end=end,
+        ref_start=ref_start,
+        refs=dict(zip(refs[::2], refs[1::2])),
+    )
+
+
+def _read_index_file(
+    index_path: str, key: Dict[str, Any], qualname: Optional[str] = None
+) -> Optional[List[marshal.CodeIndexEntry]]:
+    """Read an index file, if it exists and is for the pyc data with key.
+
+    Args:
+      index_path: The index file.
+      key: The key of the pyc data, see _read_pyc().
+      qualname: If given, only read the first entry with this qualname.
+
+    Returns:
+      The index entries, or None if the file is missing, stale or corrupt.
+    """
+    try:
+        with open(index_path, "rb") as f:
+            header = json.loads(f.readline())
+            if (
+                not isinstance(header, dict)
+                or header.get("format") != _INDEX_FORMAT
+                or header.get("key") != key
+            ):
+                return None
+            if qualname is None:
+                return [_index_entry(json.loads(line)) for line in f]
+            try:
+                i = header["qualnames"].index(qualname)
+            except ValueError:
+                return []
+            f.seek(header["offsets"][i], os.SEEK_CUR)
+            return [_index_entry(json.loads(f.readline()))]
+    except (OSError, ValueError, TypeError, KeyError, IndexError):
+        return None
+
+
+def _load_index(
+    path: str,
+    data: bytes,
+    key: Dict[str, Any],
+    qualname: Optional[str] = None,
+) -> List[marshal.CodeIndexEntry]:
+    index = _read_index_file(path + _INDEX_SUFFIX, key, qualname)
+    if index is None:
+        index = _build_index(data)
+        if qualname is not None:
+            index = [e for e in index if e.qualname == qualname][:1]
+    return index
+
+
+def write_index(path: str) -> str:
+    """Write the code index of a pyc file next to it.
+
+    The index records where each code object is in the file, so that
+    load_code_at() can decode it without decoding the rest of the file. It is
+    only used while the pyc file is unchanged, i.e. while it has the same
+    header, size and modification time.
+
+    The index file has a JSON header line with the qualnames of the code
+    objects and the offsets of their entries, followed by one JSON line per
+    entry, so that load_code_at() only has to parse the entry it needs.
+
+    Args:
+      path: The pyc file.
+
+    Returns:
+      The path of the index file.
+    """
+    data, key = _read_pyc(path)
+    index = _build_index(data)
+    lines = []
+    offsets = []
+    offset = 0
+    for e in index:
+        refs = [x for item in sorted(e.refs.items()) for x in item]
+        row = [e.path, e.firstlineno, e.start, e.end, e.ref_start, refs]
+        lines.append(json.dumps(row, separators=(",", ":")).encode() + b"\n")
+        offsets.append(offset)
+        offset += len(lines[-1])
+    header = {
+        "format": _INDEX_FORMAT,
+        "key": key,
+        "qualnames": [e.qualname for e in index],
+        "offsets": offsets,
+    }
+    index_path = path + _INDEX_SUFFIX
+    tmp = index_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(json.dumps(header, separators=(",", ":")).encode() + b"\n")
+        f.writelines(lines)
+    os.replace(tmp, index_path)
+    return index_path
+
+
+def read_index(path: str) -> List[marshal.CodeIndexEntry]:
+    """Get the code index of a pyc file.
+
+    Args:
+      path: The pyc file.
+
+    Returns:
+      The index written by write_index(), if it is up to date, or else a newly
+      built one (see marshal.code_index).
+    """
+    return _load_index(path, *_read_pyc(path))
+
+
+def load_code_at(path: str, qualname: str) -> types.CodeTypeBase:
+    """Decode a single code object from a pyc file.
+
+    Uses the index written by write_index() if it is up to date; otherwise the
+    index is built, which decodes the whole file.
+
+    Args:
+      path: The pyc file.
+      qualname: The dotted co_name path of the code object below the top-level
+        code, e.g. "C.method" (see marshal.CodeIndexEntry.qualname). If
+        several code objects have the same path, the first one is returned.
+
+    Returns:
+      The code object. Code objects nested in it are decoded when first
+      accessed.
+
+    Raises:
+      KeyError: If there is no code object with that qualname.
+    """
+    data, key = _read_pyc(path)
+    index = _load_index(path, data, key, qualname)
+    if not index:
+        raise KeyError(qualname)
+    return marshal.load_code_at(
+        memoryview(data)[_HEADER.size :],
+        _parse_header(data).python_version,
+        index[0],
+    )
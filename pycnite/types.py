@@ -14,15 +14,59 @@
 
 """Basic datatypes for parsed pyc files."""
 
-from dataclasses import dataclass
+import array
+import bisect
+from dataclasses import dataclass, field
+import hashlib
 
-from typing import Any, List, Optional, Tuple, Union
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Union
+
+
+@dataclass
+class PycHeader:
+    """The 16 byte header of a pyc file (see PEP 552)."""
+
+    python_version: Tuple[int, int]
+    magic_number: int
+    flags: int
+    # Set for timestamp-based pycs.
+    mtime: Optional[int]
+    source_size: Optional[int]
+    # Set for hash-based pycs.
+    source_hash: Optional[bytes]
+
+    @property
+    def hash_based(self) -> bool:
+        return bool(self.flags & 0x1)
+
+    @property
+    def check_source(self) -> bool:
+        return bool(self.flags & 0x2)
 
 
 @dataclass
 class CodeTypeBase:
     """Pure python types.CodeType with python version added."""
 
+    __slots__ = (
+        "python_version",
+        "co_argcount",
+        "co_posonlyargcount",
+        "co_kwonlyargcount",
+        "co_stacksize",
+        "co_flags",
+        "co_code",
+        "co_consts",
+        "co_names",
+        "co_filename",
+        "co_name",
+        "co_firstlineno",
+        # Not dataclass fields; they cache linetable.line_index() and
+        # fingerprint().
+        "_line_index",
+        "_fingerprint_cache",
+    )
+
     python_version: Tuple[int, int]
     co_argcount: int
     co_posonlyargcount: int
@@ -30,8 +74,8 @@ class CodeTypeBase:
     co_stacksize: int
     co_flags: int
     co_code: bytes
-    co_consts: List[object]
-    co_names: List[str]
+    co_consts: Sequence[object]
+    co_names: Sequence[str]
     co_filename: Union[bytes, str]
     co_name: str
     co_firstlineno: int
@@ -39,33 +83,203 @@ class CodeTypeBase:
     def __repr__(self):
         return f"<code: {self.co_name}>"
 
+    def _structure(self) -> tuple:
+        """Version-specific fields covered by the fingerprint."""
+        return ()
+
+    def _line_info(self) -> bytes:
+        """The line table, only covered by the fingerprint with lines."""
+        return b""
+
+    def _fingerprints(self) -> Tuple[bytes, bytes]:
+        """Compute the fingerprints without and with line information."""
+        structure = (
+            self.python_version,
+            self.co_argcount,
+            self.co_posonlyargcount,
+            self.co_kwonlyargcount,
+            self.co_stacksize,
+            self.co_flags,
+            self.co_names,
+            self.co_name,
+        ) + tuple(
+            bytes(x) if isinstance(x, memoryview) else x
+            for x in self._structure()
+        )
+        # Nested code objects are replaced by references to this list, so that
+        # we only need to encode the constants once for both fingerprints.
+        codes: List[CodeTypeBase] = []
+        consts = _canonical(self.co_consts, codes)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(b"%d:" % len(self.co_code))
+        h.update(self.co_code)
+        h.update(_encode_repr((structure, consts)))
+        ret = []
+        for lines in (False, True):
+            h_ = h.copy()
+            for code in codes:
+                h_.update(code.fingerprint(lines))
+            if lines:
+                h_.update(b"%d:" % self.co_firstlineno)
+                h_.update(self._line_info())
+            ret.append(h_.digest())
+        return ret[0], ret[1]
+
+    def fingerprint(self, lines: bool = True) -> bytes:
+        """A hash of the structure of the code object.
+
+        The hash covers the bytecode, constants (with nested code objects
+        represented by their own fingerprints), names, locals and signature,
+        but not the file name, so it is stable across builds of unchanged code.
+        Fingerprints are computed when first requested, or while loading with
+        fingerprints=True (see pyc.load_file), and are then cached, since code
+        objects are treated as immutable.
+
+        Args:
+          lines: Include the first line number and line table, so that code
+            that has moved within the file gets a new fingerprint.
+
+        Returns:
+          A 16 byte digest.
+        """
+        fingerprints = getattr(self, "_fingerprint_cache", None)
+        if fingerprints is None:
+            fingerprints = self._fingerprint_cache = self._fingerprints()
+        return fingerprints[1] if lines else fingerprints[0]
+
+
+# Types whose repr() is canonical and distinct from that of other types.
+_REPR_TYPES = frozenset((str, bytes, int, float, complex, bool, type(None)))
+
+
+class _Canonical:
+    """Object with a given repr, used to encode values for fingerprints."""
+
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+
+def _canonical(obj: Any, codes: List[CodeTypeBase]) -> Any:
+    """Convert obj into something with a stable and unambiguous repr().
+
+    Args:
+      obj: A constant.
+      codes: Code objects found in obj are appended to this list, and replaced
+        by their index.
+
+    Returns:
+      An object whose repr() can be hashed.
+    """
+    t = type(obj)
+    if t in _REPR_TYPES:
+        return obj
+    elif isinstance(obj, tuple):
+        if _REPR_TYPES.issuperset(map(type, obj)):
+            return obj
+        return tuple(_canonical(x, codes) for x in obj)
+    elif isinstance(obj, CodeTypeBase):
+        codes.append(obj)
+        return _Canonical(f"<code {len(codes) - 1}>")
+    elif isinstance(obj, (memoryview, bytearray)):
+        return bytes(obj)
+    elif isinstance(obj, list):
+        return [_canonical(x, codes) for x in obj]
+    elif isinstance(obj, (frozenset, set, dict)):
+        # Iteration order is not stable, so sort the elements' encodings. The
+        # compiler never puts code objects in sets, so their order in codes
+        # does not matter.
+        elts = obj.items() if isinstance(obj, dict) else obj
+        items = sorted(repr(_canonical(x, codes)) for x in elts)
+        return _Canonical(f"{t.__name__}([{', '.join(items)}])")
+    # Ellipsis and StopIteration
+    return _Canonical(f"<{obj!r}>")
+
+
+def _encode_repr(obj: Any) -> bytes:
+    return repr(obj).encode("utf-8", "surrogatepass")
+
 
 @dataclass
 class CodeType38(CodeTypeBase):
     """CodeType for python 3.8 - 3.10."""
 
+    __slots__ = (
+        "co_nlocals",
+        "co_lnotab",
+        "co_varnames",
+        "co_freevars",
+        "co_cellvars",
+    )
+
     co_nlocals: int
     co_lnotab: bytes
-    co_varnames: List[str]
+    co_varnames: Sequence[str]
     co_freevars: Tuple[str, ...]
     co_cellvars: Tuple[str, ...]
 
+    def _structure(self) -> tuple:
+        return (
+            self.co_nlocals,
+            self.co_varnames,
+            self.co_freevars,
+            self.co_cellvars,
+        )
+
+    def _line_info(self) -> bytes:
+        return self.co_lnotab
+
 
 @dataclass
 class CodeType311(CodeTypeBase):
     """CodeType for python 3.11+."""
 
+    __slots__ = (
+        "co_qualname",
+        "co_localsplusnames",
+        "co_localspluskinds",
+        "co_linetable",
+        "co_exceptiontable",
+    )
+
     co_qualname: str
     co_localsplusnames: Tuple[str, ...]
-    co_localspluskinds: Tuple[int, ...]
+    co_localspluskinds: bytes
     co_linetable: bytes
     co_exceptiontable: bytes
 
+    def _structure(self) -> tuple:
+        return (
+            self.co_localsplusnames,
+            self.co_localspluskinds,
+            self.co_exceptiontable,
+        )
+
+    def _line_info(self) -> bytes:
+        return self.co_linetable
+
 
 @dataclass
 class Opcode:
     """Opcode with names and line numbers."""
 
+    # There can be millions of these, so avoid a per-instance __dict__.
+    __slots__ = (
+        "offset",
+        "line",
+        "endline",
+        "col",
+        "endcol",
+        "op",
+        "name",
+        "arg",
+        "argval",
+    )
+
     offset: int
     line: int
     endline: Optional[int]
@@ -76,6 +290,24 @@ class Opcode:
     arg: Optional[int]
     argval: Any
 
+    def __reduce__(self):
+        # Pickle as a constructor call, which is half the size of the default
+        # pickle of an object with __slots__ and twice as fast to load.
+        return (
+            Opcode,
+            (
+                self.offset,
+                self.line,
+                self.endline,
+                self.col,
+                self.endcol,
+                self.op,
+                self.name,
+                self.arg,
+                self.argval,
+            ),
+        )
+
     def __str__(self):
         ret = f"{self.line:>5}{self.offset:>6}  {self.name:<30}"
         if self.arg is not None:
@@ -83,10 +315,111 @@ class Opcode:
         return ret
 
 
+class OpcodeTable(Sequence[Opcode]):
+    """Columnar storage for a list of opcodes.
+
+    Each integer field of Opcode is stored in its own array, with the names
+    and argvals in side lists, and Opcode objects are only created when
+    indexing or iterating. Analyses that scan a single field can work on the
+    arrays directly; they support the buffer protocol, so they can also be
+    wrapped without copying, e.g. with numpy.frombuffer(table.lines,
+    dtype=numpy.intc).
+
+    Fields that are None in the Opcode are stored as OpcodeTable.NONE.
+    """
+
+    NONE = -(2**31)
+
+    def __init__(self, opcodes: Iterable[Opcode] = ()):
+        self.offsets = array.array("i")
+        self.lines = array.array("i")
+        self.endlines = array.array("i")
+        self.cols = array.array("i")
+        self.endcols = array.array("i")
+        self.ops = array.array("H")
+        self.args = array.array("q")
+        self.names: List[str] = []
+        self.argvals: List[Any] = []
+        for op in opcodes:
+            self.append(op)
+
+    def add(
+        self,
+        offset,
+        line,
+        op,
+        name,
+        *,
+        endline=None,
+        col=None,
+        endcol=None,
+        arg=None,
+        argval=None,
+    ):
+        """Add an opcode, given its fields."""
+        none = OpcodeTable.NONE
+        self.offsets.append(offset)
+        self.lines.append(none if line is None else line)
+        self.endlines.append(none if endline is None else endline)
+        self.cols.append(none if col is None else col)
+        self.endcols.append(none if endcol is None else endcol)
+        self.ops.append(op)
+        self.args.append(none if arg is None else arg)
+        self.names.append(name)
+        self.argvals.append(argval)
+
+    def append(self, op: Opcode):
+        self.add(
+            op.offset,
+            op.line,
+            op.op,
+            op.name,
+            endline=op.endline,
+            col=op.col,
+            endcol=op.endcol,
+            arg=op.arg,
+            argval=op.argval,
+        )
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        none = OpcodeTable.NONE
+        line = self.lines[i]
+        endline = self.endlines[i]
+        col = self.cols[i]
+        endcol = self.endcols[i]
+        arg = self.args[i]
+        return Opcode(
+            offset=self.offsets[i],
+            line=None if line == none else line,
+            endline=None if endline == none else endline,
+            col=None if col == none else col,
+            endcol=None if endcol == none else endcol,
+            op=self.ops[i],
+            name=self.names[i],
+            arg=None if arg == none else arg,
+            argval=self.argvals[i],
+        )
+
+    def __eq__(self, other):
+        if isinstance(other, (OpcodeTable, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"OpcodeTable({list(self)!r})"
+
+
 @dataclass
 class ExceptionTableEntry:
     """Exception table entry in python 3.11+."""
 
+    __slots__ = ("start", "end", "target", "depth", "lasti")
+
     start: int
     end: int
     target: int
@@ -102,20 +435,81 @@ class ExceptionTableEntry:
 
 @dataclass
 class ExceptionTable:
-    """Exception table in python 3.11+."""
+    """Exception table in python 3.11+.
+
+    lookup() and handlers_for_range() use an index of the entries sorted by
+    start offset, built on first use; call reindex() after modifying entries.
+    """
 
     entries: List[ExceptionTableEntry]
+    _sorted: List[ExceptionTableEntry] = field(
+        default_factory=list, init=False, repr=False, compare=False
+    )
+    _starts: Optional[array.array] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     def __bool__(self):
         return bool(self.entries)
 
+    def reindex(self):
+        """(Re)build the offset index."""
+        self._sorted = sorted(self.entries, key=lambda e: e.start)
+        self._starts = array.array("i", [e.start for e in self._sorted])
+
+    def _index(self, offset: int) -> int:
+        """Index in _sorted of the last entry starting at or before offset."""
+        if self._starts is None:
+            self.reindex()
+        return bisect.bisect_right(self._starts, offset) - 1
+
+    def lookup(self, offset: int) -> Optional[ExceptionTableEntry]:
+        """Get the handler for the instruction at a given offset.
+
+        Entries do not overlap (nested try blocks are flattened by the
+        compiler), so this is the innermost handler.
+
+        Args:
+          offset: A bytecode offset.
+
+        Returns:
+          The entry covering offset, with the handler's target, stack depth
+          and lasti flag, or None if the instruction has no handler.
+        """
+        i = self._index(offset)
+        if i >= 0 and offset <= self._sorted[i].end:
+            return self._sorted[i]
+        return None
+
+    def handlers_for_range(
+        self, start: int, end: int
+    ) -> List[ExceptionTableEntry]:
+        """Get the entries covering any instruction in [start, end).
+
+        Args:
+          start: The first bytecode offset.
+          end: The offset after the last instruction.
+
+        Returns:
+          The entries, in offset order.
+        """
+        ret = []
+        for i in range(max(self._index(start), 0), len(self._sorted)):
+            e = self._sorted[i]
+            if e.start >= end:
+                break
+            if e.end >= start:
+                ret.append(e)
+        return ret
+
 
 @dataclass
 class DisassembledCode:
     """Tree of bytecode and associated opcode list."""
 
     code: CodeTypeBase
-    opcodes: List[Opcode]
+    # Either a list or an OpcodeTable
+    opcodes: Sequence[Opcode]
     exception_table: ExceptionTable
     children: "List[DisassembledCode]"
 
@@ -127,6 +521,11 @@ class DisassembledCode:
     def python_version(self):
         return self.code.python_version
 
+    @property
+    def fingerprint(self) -> bytes:
+        """The fingerprint of the code, see CodeTypeBase.fingerprint()."""
+        return self.code.fingerprint()
+
     def get_child(self, name) -> "Optional[DisassembledCode]":
         """Get the first child with name = `name`."""
         for c in self.children:
@@ -0,0 +1,462 @@
+"""Benchmarks for pycnite.
+
+Usage:
+  python scripts/benchmark.py [benchmark ...]
+
+Runs all benchmarks if none are named. Synthetic modules are compiled with
+the host python, so their timings are for the host's target version.
+"""
+
+import argparse
+import gc
+import glob
+import importlib.util
+import io
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Make sure we import from the local copy of pycnite
+sys.path = [os.path.dirname(os.path.dirname(__file__))] + sys.path
+
+from pycnite import bytecode
+from pycnite import cache
+from pycnite import linetable
+from pycnite import marshal as pyc_marshal
+from pycnite import pyc
+
+DATADIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "tests", "testdata"
+)
+
+HOST_VERSION = sys.version_info[:2]
+
+
+def synthetic_source(n_functions=2000):
+    """A large generated module with lots of small functions and classes."""
+    out = []
+    for i in range(n_functions):
+        out.append(
+            f"def f{i}(a, b=({i}, 'x{i}', 1.5), *args, **kwargs):\n"
+            f"    '''Docstring for f{i}.'''\n"
+            f"    x = a + b[0] * {i} - {i ** 5}\n"
+            f"    try:\n"
+            f"        y = [c for c in args if c != 'k{i}']\n"
+            f"    except ValueError:\n"
+            f"        y = None\n"
+            f"    return x, y, kwargs.get('v{i}')\n"
+        )
+        if i % 10 == 0:
+            out.append(
+                f"class C{i}:\n"
+                f"    def m(self, z):\n"
+                f"        return z.attr{i} + {i}\n"
+            )
+    return "".join(out)
+
+
+def synthetic_pyc(n_functions=2000):
+    """pyc data for synthetic_source(), compiled by the host python."""
+    code = compile(synthetic_source(n_functions), "synthetic.py", "exec")
+    header = importlib.util.MAGIC_NUMBER + b"\0" * 12
+    return header + marshal.dumps(code)
+
+
+def testdata_pycs():
+    """(path, data) for all pycs in tests/testdata."""
+    ret = []
+    for path in sorted(glob.glob(os.path.join(DATADIR, "*", "*.pyc"))):
+        with open(path, "rb") as f:
+            ret.append((path, f.read()))
+    return ret
+
+
+def stdlib_pycs(limit=500):
+    """(path, data) for up to `limit` of the host's standard library pycs."""
+    root = os.path.dirname(os.__file__)
+    paths = sorted(pyc.find_pyc_files(root, cpython_only=True))[:limit]
+    ret = []
+    for path in paths:
+        with open(path, "rb") as f:
+            ret.append((path, f.read()))
+    return ret
+
+
+def best_time(fn, repeat=5, number=1):
+    """Best wall clock time of `number` calls to fn, over `repeat` runs."""
+    times = []
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append((time.perf_counter() - start) / number)
+    finally:
+        gc.enable()
+    return min(times)
+
+
+def report(name, seconds, size=None):
+    line = f"  {name:<40} {seconds * 1000:10.2f} ms"
+    if size:
+        line += f" {size / 1e6 / seconds:8.1f} MB/s"
+    print(line)
+
+
+# Benchmarks
+
+
+def bench_marshal():
+    """Pure python MarshalReader on the test corpus and a large module."""
+    corpus = []
+    for path, data in testdata_pycs():
+        version = pyc.read_header(path).python_version
+        corpus.append((data[16:], version))
+
+    def load_corpus():
+        for data, version in corpus:
+            pyc_marshal.MarshalReader(data, version).load()
+
+    size = sum(len(d) for d, _ in corpus)
+    report("testdata corpus", best_time(load_corpus, number=100), size)
+    data = synthetic_pyc()[16:]
+    load = lambda: pyc_marshal.MarshalReader(data, HOST_VERSION).load()
+    report(f"synthetic module ({len(data)} bytes)", best_time(load), len(data))
+
+
+def bench_nesting():
+    """Recursive vs iterative MarshalReader on wide and deep constants."""
+    wide = pyc_marshal.dumps(
+        tuple((i, f"s{i}", (i, 1.5)) for i in range(100000)), (3, 11)
+    )
+    # Built by hand, since the writer is recursive too.
+    deep = b")\x02i\x00\x00\x00\x00" * 100 + b"N"
+    deep = b")\xc8" + deep * 200
+    deepest = b")\x01" * 100000 + b"N"
+    for name, data in (
+        ("wide", wide),
+        ("deep", deep),
+        ("deepest", deepest),
+    ):
+        for method in ("load", "load_iterative"):
+
+            def load():
+                getattr(pyc_marshal.MarshalReader(data, (3, 11)), method)()
+
+            label = f"{name} {method}"
+            try:
+                report(label, best_time(load), len(data))
+            except RecursionError:
+                print(f"  {label:<40} RecursionError")
+
+
+def bench_lazy():
+    """Time to the top-level code object with lazy vs full loading."""
+    modules = [("synthetic module", synthetic_pyc()[16:])]
+    for name in ("pydoc", "typing"):
+        path = importlib.util.find_spec(name).origin
+        with open(path, "rb") as f:
+            code = compile(f.read(), path, "exec")
+        modules.append((name, marshal.dumps(code)))
+    for name, data in modules:
+
+        def full():
+            pyc_marshal.loads(data, HOST_VERSION, native_fast_path=False)
+
+        def lazy():
+            pyc_marshal.loads(data, HOST_VERSION, lazy=True)
+
+        t_full = best_time(full, repeat=10)
+        t_lazy = best_time(lazy, repeat=10)
+        report(f"{name} full", t_full, len(data))
+        report(f"{name} lazy", t_lazy, len(data))
+        print(f"  {'speedup':<40} {t_full / t_lazy:10.1f} x")
+
+
+def _count_opcodes(dis):
+    n = 0
+    stack = [dis]
+    while stack:
+        d = stack.pop()
+        n += len(d.opcodes)
+        stack.extend(d.children)
+    return n
+
+
+def bench_memory():
+    """Memory held by a fully disassembled large module."""
+    code = pyc.loads(synthetic_pyc())
+    for table in (False, True):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        dis = bytecode.dis_all(code, table=table)
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        n_opcodes = _count_opcodes(dis)
+        storage = "OpcodeTable" if table else "list"
+        print(
+            f"  {storage:<12} {n_opcodes} opcodes, {size / 1e6:.1f} MB, "
+            f"{size / n_opcodes:.0f} bytes per opcode"
+        )
+        del dis
+    tracemalloc.start()
+    n_opcodes = 0
+
+    def visit(path, dis):
+        nonlocal n_opcodes
+        n_opcodes += len(dis.opcodes)
+
+    bytecode.dis_walk(code, visit)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"  {'dis_walk':<12} {n_opcodes} opcodes, {peak / 1e6:.1f} MB peak")
+
+
+def _code_objects(code):
+    ret = []
+    stack = [code]
+    while stack:
+        c = stack.pop()
+        ret.append(c)
+        stack.extend(x for x in c.co_consts if hasattr(x, "co_code"))
+    return ret
+
+
+def bench_linetable():
+    """Full vs lines-only 3.11+ line table decoding."""
+    corpora = {}
+    for _, data in testdata_pycs():
+        code = pyc.loads(data)
+        if code.python_version >= (3, 11):
+            name = f"testdata {'.'.join(map(str, code.python_version))}"
+            corpora.setdefault(name, []).extend(_code_objects(code))
+    if HOST_VERSION >= (3, 11):
+        corpora["synthetic module"] = _code_objects(pyc.loads(synthetic_pyc()))
+    for name, codes in corpora.items():
+        size = sum(len(c.co_linetable) for c in codes)
+
+        def read_all():
+            for c in codes:
+                linetable.linetable_reader(c).read_all()
+
+        def read_lines():
+            for c in codes:
+                linetable.linetable_reader(c).read_lines()
+
+        number = max(1, 100000 // size)
+        report(f"{name} read_all", best_time(read_all, number=number), size)
+        report(f"{name} read_lines", best_time(read_lines, number=number), size)
+
+
+def bench_executable_lines():
+    """Executable lines via dis_all vs linetable.executable_lines."""
+    corpus = [pyc.loads(data) for _, data in testdata_pycs()]
+    big = pyc.loads(synthetic_pyc())
+
+    def via_dis(codes):
+        for code in codes:
+            {op.line for _, op in bytecode.iter_dis_all(code)}
+
+    def via_linetable(codes):
+        for code in codes:
+            linetable.executable_lines(code)
+
+    for name, codes, number in (
+        ("testdata corpus", corpus, 20),
+        ("synthetic module", [big], 1),
+    ):
+        t_dis = best_time(lambda: via_dis(codes), number=number)
+        t_lt = best_time(lambda: via_linetable(codes), number=number)
+        report(f"{name} dis_all", t_dis)
+        report(f"{name} executable_lines", t_lt)
+        print(f"  {'speedup':<40} {t_dis / t_lt:10.1f} x")
+
+
+def bench_disk_cache():
+    """Cold vs warm DiskCache, and uncached loading, for a tree of pycs."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for path, data in testdata_pycs():
+            paths.append(os.path.join(tmpdir, os.path.basename(path)))
+            with open(paths[-1], "wb") as f:
+                f.write(data)
+        paths.append(os.path.join(tmpdir, "synthetic.pyc"))
+        with open(paths[-1], "wb") as f:
+            f.write(synthetic_pyc())
+        size = sum(os.path.getsize(p) for p in paths)
+        cache_dir = os.path.join(tmpdir, "cache")
+        for method, uncached in (
+            ("load_file", pyc.load_file),
+            ("dis_all", lambda p: bytecode.dis_all(pyc.load_file(p))),
+        ):
+
+            def run(fn):
+                for p in paths:
+                    fn(p)
+
+            def cold():
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                run(getattr(cache.DiskCache(cache_dir), method))
+
+            def warm():
+                run(getattr(cache.DiskCache(cache_dir), method))
+
+            report(f"{method} uncached", best_time(lambda: run(uncached)), size)
+            report(f"{method} cold cache", best_time(cold), size)
+            report(f"{method} warm cache", best_time(warm), size)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_strip():
+    """Size and host load time of pycs stripped with pyc.strip."""
+    corpus = [data for _, data in testdata_pycs()]
+    for name, datas in (
+        ("testdata", corpus),
+        ("synthetic", [synthetic_pyc()]),
+    ):
+        variants = {"original": datas}
+        for label, line_tables in (("-docs", False), ("-docs -columns", True)):
+            variants[label] = []
+            for data in datas:
+                header = pyc.read_header(io.BytesIO(data))
+                code = pyc.strip(pyc.loads(data), line_tables=line_tables)
+                variants[label].append(pyc.dumps(code, header))
+        for label, stripped in variants.items():
+            size = sum(len(d) for d in stripped)
+            line = f"  {name + ' ' + label:<28} {size:10d} bytes"
+            # Only data for the host version can be loaded by the interpreter.
+            host = [
+                d[16:]
+                for d in stripped
+                if pyc.read_header(io.BytesIO(d)).python_version == HOST_VERSION
+            ]
+            if host:
+                t = best_time(lambda: [marshal.loads(d) for d in host])
+                line += f" {t * 1000:10.2f} ms host load"
+            print(line)
+
+
+def bench_scan():
+    """marshal.scan vs loading, on the test corpus and a large module."""
+    corpus = []
+    for path, data in testdata_pycs():
+        version = pyc.read_header(path).python_version
+        corpus.append((data[16:], version))
+    data = synthetic_pyc()[16:]
+    for name, datas in (
+        ("testdata corpus", corpus),
+        ("synthetic module", [(data, HOST_VERSION)]),
+    ):
+        size = sum(len(d) for d, _ in datas)
+
+        def load():
+            for d, version in datas:
+                pyc_marshal.MarshalReader(d, version).load_iterative()
+
+        def scan():
+            for d, version in datas:
+                pyc_marshal.scan(d, version)
+
+        number = max(1, 1000000 // size)
+        t_load = best_time(load, number=number)
+        t_scan = best_time(scan, number=number)
+        report(f"{name} load_iterative", t_load, size)
+        report(f"{name} scan", t_scan, size)
+        print(f"  {'speedup':<40} {t_load / t_scan:10.1f} x")
+
+
+def bench_code_index():
+    """One function via pyc.load_code_at vs loading the whole module."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "synthetic.pyc")
+        with open(path, "wb") as f:
+            f.write(synthetic_pyc())
+        size = os.path.getsize(path)
+        report("write_index", best_time(lambda: pyc.write_index(path)), size)
+        index_size = os.path.getsize(path + ".index")
+        print(f"  {'index size':<40} {index_size:10d} bytes")
+        load = lambda: pyc.load_file(path, native_fast_path=False)
+        report("load_file", best_time(load), size)
+        load = lambda: pyc.load_file(path, lazy=True)
+        report("load_file lazy", best_time(load), size)
+        for qualname in ("f1000", "C1000.m"):
+            load = lambda: pyc.load_code_at(path, qualname)
+            report(f"load_code_at {qualname}", best_time(load))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_fields():
+    """Loading only some code fields, on the host standard library."""
+    corpus = stdlib_pycs() or testdata_pycs()
+    size = sum(len(data) for _, data in corpus)
+    print(f"  {len(corpus)} pycs, {size} bytes")
+    projections = {
+        "all fields": None,
+        "names only": {"co_names", "co_consts", "co_name", "co_qualname"},
+        # Without co_consts, nested code objects are skipped.
+        "top-level bytecode": {"co_code"},
+    }
+    for native in (False, True):
+        for name, fields in projections.items():
+            label = name + (" native" if native else " pure python")
+            _bench_projection(corpus, size, label, native, fields)
+
+
+def _bench_projection(corpus, size, label, native, fields):
+    """Report the time and memory to load corpus with some fields."""
+
+
+    def load():
+        return [
+            pyc.loads(data, native_fast_path=native, fields=fields)
+            for _, data in corpus
+        ]
+
+    report(label, best_time(load, repeat=3), size)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    codes = load()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del codes
+    print(f"  {label + ' retained':<40} {retained / 1e6:10.1f} MB")
+
+
+BENCHMARKS = {
+    "marshal": bench_marshal,
+    "nesting": bench_nesting,
+    "lazy": bench_lazy,
+    "memory": bench_memory,
+    "linetable": bench_linetable,
+    "executable_lines": bench_executable_lines,
+    "disk_cache": bench_disk_cache,
+    "strip": bench_strip,
+    "scan": bench_scan,
+    "code_index": bench_code_index,
+    "fields": bench_fields,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks", nargs="*", help=", ".join(BENCHMARKS))
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
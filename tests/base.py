@@ -20,6 +20,18 @@ DATADIR = os.path.join(os.path.dirname(__file__), "testdata")
 
 VERSIONS = ((3, 8), (3, 9), (3, 10), (3, 11), (3, 12))
 
+# The test programs compiled for each version in DATADIR.
+PREFIXES = (
+    "basic",
+    "complex_exception",
+    "exception",
+    "flow",
+    "generator",
+    "genexpr",
+    "method_calls",
+    "trivial",
+)
+
 
 def test_file(filename, version):
     version = ".".join(map(str, version))
@@ -32,6 +44,11 @@ def test_pyc(prefix, version):
     return test_file(filename, version)
 
 
+def test_pycs():
+    """All the pyc files in DATADIR, for all versions."""
+    return {test_pyc(p, v) for p in PREFIXES for v in VERSIONS}
+
+
 def test_src(prefix):
     filename = f"{prefix}.py"
     return os.path.join(DATADIR, "src", filename)
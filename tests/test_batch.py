@@ -0,0 +1,71 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for pycnite.batch."""
+
+import os
+import tempfile
+import unittest
+
+from . import base
+from pycnite import batch
+from pycnite import bytecode
+from pycnite import linetable
+from pycnite import pyc
+from pycnite import types
+
+
+class TestBatch(unittest.TestCase):
+    """Test parallel loading of pyc trees."""
+
+    def test_load_tree(self):
+        for jobs in (1, 2):
+            stats = batch.BatchStats()
+            results = dict(pyc.load_tree(base.DATADIR, jobs=jobs, stats=stats))
+            self.assertLessEqual(base.test_pycs(), set(results))
+            for version in base.VERSIONS:
+                code = results[base.test_pyc("basic", version)]
+                self.assertIsInstance(code, types.CodeTypeBase)
+                self.assertEqual(code.python_version, version)
+            self.assertEqual(stats.files, len(results))
+            self.assertEqual(stats.errors, 0)
+            self.assertGreater(stats.bytes, 0)
+
+    def test_dis_tree(self):
+        results = dict(bytecode.dis_tree(base.DATADIR, jobs=2, chunksize=3))
+        path = base.test_pyc("trivial", (3, 11))
+        expected = bytecode.dis_all(pyc.load_file(path))
+        self.assertEqual(results[path], expected)
+
+    def test_executable_lines_tree(self):
+        results = dict(pyc.executable_lines_tree(base.DATADIR, jobs=2))
+        path = base.test_pyc("flow", (3, 8))
+        expected = linetable.executable_lines(pyc.load_file(path))
+        self.assertEqual(results[path], expected)
+
+    def test_errors(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "bad.cpython-311.pyc"), "wb") as f:
+                f.write(b"not a pyc file")
+            with open(os.path.join(d, "ignored.pyc"), "wb") as f:
+                f.write(b"not a pyc file")
+            stats = batch.BatchStats()
+            results = list(pyc.load_tree(d, jobs=1, stats=stats))
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0][1], Exception)
+        self.assertEqual(stats.errors, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,6 +14,10 @@
 
 """Tests for pycnite.bytecode."""
 
+import importlib.util
+import marshal
+import pickle
+import textwrap
 import unittest
 
 from . import base
@@ -86,6 +90,174 @@ class TestBytecode(unittest.TestCase):
         self.assertIsNotNone(opcode.col)
         self.assertIsNotNone(opcode.endcol)
 
+    def test_slots(self):
+        path = base.test_pyc("trivial", (3, 11))
+        code = pyc.load_file(path)
+        opcode = bytecode.dis(code)[0]
+        self.assertFalse(hasattr(code, "__dict__"))
+        self.assertFalse(hasattr(opcode, "__dict__"))
+
+    def test_opcode_table(self):
+        for version in base.VERSIONS:
+            path = base.test_pyc("basic", version)
+            code = pyc.load_file(path)
+            opcodes = bytecode.dis(code)
+            table = bytecode.dis_table(code)
+            self.assertEqual(len(table), len(opcodes))
+            self.assertEqual(list(table), opcodes)
+            self.assertEqual(table[-1], opcodes[-1])
+            self.assertEqual(table[1:3], opcodes[1:3])
+            self.assertEqual(list(table.ops), [x.op for x in opcodes])
+            self.assertEqual(table.names, [x.name for x in opcodes])
+
+    def test_opcode_table_none(self):
+        path = base.test_pyc("basic", (3, 8))
+        table = bytecode.dis_table(pyc.load_file(path))
+        self.assertEqual(table.endlines[0], table.NONE)
+        self.assertIsNone(table[0].endline)
+
+    def test_dis_all_table(self):
+        path = base.test_pyc("complex_exception", (3, 11))
+        code = pyc.load_file(path)
+        expected = bytecode.dis_all(code)
+        actual = bytecode.dis_all(code, table=True)
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual.pretty_format(), expected.pretty_format())
+
+    def test_iter_dis_all(self):
+        path = base.test_pyc("genexpr", (3, 10))
+        code = pyc.load_file(path)
+        expected = []
+        stack = [((), bytecode.dis_all(code))]
+        while stack:
+            path, d = stack.pop()
+            expected.extend((path, op) for op in d.opcodes)
+            for child in reversed(d.children):
+                stack.append((path + (child.code.co_name,), child))
+        actual = list(bytecode.iter_dis_all(code))
+        self.assertEqual(actual, expected)
+        paths = {path for path, _ in actual}
+        self.assertEqual(paths, {(), ("f",), ("f", "<genexpr>")})
+
+    def test_dis_walk(self):
+        for version in base.VERSIONS:
+            path = base.test_pyc("genexpr", version)
+            code = pyc.load_file(path)
+            expected = []
+            stack = [((), bytecode.dis_all(code))]
+            while stack:
+                path, d = stack.pop()
+                expected.append((path, d.code, d.opcodes, d.exception_table))
+                for child in reversed(d.children):
+                    stack.append((path + (child.code.co_name,), child))
+            actual = []
+
+            def visit(path, d, actual=actual):
+                self.assertEqual(d.children, [])
+                actual.append((path, d.code, d.opcodes, d.exception_table))
+
+            bytecode.dis_walk(code, visit)
+            self.assertEqual(actual, expected)
+            with self.assertRaises(ValueError):
+                bytecode.dis_walk(code, visit, table=True, lazy=True)
+
+    def test_line_index(self):
+        for version in base.VERSIONS:
+            path = base.test_pyc("method_calls", version)
+            code = pyc.load_file(path)
+            expected = {}
+            for path, op in bytecode.iter_dis_all(code):
+                expected.setdefault(op.line, []).append((path, op.offset))
+            index = bytecode.LineIndex.build(code)
+            self.assertEqual(index.lines, expected)
+            self.assertEqual(index.get(-100), [])
+            self.assertEqual(
+                bytecode.LineIndex.from_json(index.to_json()), index
+            )
+
+    def test_iter_dis(self):
+        path = base.test_pyc("basic", (3, 11))
+        code = pyc.load_file(path)
+        it = bytecode.iter_dis(code)
+        self.assertEqual(next(it), bytecode.dis(code)[0])
+
+    def test_lazy(self):
+        for version in base.VERSIONS:
+            path = base.test_pyc("complex_exception", version)
+            code = pyc.load_file(path)
+            expected = bytecode.dis_all(code)
+            actual = bytecode.dis_all(code, lazy=True)
+            self.assertIsInstance(actual.opcodes[0], bytecode.LazyOpcode)
+            self.assertEqual(actual, expected)
+            self.assertEqual(actual.pretty_format(), expected.pretty_format())
+
+    def test_lazy_streaming(self):
+        # Positions are decoded on demand while disassembly is still going on.
+        path = base.test_pyc("method_calls", (3, 11))
+        code = pyc.load_file(path)
+        expected = bytecode.dis(code)
+        for op, lazy_op in zip(expected, bytecode.iter_dis(code, lazy=True)):
+            self.assertEqual(lazy_op.col, op.col)
+            self.assertEqual(lazy_op, op)
+
+    def test_lazy_table(self):
+        path = base.test_pyc("basic", (3, 11))
+        code = pyc.load_file(path)
+        with self.assertRaises(ValueError):
+            bytecode.dis_all(code, table=True, lazy=True)
+
+    def test_cache(self):
+        src = textwrap.dedent("""
+          def f(x):
+            return x + 1
+          def g():
+            return lambda: 42
+        """)
+
+        def load(src):
+            code = compile(src, "<test>", "exec")
+            header = importlib.util.MAGIC_NUMBER + b"\0" * 12
+            return pyc.loads(header + marshal.dumps(code))
+
+        cache = bytecode.DisCache()
+        code = load(src)
+        expected = bytecode.dis_all(code)
+        self.assertEqual(bytecode.dis_all(code, cache=cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (0, 4))
+        # Moving everything down a line only changes positions.
+        moved = load("\n" + src)
+        expected = bytecode.dis_all(moved)
+        self.assertEqual(bytecode.dis_all(moved, cache=cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (4, 4))
+        # Changing the lambda also changes g and the module.
+        changed = load(src.replace("42", "43"))
+        expected = bytecode.dis_all(changed)
+        self.assertEqual(bytecode.dis_all(changed, cache=cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (5, 7))
+        self.assertEqual(len(cache), 7)
+        # Splitting a line changes the line table but not the bytecode.
+        split = load(src.replace("x + 1", "(x +\n 1)"))
+        expected = bytecode.dis_all(split)
+        self.assertEqual(bytecode.dis_all(split, cache=cache), expected)
+        self.assertEqual((cache.hits, cache.misses), (9, 7))
+
+    def test_cache_eviction(self):
+        path = base.test_pyc("genexpr", (3, 11))
+        code = pyc.load_file(path)
+        cache = bytecode.DisCache(maxsize=1)
+        bytecode.dis_all(code, cache=cache)
+        bytecode.dis_all(code, cache=cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.hits, 0)
+
+    def test_pickle(self):
+        path = base.test_pyc("basic", (3, 11))
+        code = pyc.load_file(path)
+        expected = bytecode.dis_all(code)
+        self.assertEqual(pickle.loads(pickle.dumps(expected)), expected)
+        lazy = bytecode.dis(code, lazy=True)
+        self.assertEqual(pickle.loads(pickle.dumps(lazy)), expected.opcodes)
+
     def test_extended_arg(self):
         code = bytearray([144, 10, 144, 20, 100, 1])
         ops = list(bytecode.wordcode_reader(code))
@@ -0,0 +1,105 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for pycnite.cache."""
+
+import dataclasses
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import base
+from pycnite import bytecode
+from pycnite import cache
+from pycnite import pyc
+
+
+class TestDiskCache(unittest.TestCase):
+    """Test the on-disk cache."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, "cache")
+        self.pyc = os.path.join(self.tmpdir, "test.pyc")
+        shutil.copy(base.test_pyc("complex_exception", (3, 11)), self.pyc)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super().tearDown()
+
+    def test_load_file(self):
+        expected = pyc.load_file(self.pyc)
+        c = cache.DiskCache(self.cache_dir)
+        self.assertEqual(c.load_file(self.pyc), expected)
+        self.assertEqual((c.hits, c.misses), (0, 1))
+        # A new cache object on the same directory, e.g. in a later run.
+        c = cache.DiskCache(self.cache_dir)
+        self.assertEqual(c.load_file(self.pyc), expected)
+        self.assertEqual((c.hits, c.misses), (1, 0))
+
+    def test_dis_all(self):
+        expected = bytecode.dis_all(pyc.load_file(self.pyc))
+        c = cache.DiskCache(self.cache_dir)
+        self.assertEqual(c.dis_all(self.pyc), expected)
+        self.assertEqual(c.dis_all(self.pyc), expected)
+        self.assertEqual((c.hits, c.misses), (1, 1))
+
+    def test_dis_all_unknown(self):
+        # Without co_consts, the argvals of LOAD_CONST are UNKNOWN.
+        header = pyc.read_header(self.pyc)
+        code = dataclasses.replace(pyc.load_file(self.pyc), co_consts=())
+        with open(self.pyc, "wb") as f:
+            f.write(pyc.dumps(code, header))
+        c = cache.DiskCache(self.cache_dir)
+        c.dis_all(self.pyc)
+        dis = c.dis_all(self.pyc)
+        self.assertEqual(c.hits, 1)
+        argvals = [op.argval for op in dis.opcodes if op.name == "LOAD_CONST"]
+        self.assertTrue(argvals)
+        for argval in argvals:
+            self.assertIs(argval, bytecode.UNKNOWN)
+
+    def test_changed_file(self):
+        c = cache.DiskCache(self.cache_dir)
+        c.load_file(self.pyc)
+        shutil.copy(base.test_pyc("trivial", (3, 11)), self.pyc)
+        expected = pyc.load_file(self.pyc)
+        self.assertEqual(c.load_file(self.pyc), expected)
+        self.assertEqual(c.misses, 2)
+
+    def test_corrupt_entry(self):
+        c = cache.DiskCache(self.cache_dir)
+        expected = c.load_file(self.pyc)
+        for name in os.listdir(self.cache_dir):
+            if name.startswith("code-"):
+                with open(os.path.join(self.cache_dir, name), "r+b") as f:
+                    f.truncate(20)
+        self.assertEqual(c.load_file(self.pyc), expected)
+        self.assertEqual(c.misses, 2)
+
+    def test_eviction(self):
+        c = cache.DiskCache(self.cache_dir, max_bytes=1)
+        c.load_file(self.pyc)
+        self.assertLessEqual(c.size(), 1)
+        c = cache.DiskCache(self.cache_dir)
+        c.load_file(self.pyc)
+        self.assertGreater(c.size(), 1)
+        c.clear()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,10 +14,12 @@
 
 """Tests for pycnite.linetable."""
 
+import dataclasses
 import itertools
 import unittest
 
 from . import base
+from pycnite import bytecode
 from pycnite import linetable
 from pycnite import pyc
 from pycnite import types
@@ -67,6 +69,81 @@ class TestLineTable(unittest.TestCase):
         for e in entries:
             self.assertEqual(e.line, e.endline)
 
+    def test_read_lines(self):
+        for version in ((3, 11), (3, 12)):
+            for testfile in ("flow", "method_calls", "generator"):
+                code = pyc.load_file(base.test_pyc(testfile, version))
+                expected = []
+                reader = linetable.linetable_reader(code)
+                while reader.pos < reader.end_pos:
+                    endline, _, _ = reader.read()
+                    line = -1 if endline == -1 else reader.line
+                    if expected and expected[-1] == line:
+                        expected[-2] = reader.end
+                    else:
+                        expected.extend([reader.end, line])
+                reader = linetable.linetable_reader(code)
+                actual = reader.read_lines()
+                self.assertEqual(list(actual), expected)
+
+    def test_strip_columns(self):
+        for version in ((3, 11), (3, 12)):
+            for testfile in ("flow", "method_calls", "complex_exception"):
+                code = pyc.load_file(base.test_pyc(testfile, version))
+                table = linetable.strip_columns(code)
+                self.assertLess(len(table), len(code.co_linetable))
+                stripped = dataclasses.replace(code, co_linetable=table)
+                self.assertEqual(
+                    linetable.linetable_reader(stripped).read_lines(),
+                    linetable.linetable_reader(code).read_lines(),
+                )
+                for e in linetable.linetable_reader(stripped).read_all():
+                    self.assertEqual((e.startcol, e.endcol), (-1, -1))
+
+    def test_executable_lines(self):
+        for version in base.VERSIONS:
+            for testfile in ("flow", "method_calls", "complex_exception"):
+                code = pyc.load_file(base.test_pyc(testfile, version))
+                expected = {op.line for _, op in bytecode.iter_dis_all(code)}
+                self.assertEqual(linetable.executable_lines(code), expected)
+                top_level = {op.line for op in bytecode.dis(code)}
+                actual = linetable.executable_lines(code, recursive=False)
+                self.assertEqual(actual, top_level)
+
+
+class TestLineTableIndex(unittest.TestCase):
+    """Test random access line table lookups."""
+
+    def test_matches_reader(self):
+        for version in base.VERSIONS:
+            for testfile in ("flow", "method_calls", "generator"):
+                path = base.test_pyc(testfile, version)
+                code = pyc.load_file(path)
+                index = linetable.line_index(code)
+                offsets = range(0, len(code.co_code), 2)
+                reader = linetable.linetable_reader(code)
+                expected = [reader.get(i).line for i in offsets]
+                # Look offsets up in reverse to check random access.
+                actual = [index.get(i).line for i in reversed(offsets)]
+                self.assertEqual(actual[::-1], expected)
+
+    def test_columns(self):
+        code = pyc.load_file(base.test_pyc("flow", (3, 11)))
+        index = linetable.line_index(code)
+        reader = linetable.linetable_reader(code)
+        for entry in reader.read_all():
+            actual = index.get(entry.offset)
+            # Adjacent entries with the same position are merged in the index.
+            self.assertGreaterEqual(actual.end_offset, entry.end_offset)
+            actual.end_offset = entry.end_offset
+            self.assertEqual(actual, entry)
+
+    def test_cached(self):
+        code = pyc.load_file(base.test_pyc("trivial", (3, 9)))
+        index = linetable.line_index(code)
+        self.assertIs(linetable.line_index(code), index)
+        self.assertLessEqual(len(index), len(code.co_code) // 2)
+
 
 class TestExceptionTable(unittest.TestCase):
     """Test exceptiontable parsing."""
@@ -146,6 +223,30 @@ class TestExceptionTable(unittest.TestCase):
                 ]
             self.assertEqual(actual, expected)
 
+    def test_lookup(self):
+        for version in base.VERSIONS:
+            if version < (3, 11):
+                continue
+            path = base.test_pyc("complex_exception", version)
+            code = pyc.load_file(path).co_consts[0]
+            entries = linetable.ExceptionTableReader(code).read_all()
+            table = types.ExceptionTable(entries)
+            offsets = range(0, len(code.co_code) + 4, 2)
+            for offset in offsets:
+                expected = [e for e in entries if e.start <= offset <= e.end]
+                actual = table.lookup(offset)
+                self.assertEqual([actual] if actual else [], expected)
+            for start, end in itertools.combinations(offsets, 2):
+                expected = [
+                    e for e in entries if e.start < end and e.end >= start
+                ]
+                self.assertEqual(table.handlers_for_range(start, end), expected)
+
+    def test_lookup_empty(self):
+        table = types.ExceptionTable([])
+        self.assertIsNone(table.lookup(0))
+        self.assertEqual(table.handlers_for_range(0, 10), [])
+
 
 if __name__ == "__main__":
     unittest.main()
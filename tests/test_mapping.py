@@ -41,6 +41,29 @@ class TestMapping(unittest.TestCase):
     self.run_test((3, 12), 121, "RETURN_CONST")
     self.run_test((3, 12), 150, "YIELD_VALUE")
 
+  def test_op_table(self):
+    for version in ((3, 8), (3, 9), (3, 10), (3, 11), (3, 12)):
+      table = mapping.get_op_table(version)
+      self.assertEqual(len(table), 256)
+      self.assertIs(mapping.get_op_table(version), table)
+      opmap = mapping.get_mapping(version)
+      for op, info in enumerate(table):
+        if info is None:
+          self.assertNotIn(op, opmap)
+        else:
+          self.assertEqual(info.name, opmap[op])
+          self.assertEqual(info.arg_type, mapping.arg_type(info.name, version))
+
+  def test_arg_decoders(self):
+    # JUMP_FORWARD 3 at offset 10
+    self.assertEqual(mapping.get_op_table((3, 9))[110].decode_arg(3, 12), 15)
+    self.assertEqual(mapping.get_op_table((3, 10))[110].decode_arg(3, 12), 18)
+    # JUMP_BACKWARD 3 at offset 10
+    self.assertEqual(mapping.get_op_table((3, 11))[140].decode_arg(3, 12), 6)
+    # LOAD_GLOBAL 5
+    self.assertIsNone(mapping.get_op_table((3, 10))[116].decode_arg)
+    self.assertEqual(mapping.get_op_table((3, 11))[116].decode_arg(5, 0), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
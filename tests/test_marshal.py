@@ -14,9 +14,16 @@
 
 """Tests for marshal.py."""
 
+import dataclasses
+import marshal as host_marshal
+import pickle
+import sys
+import textwrap
 import unittest
 
+from . import base
 from pycnite import marshal
+from pycnite import types
 
 
 class Base(unittest.TestCase):
@@ -233,6 +240,503 @@ class TestCodeReader(Base):
         self.assertEqual(code.co_flags, 3)
         self.assertEqual(code.co_names, ())
 
+    def test_zero_copy(self):
+        # Code from marshal.dumps of
+        #   def f():
+        #     return b"abc"
+        bytecode = (
+            b"\xe3\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01"
+            b"\x00\x00\x00\x03\x00\x00\x00\xf3\x06\x00\x00\x00\x97\x00d"
+            b"\x01S\x00)\x02N\xf3\x03\x00\x00\x00abc\xa9\x00r\x03\x00\x00"
+            b"\x00\xf3\x00\x00\x00\x00\xfa\x08<string>\xda\x01fr\x06\x00\x00"
+            b"\x00\x03\x00\x00\x00s\x07\x00\x00\x00\x80\x00\xd8\x0b\x11\x886"
+            b"r\x04\x00\x00\x00"
+        )
+        expected = marshal.loads(bytecode, (3, 11))
+        code = marshal.loads(memoryview(bytecode), (3, 11), zero_copy=True)
+        self.assertEqual(code, expected)
+        self.assertIsInstance(code.co_code, memoryview)
+        self.assertIsInstance(code.co_linetable, memoryview)
+        # Bytes constants and empty fields are still copied.
+        self.assertStrictEqual(code.co_consts[1], b"abc")
+        self.assertStrictEqual(code.co_exceptiontable, b"")
+
+
+class TestIterativeReader(Base):
+    """Tests for the non-recursive reader."""
+
+    def test_matches_load(self):
+        for version in base.VERSIONS:
+            for testfile in ("basic", "complex_exception", "genexpr"):
+                with open(base.test_pyc(testfile, version), "rb") as f:
+                    data = memoryview(f.read()[16:])
+                for zero_copy in (False, True):
+                    r1 = marshal.MarshalReader(
+                        data, version, zero_copy=zero_copy
+                    )
+                    r2 = marshal.MarshalReader(
+                        data, version, zero_copy=zero_copy
+                    )
+                    self.assertEqual(r1.load(), r2.load_iterative())
+                    self.assertEqual(r1.bufpos, r2.bufpos)
+                    self.assertEqual(
+                        [type(x) for x in r1.refs], [type(x) for x in r2.refs]
+                    )
+
+    def test_ref_order(self):
+        # A flagged tuple (ref 0) of a flagged int (ref 1) and a dict whose
+        # value refers to the int.
+        data = b"\xa9\x02\xe9\x07\x00\x00\x00{Nr\x01\x00\x00\x000"
+        reader = marshal.MarshalReader(data, (3, 9))
+        self.assertEqual(reader.load_iterative(), (7, {None: 7}))
+        self.assertEqual(reader.refs, [(7, {None: 7}), 7])
+
+    def test_deep_nesting(self):
+        depth = 10 * sys.getrecursionlimit()
+        value = self.load(b")\x01" * depth + b"N")
+        for _ in range(depth):
+            (value,) = value
+        self.assertIsNone(value)
+
+    def test_truncated_container(self):
+        self.assertRaises(EOFError, lambda: self.load(b")\x02N"))
+        self.assertRaises(EOFError, lambda: self.load(b"{N"))
+
+
+class TestLazyCodeReader(Base):
+    """Tests for lazily decoding nested code objects."""
+
+    SRC = textwrap.dedent("""
+      def f(shared_arg):
+        def g():
+          return "shared constant"
+        return g
+      class A:
+        def h(self):
+          return shared_arg
+      x = ("shared constant", f)
+    """)
+
+    def setUp(self):
+        super().setUp()
+        self.version = sys.version_info[:2]
+        code = compile(self.SRC, "<test>", "exec")
+        self.data = host_marshal.dumps(code)
+
+    def test_lazy(self):
+        expected = marshal.loads(self.data, self.version)
+        code = marshal.loads(self.data, self.version, lazy=True)
+        self.assertIsInstance(code.co_consts, marshal.LazyConsts)
+        # Nested code objects are not decoded until accessed.
+        raw = [x for x in tuple.__iter__(code.co_consts)]
+        self.assertTrue(any(isinstance(x, marshal._LazyObject) for x in raw))
+        # Module level fields referring to objects defined inside the skipped
+        # code objects are decoded correctly.
+        self.assertEqual(code.co_names, expected.co_names)
+        self.assertEqual(code, expected)
+
+    def test_shared_refs(self):
+        code = marshal.loads(self.data, self.version, lazy=True)
+        f = [x for x in code.co_consts if hasattr(x, "co_code")][0]
+        g = [x for x in f.co_consts if hasattr(x, "co_code")][0]
+        (s1,) = [x for x in g.co_consts if x == "shared constant"]
+        (s2,) = [x for x in code.co_consts if x == "shared constant"]
+        self.assertIs(s1, s2)
+
+    def test_partial_access(self):
+        code = marshal.loads(self.data, self.version, lazy=True)
+        # Accessing one code object doesn't decode its siblings.
+        consts = [x for x in tuple.__iter__(code.co_consts)]
+        lazy = [x for x in consts if isinstance(x, marshal._LazyObject)]
+        lazy[0].resolve()
+        self.assertIsNone(lazy[0].reader)
+        self.assertIsNotNone(lazy[1].reader)
+
+    def test_skip(self):
+        # A tuple of a flagged short ascii string and a reference to it.
+        data = b")\x02\xfa\x01ar\x00\x00\x00\x00"
+        reader = marshal.MarshalReader(data, (3, 11), lazy=True)
+        reader.skip()
+        self.assertTrue(reader.eof())
+        (placeholder,) = reader.refs
+        self.assertIsInstance(placeholder, marshal._LazyObject)
+        self.assertEqual(placeholder.resolve(), "a")
+
+    def test_skip_errors(self):
+        for data, exc in (
+            (b")\x01r\x00\x00\x00\x00", ValueError),
+            (b")\x02\xfa\x01a", EOFError),
+            (b")\x01?", ValueError),
+        ):
+            with self.subTest(data=data):
+                reader = marshal.MarshalReader(data, (3, 11), lazy=True)
+                with self.assertRaises(exc):
+                    reader.skip()
+
+    def _lazy_consts(self):
+        expected = marshal.loads(self.data, self.version).co_consts
+        consts = marshal.loads(self.data, self.version, lazy=True).co_consts
+        child = next(x for x in expected if isinstance(x, types.CodeTypeBase))
+        return consts, expected, child
+
+    def test_contains(self):
+        consts, _, child = self._lazy_consts()
+        self.assertIn(child, consts)
+
+    def test_index(self):
+        consts, expected, child = self._lazy_consts()
+        self.assertEqual(consts.index(child), expected.index(child))
+        with self.assertRaises(ValueError):
+            consts.index(child, expected.index(child) + 1)
+
+    def test_count(self):
+        consts, _, child = self._lazy_consts()
+        self.assertEqual(consts.count(child), 1)
+
+    def test_add(self):
+        consts, expected, _ = self._lazy_consts()
+        for value in (consts + (), () + consts, consts * 1):
+            self.assertIs(type(value), tuple)
+            self.assertEqual(value, expected)
+            self.assertFalse(
+                any(isinstance(x, marshal._LazyObject) for x in value)
+            )
+
+    def test_pickle(self):
+        consts, expected, _ = self._lazy_consts()
+        data = pickle.dumps(consts)
+        # The reader is not pickled through unresolved placeholders.
+        self.assertNotIn(b"MarshalReader", data)
+        value = pickle.loads(data)
+        self.assertIs(type(value), tuple)
+        self.assertEqual(value, expected)
+
+
+class TestFingerprint(Base):
+    """Tests for code object fingerprints."""
+
+    SRC = textwrap.dedent("""
+      def f(x):
+        return {x, "a", "b"}
+      def g():
+        return lambda: 42
+    """)
+
+    def _load(self, src, **kwargs):
+        code = compile(src, "<test>", "exec")
+        data = host_marshal.dumps(code)
+        return marshal.loads(data, sys.version_info[:2], **kwargs)
+
+    def _fingerprints(self, code, lines=True):
+        return {
+            c.co_name: c.fingerprint(lines)
+            for c in code.co_consts
+            if isinstance(c, types.CodeTypeBase)
+        }
+
+    def test_load_modes(self):
+        expected = self._fingerprints(self._load(self.SRC))
+        for kwargs in (
+            {"native_fast_path": False},
+            {"native_fast_path": False, "fingerprints": True},
+            {"fingerprints": True},
+            {"lazy": True},
+        ):
+            actual = self._fingerprints(self._load(self.SRC, **kwargs))
+            self.assertEqual(actual, expected)
+
+    def test_lines(self):
+        code = self._load(self.SRC)
+        moved = self._load("\n" + self.SRC)
+        self.assertEqual(
+            self._fingerprints(code, lines=False),
+            self._fingerprints(moved, lines=False),
+        )
+        self.assertNotEqual(
+            self._fingerprints(code)["f"], self._fingerprints(moved)["f"]
+        )
+
+    def test_nested_change(self):
+        code = self._fingerprints(self._load(self.SRC))
+        changed = self._fingerprints(self._load(self.SRC.replace("42", "43")))
+        self.assertEqual(code["f"], changed["f"])
+        self.assertNotEqual(code["g"], changed["g"])
+
+    def test_filename(self):
+        code = self._load(self.SRC)
+        renamed = dataclasses.replace(code, co_filename="other.py")
+        self.assertEqual(code.fingerprint(), renamed.fingerprint())
+
+
+class TestMarshalWriter(Base):
+    """Tests for marshal writer."""
+
+    def assertRoundTrip(self, obj, python_version=(3, 9)):
+        data = marshal.dumps(obj, python_version)
+        self.assertStrictEqual(self.load(data, python_version), obj)
+
+    def test_dump_simple(self):
+        self.assertEqual(marshal.dumps(None, (3, 9)), b"N")
+        self.assertEqual(marshal.dumps(True, (3, 9)), b"T")
+        self.assertEqual(marshal.dumps(-1, (3, 9)), b"i\xff\xff\xff\xff")
+        self.assertEqual(marshal.dumps("ab", (3, 9)), b"z\x02ab")
+        for obj in (
+            Ellipsis,
+            StopIteration,
+            2**31,
+            -(2**100),
+            1.5,
+            1 + 2j,
+            "a b",
+            "é",
+            "x" * 300,
+            b"\x00\x01",
+            (1, (2, "x")),
+            tuple(range(300)),
+            [1, [2]],
+            {"a": 1, 2: None},
+            {1, 2},
+            frozenset({"a", "b"}),
+        ):
+            self.assertRoundTrip(obj)
+
+    def test_shared_refs(self):
+        x = ("shared", 1.5)
+        data = marshal.dumps((x, x), (3, 9))
+        self.assertIn(bytes([marshal.Type.REF]), data)
+        y = self.load(data)
+        self.assertIs(y[0], y[1])
+
+    def test_trace(self):
+        for version in base.VERSIONS:
+            for testfile in ("basic", "complex_exception", "genexpr"):
+                with open(base.test_pyc(testfile, version), "rb") as f:
+                    data = f.read()[16:]
+                trace = marshal.Trace()
+                code = marshal.loads(data, version, trace=trace)
+                self.assertEqual(marshal.dumps(code, version, trace), data)
+                # Without the trace the data can differ, but loads to the same
+                # code.
+                data = marshal.dumps(code, version)
+                self.assertEqual(self.load(data, version), code)
+
+    def test_trace_mismatch(self):
+        version = sys.version_info[:2]
+        data = host_marshal.dumps(("a", 1))
+        trace = marshal.Trace()
+        marshal.loads(data, version, trace=trace)
+        for obj in (("a", 2.0), ("a", 1, 2), ("a",)):
+            with self.assertRaises(ValueError):
+                marshal.dumps(obj, version, trace)
+        with self.assertRaises(ValueError):
+            marshal.loads(data, version, lazy=True, trace=trace)
+
+    def test_host_code(self):
+        version = sys.version_info[:2]
+        if version not in base.VERSIONS:
+            self.skipTest("host version not supported")
+        code = compile(TestLazyCodeReader.SRC, "<test>", "exec")
+        loaded = self.load(host_marshal.dumps(code), version)
+        data = marshal.dumps(loaded, version)
+        self.assertEqual(host_marshal.loads(data), code)
+
+    def test_unmarshallable(self):
+        with self.assertRaises(ValueError):
+            marshal.dumps(object(), (3, 9))
+
+
+class TestFields(Base):
+    """Tests for loading only some fields of code objects."""
+
+    FIELDS = frozenset({"co_names", "co_consts", "co_name", "co_qualname"})
+
+    def test_skip_fields(self):
+        for version in base.VERSIONS:
+            for testfile in ("basic", "complex_exception", "genexpr"):
+                with open(base.test_pyc(testfile, version), "rb") as f:
+                    data = f.read()[16:]
+                full = self.load(data, version)
+                code = marshal.loads(data, version, fields=self.FIELDS)
+                self.assertEqual(code.co_names, full.co_names)
+                self.assertEqual(code.co_argcount, full.co_argcount)
+                # Fields shared through the reference table are skipped too.
+                stack = [code]
+                while stack:
+                    c = stack.pop()
+                    self.assertEqual(c.co_code, b"")
+                    self.assertEqual(c.co_filename, "")
+                    if version >= (3, 11):
+                        self.assertEqual(c.co_linetable, b"")
+                        self.assertEqual(c.co_exceptiontable, b"")
+                    else:
+                        self.assertEqual(c.co_lnotab, b"")
+                    stack.extend(
+                        x
+                        for x in c.co_consts
+                        if isinstance(x, types.CodeTypeBase)
+                    )
+                # The recursive and iterative readers skip the same fields,
+                # and reserve the same reference table slots as a full load.
+                reader = marshal.MarshalReader(data, version)
+                reader.load_iterative()
+                n_refs = len(reader.refs)
+                for lazy in (False, True):
+                    reader = marshal.MarshalReader(
+                        data, version, lazy=lazy, fields=self.FIELDS
+                    )
+                    self.assertEqual(reader.load(), code)
+                    self.assertEqual(len(reader.refs), n_refs)
+
+    def test_referenced_field(self):
+        with open(base.test_pyc("basic", (3, 11)), "rb") as f:
+            code = self.load(f.read()[16:], (3, 11))
+        # The writer stores the second co_code as a reference to the first.
+        data = marshal.dumps((code, code.co_code), (3, 11))
+        self.assertIn(bytes([marshal.Type.REF]), data)
+        for lazy in (False, True):
+            skipped, co_code = marshal.loads(
+                data, (3, 11), lazy=lazy, fields=self.FIELDS
+            )
+            self.assertEqual(skipped.co_code, b"")
+            self.assertEqual(co_code, code.co_code)
+        reader = marshal.MarshalReader(data, (3, 11), fields=self.FIELDS)
+        self.assertEqual(reader.load()[1], code.co_code)
+
+    def test_requested_fields(self):
+        with open(base.test_pyc("basic", (3, 11)), "rb") as f:
+            data = f.read()[16:]
+        full = self.load(data, (3, 11))
+        code = marshal.loads(data, (3, 11), fields={"co_code"})
+        self.assertEqual(code.co_code, full.co_code)
+        self.assertEqual(code.co_linetable, b"")
+        self.assertEqual(code.co_names, ())
+
+    def test_skip_consts(self):
+        for version in base.VERSIONS:
+            with open(base.test_pyc("genexpr", version), "rb") as f:
+                data = f.read()[16:]
+            full = self.load(data, version)
+            for lazy in (False, True):
+                code = marshal.loads(
+                    data, version, lazy=lazy, fields={"co_names"}
+                )
+                self.assertEqual(code.co_consts, ())
+                self.assertEqual(code.co_names, full.co_names)
+            reader = marshal.MarshalReader(data, version, fields={"co_names"})
+            self.assertEqual(reader.load_iterative(), code)
+
+    def test_bad_fields(self):
+        data = marshal.dumps(None, (3, 11))
+        with self.assertRaises(ValueError):
+            marshal.loads(data, (3, 11), fields={"co_bogus"})
+        with self.assertRaises(ValueError):
+            marshal.loads(data, (3, 11), fields=set(), fingerprints=True)
+
+
+class TestCodeIndex(Base):
+    """Tests for code_index() and load_code_at()."""
+
+    def test_load_code_at(self):
+        for version in base.VERSIONS:
+            for testfile in ("basic", "complex_exception", "genexpr"):
+                with open(base.test_pyc(testfile, version), "rb") as f:
+                    data = f.read()[16:]
+                code = self.load(data, version)
+                stack = [code]
+                expected = []
+                while stack:
+                    c = stack.pop()
+                    expected.append(c)
+                    stack.extend(
+                        x
+                        for x in reversed(c.co_consts)
+                        if isinstance(x, types.CodeTypeBase)
+                    )
+                index = marshal.code_index(data, version)
+                self.assertEqual(len(index), len(expected))
+                self.assertEqual(index[0].path, ())
+                for entry, c in zip(index, expected):
+                    if entry.path:
+                        self.assertEqual(entry.path[-1], c.co_name)
+                    self.assertEqual(entry.firstlineno, c.co_firstlineno)
+                    self.assertEqual(
+                        marshal.load_code_at(data, version, entry), c
+                    )
+
+    def test_shared_refs(self):
+        # The second function only refers to its name, filename and other
+        # strings defined by the first one.
+        version = sys.version_info[:2]
+        if version not in base.VERSIONS:
+            self.skipTest("host version not supported")
+        code = compile("def f(x): return x\ndef g(x): return x", "t", "exec")
+        data = host_marshal.dumps(code)
+        entry = marshal.code_index(data, version)[2]
+        self.assertEqual(entry.qualname, "g")
+        self.assertTrue(entry.refs)
+        g = self.load(data, version).co_consts[1]
+        self.assertEqual(marshal.load_code_at(data, version, entry), g)
+
+    def test_mismatch(self):
+        with open(base.test_pyc("basic", (3, 11)), "rb") as f:
+            data = f.read()[16:]
+        entry = marshal.code_index(data, (3, 11))[1]
+        with self.assertRaises(ValueError):
+            marshal.load_code_at(data[: entry.end - 1], (3, 11), entry)
+        entry.start += 1
+        with self.assertRaises(ValueError):
+            marshal.load_code_at(data, (3, 11), entry)
+
+
+class TestScan(Base):
+    """Tests for scan()."""
+
+    def test_matches_trace(self):
+        for version in base.VERSIONS:
+            for testfile in ("basic", "complex_exception", "genexpr"):
+                with open(base.test_pyc(testfile, version), "rb") as f:
+                    data = f.read()[16:]
+                trace = marshal.Trace()
+                marshal.loads(data, version, trace=trace)
+                result = marshal.scan(data, version)
+                self.assertEqual(result.n_objects, len(trace.codes))
+                n_code = trace.codes.count(marshal.Type.CODE)
+                n_code += trace.codes.count(
+                    marshal.Type.CODE | marshal.Flags.REF
+                )
+                self.assertEqual(result.n_code_objects, n_code)
+                # The module's code object is the whole of the data.
+                self.assertEqual(result.code_extents[0], (0, len(data)))
+                for start, end in result.code_extents:
+                    self.assertEqual(data[start] & ~marshal.Flags.REF, 0x63)
+                    self.assertLess(start, end)
+
+    def test_simple(self):
+        data = b"\xa9\x02\xe9\x07\x00\x00\x00{Nr\x01\x00\x00\x000"
+        result = marshal.scan(data, (3, 9))
+        self.assertEqual(result.n_objects, 6)
+        self.assertEqual(result.code_extents, [])
+
+    def test_truncated(self):
+        for data in (b")\x02N", b"{N", b"i\x01\x00", b"z\x05abc", b""):
+            with self.assertRaises(EOFError):
+                marshal.scan(data, (3, 9))
+
+    def test_bad_data(self):
+        for data in (
+            b"?",
+            b"r\x00\x00\x00\x00",
+            # A reference to a container from inside it.
+            b"\xa9\x01r\x00\x00\x00\x00",
+            b"(\xff\xff\xff\xff",
+        ):
+            with self.assertRaises(ValueError):
+                marshal.scan(data, (3, 9))
+
+    def test_trailing_bytes(self):
+        with self.assertRaises(BufferError):
+            marshal.scan(b"NN", (3, 9))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,98 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for pycnite.native."""
+
+import marshal as host_marshal
+import sys
+import textwrap
+import unittest
+
+from . import base
+from pycnite import marshal
+from pycnite import native
+from pycnite import pyc
+
+
+HOST_VERSION = sys.version_info[:2]
+
+
+@unittest.skipUnless(
+    native.can_load(HOST_VERSION), "host version not supported"
+)
+class TestNative(unittest.TestCase):
+    """Test the host marshal fast path."""
+
+    def test_testdata(self):
+        # Both paths agree on the whole corpus; only files compiled by the host
+        # version actually use the fast path.
+        for version in base.VERSIONS:
+            for prefix in ("basic", "complex_exception", "exception", "flow"):
+                path = base.test_pyc(prefix, version)
+                fast = pyc.load_file(path, native_fast_path=True)
+                slow = pyc.load_file(path)
+                self.assertEqual(fast, slow)
+                if version == HOST_VERSION:
+                    with open(path, "rb") as f:
+                        data = f.read()[16:]
+                    self.assertEqual(native.loads(data, version), slow)
+
+    def test_fields(self):
+        path = base.test_pyc("complex_exception", HOST_VERSION)
+        for fields in (set(), {"co_names"}, {"co_code", "co_lnotab"}):
+            fast = pyc.load_file(path, native_fast_path=True, fields=fields)
+            slow = pyc.load_file(path, fields=fields)
+            self.assertEqual(fast, slow)
+
+    def test_cells(self):
+        src = textwrap.dedent("""
+          def f(a, b, *args):
+            c = 1
+            def g():
+              return a, c
+            return g
+        """)
+        data = host_marshal.dumps(compile(src, "<test>", "exec"))
+        fast = marshal.loads(data, HOST_VERSION, native_fast_path=True)
+        slow = marshal.loads(data, HOST_VERSION)
+        self.assertEqual(fast, slow)
+        self.assertEqual(fast.co_consts[0].co_name, "f")
+
+    def test_surrogates(self):
+        data = host_marshal.dumps(("\ud800", frozenset(["\udfff"])))
+        self.assertEqual(
+            marshal.loads(data, HOST_VERSION, native_fast_path=True),
+            marshal.loads(data, HOST_VERSION),
+        )
+
+    def test_errors(self):
+        # Errors are reported by the pure python reader.
+        for data, error in ((b"NN", BufferError), (b"i\x01", EOFError)):
+            with self.assertRaises(error):
+                marshal.loads(data, HOST_VERSION, native_fast_path=True)
+
+    def test_malformed(self):
+        # A negative kwonlyargcount makes the host marshal module raise
+        # SystemError, but the pure python reader loads it.
+        with open(base.test_pyc("basic", HOST_VERSION), "rb") as f:
+            data = bytearray(f.read()[16:])
+        data[12] = 169
+        self.assertEqual(
+            marshal.loads(bytes(data), HOST_VERSION, native_fast_path=True),
+            marshal.loads(bytes(data), HOST_VERSION),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
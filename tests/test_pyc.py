@@ -14,6 +14,15 @@
 
 """Tests for pycnite.pyc."""
 
+import importlib.util
+import io
+import json
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
 import unittest
 
 from . import base
@@ -48,6 +57,195 @@ class TestLoader(unittest.TestCase):
             self.assertIsInstance(code, types.CodeTypeBase)
             self.assertEqual(version, code.python_version)
 
+    def test_load_file_mmap(self):
+        for version in base.VERSIONS:
+            path = base.test_pyc("exception", version)
+            expected = pyc.load_file(path)
+            code = pyc.load_file(path, mmap=True)
+            self.assertIsInstance(code.co_code, memoryview)
+            self.assertEqual(code, expected)
+            self.assertEqual(bytes(code.co_code), expected.co_code)
+
+    def test_load_file_malformed(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "test.pyc")
+        for data in (b"", b"\xa7\x0d\r\n"):
+            with open(path, "wb") as f:
+                f.write(data)
+            for mmap in (False, True):
+                with self.assertRaises(OSError):
+                    pyc.load_file(path, mmap=mmap)
+
+    def test_load_file_fields(self):
+        fields = {"co_names", "co_consts", "co_name"}
+        for version in base.VERSIONS:
+            path = base.test_pyc("exception", version)
+            expected = pyc.load_file(path)
+            for mmap in (False, True):
+                code = pyc.load_file(path, mmap=mmap, fields=fields)
+                self.assertEqual(code.co_code, b"")
+                self.assertEqual(code.co_names, expected.co_names)
+                self.assertEqual(code.co_name, expected.co_name)
+
+
+class TestHeader(unittest.TestCase):
+    """Test pyc header parsing."""
+
+    def test_read_header(self):
+        for version in base.VERSIONS:
+            path = base.test_pyc("basic", version)
+            header = pyc.read_header(path)
+            self.assertEqual(header.python_version, version)
+            self.assertFalse(header.hash_based)
+            self.assertIsNone(header.source_hash)
+            self.assertEqual(
+                header.source_size, os.path.getsize(base.test_src("basic"))
+            )
+
+    def test_read_header_stream(self):
+        path = base.test_pyc("basic", (3, 11))
+        with open(path, "rb") as f:
+            header = pyc.read_header(f)
+            self.assertEqual(f.tell(), 16)
+        self.assertEqual(header.magic_number, 3495)
+        self.assertEqual(header.mtime, 1691705700)
+
+    def test_hash_based(self):
+        data = b"\xa7\x0d\r\n\x03\x00\x00\x00" + b"12345678"
+        header = pyc.read_header(io.BytesIO(data))
+        self.assertTrue(header.hash_based)
+        self.assertTrue(header.check_source)
+        self.assertEqual(header.source_hash, b"12345678")
+        self.assertIsNone(header.mtime)
+
+    def test_malformed(self):
+        for data in (b"\xa7\x0d\r\n", b"\xa7\x0d\r\n\x04" + b"\x00" * 11):
+            with self.assertRaises(OSError):
+                pyc.read_header(io.BytesIO(data))
+
+    def test_read_headers(self):
+        headers = dict(pyc.read_headers(base.DATADIR))
+        # There may be other pycs, e.g. in testdata/src/__pycache__.
+        self.assertLessEqual(base.test_pycs(), set(headers))
+        for version in base.VERSIONS:
+            header = headers[base.test_pyc("basic", version)]
+            self.assertEqual(header.python_version, version)
+
+
+class TestStrip(unittest.TestCase):
+    """Test writing stripped pyc files."""
+
+    SRC = textwrap.dedent('''
+      """Module docstring."""
+      class A:
+        """Class docstring."""
+        def f(self):
+          """Method docstring."""
+          return [x for x in "ab"]
+      def g():
+        "used"
+        return "used"
+    ''')
+
+    def setUp(self):
+        super().setUp()
+        if sys.version_info[:2] not in base.VERSIONS:
+            self.skipTest("host version not supported")
+        code = compile(self.SRC, "<test>", "exec")
+        self.data = importlib.util.MAGIC_NUMBER + b"\0" * 12
+        self.data += marshal.dumps(code)
+
+    def _exec(self, data):
+        namespace = {}
+        exec(marshal.loads(data[16:]), namespace)  # pylint: disable=exec-used
+        return namespace
+
+    def test_strip(self):
+        header = pyc.read_header(io.BytesIO(self.data))
+        code = pyc.loads(self.data)
+        for line_tables in (False, True):
+            stripped = pyc.strip(code, line_tables=line_tables)
+            data = pyc.dumps(stripped, header)
+            self.assertEqual(data[:16], self.data[:16])
+            self.assertLess(len(data), len(self.data))
+            namespace = self._exec(data)
+            self.assertIsNone(namespace["__doc__"])
+            self.assertIsNone(namespace["A"].__doc__)
+            self.assertIsNone(namespace["A"].f.__doc__)
+            self.assertEqual(namespace["A"]().f(), ["a", "b"])
+            # Docstrings that are also used as constants are kept.
+            self.assertEqual(namespace["g"].__doc__, "used")
+            self.assertEqual(namespace["g"](), "used")
+
+    def test_strip_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "test.pyc")
+        with open(path, "wb") as f:
+            f.write(self.data)
+        pyc.strip_file(path, path)
+        with open(path, "rb") as f:
+            namespace = self._exec(f.read())
+        self.assertIsNone(namespace["A"].__doc__)
+
+
+class TestCodeIndex(unittest.TestCase):
+    """Test loading single code objects from pyc files."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.pyc = os.path.join(self.tmpdir, "test.pyc")
+        shutil.copy(base.test_pyc("complex_exception", (3, 11)), self.pyc)
+
+    def test_load_code_at(self):
+        code = pyc.load_file(self.pyc, native_fast_path=False)
+        f = code.co_consts[0]
+        for write_index in (False, True):
+            if write_index:
+                pyc.write_index(self.pyc)
+            self.assertEqual(pyc.load_code_at(self.pyc, f.co_name), f)
+            self.assertEqual(pyc.load_code_at(self.pyc, ""), code)
+            with self.assertRaises(KeyError):
+                pyc.load_code_at(self.pyc, "nonexistent")
+
+    def test_write_index(self):
+        index = pyc.read_index(self.pyc)
+        index_path = pyc.write_index(self.pyc)
+        self.assertTrue(os.path.exists(index_path))
+        self.assertEqual(pyc.read_index(self.pyc), index)
+        # A stale index is ignored.
+        with open(index_path, "r+b") as f:
+            f.seek(0)
+            f.write(b"{}")
+        self.assertEqual(pyc.read_index(self.pyc), index)
+        pyc.write_index(self.pyc)
+        shutil.copy(base.test_pyc("trivial", (3, 11)), self.pyc)
+        self.assertEqual(
+            pyc.read_index(self.pyc)[0].end, os.path.getsize(self.pyc) - 16
+        )
+
+    def test_index_key(self):
+        # Rename the top-level code in the index, to see when it is used.
+        index_path = pyc.write_index(self.pyc)
+        with open(index_path, "rb") as f:
+            header, *rows = f.readlines()
+        header = json.loads(header)
+        header["qualnames"][0] = "renamed"
+        with open(index_path, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.writelines(rows)
+        code = pyc.load_code_at(self.pyc, "renamed")
+        self.assertEqual(code, pyc.load_file(self.pyc))
+        # Rewriting the pyc file invalidates the index, even if its header and
+        # size are unchanged.
+        st = os.stat(self.pyc)
+        os.utime(self.pyc, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        with self.assertRaises(KeyError):
+            pyc.load_code_at(self.pyc, "renamed")
+
 
 if __name__ == "__main__":
     unittest.main()